@@ -0,0 +1,223 @@
+# atributos_index.py
+# Indice residente (somente leitura) de atributos por NCM, carregado na inicializacao
+
+import os
+import threading
+import time
+
+from atributos_store import _days_to_date
+from config import ATRIBUTOS_STORAGE, ATRIBUTOS_DB_FILE, ATRIBUTOS_FILE, INDEX_STATE_FILE
+
+# Intervalo minimo entre verificacoes de versao do indice (segundos)
+_VERSION_CHECK_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_index = None
+# Versao do ultimo carregamento iniciado (concluido ou em andamento)
+_version = None
+_checked_at = 0.0
+
+
+class AtributosIndex:
+    """
+    Atributos de todos os NCMs em memoria, por codigo NCM normalizado.
+
+    Envolve um AtributosStore (colunas numpy + offsets por NCM): busca
+    por NCM e um slice O(1) das colunas e cada consulta monta apenas os
+    dicionarios retornados, no formato de search.find_atributos_by_ncm.
+    """
+
+    def __init__(self, store, origem, version=None, load_seconds=0.0):
+        self.store = store
+        self.origem = origem
+        self.version = version
+        self.load_seconds = load_seconds
+        self._dates = {}
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, ncm_code):
+        return ncm_code in self.store
+
+    def find(self, ncm_code, limit=None):
+        """Atributos do NCM (codigo normalizado), no maximo limit; [] se ausente."""
+        bounds = self.store.slice(ncm_code)
+        if bounds is None:
+            return []
+        start, end = bounds
+        if limit is not None:
+            end = min(end, start + limit)
+
+        store = self.store
+        hits = [
+            {
+                "tipo": "atributo",
+                "ncm_codigo": ncm_code,
+                "atributo_codigo": store.atributo_codes[atributo_id],
+                "modalidade": store.modalidades[modalidade],
+                "obrigatorio": obrigatorio,
+                "multivalorado": multivalorado,
+                "data_inicio_vigencia": self._date(vigencia)
+            }
+            for atributo_id, modalidade, obrigatorio, multivalorado, vigencia in zip(
+                store.atributo_ids[start:end].tolist(),
+                store.modalidade[start:end].tolist(),
+                store.obrigatorio[start:end].tolist(),
+                store.multivalorado[start:end].tolist(),
+                store.vigencia[start:end].tolist()
+            )
+        ]
+        if store.vigencia_original:
+            # Datas que a coluna int32 nao reproduz: valor original
+            for r in range(start, end):
+                if r in store.vigencia_original:
+                    hits[r - start]["data_inicio_vigencia"] = store.vigencia_original[r]
+        return hits
+
+    def _date(self, days):
+        """Data 'YYYY-MM-DD' de dias desde 1970 (poucas datas distintas: em cache)."""
+        date = self._dates.get(days)
+        if date is None:
+            date = self._dates[days] = _days_to_date(days)
+        return date
+
+    def find_many(self, ncm_codes, limit=None):
+        """Atributos de varios NCMs: dict codigo -> lista (ver find)."""
+        return {code: self.find(code, limit) for code in dict.fromkeys(ncm_codes)}
+
+    def stats(self):
+        """Contagens, memoria estimada e origem do indice."""
+        return {
+            'ncms': len(self.store),
+            'atributos': self.store.num_atributos,
+            'memoria_mb': self.store.memory_usage() / (1024 * 1024),
+            'origem': self.origem,
+            'carga_s': self.load_seconds
+        }
+
+
+def index_version():
+    """
+    Versao dos dados de atributos: data de modificacao do estado do
+    indice e da tabela de atributos (mudam a cada indexacao) e tamanho e
+    data de modificacao do JSON de atributos das fontes.
+    """
+    version = []
+    for path in (INDEX_STATE_FILE, ATRIBUTOS_DB_FILE, ATRIBUTOS_FILE):
+        try:
+            st = os.stat(path)
+            version.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def load_atributos_index(version=None, from_sources=True):
+    """
+    Carrega indice de atributos, pela ordem: tabela local SQLite
+    (ATRIBUTOS_STORAGE='sqlite'), snapshot binario das fontes atuais
+    (data_snapshot) ou, com from_sources=True, processando o JSON de
+    atributos (load_parsed_data; lento, apenas em setup/warm-up).
+
+    Retorna None se nenhuma origem permitida estiver disponivel.
+    """
+    from atributos_table import atributos_table_exists, load_atributos_store, close_atributos_table
+    from data_snapshot import load_snapshot, snapshot_key
+
+    t0 = time.time()
+    version = index_version() if version is None else version
+    if ATRIBUTOS_STORAGE == 'sqlite' and atributos_table_exists():
+        # Reabre conexao: a tabela pode ter sido regravada por outro processo
+        close_atributos_table()
+        store, origem = load_atributos_store(), 'tabela'
+    else:
+        data = load_snapshot(snapshot_key(cached=True))
+        if data is not None:
+            store, origem = data[2], 'snapshot'
+        elif from_sources:
+            from data_snapshot import load_parsed_data
+            _, _, store = load_parsed_data()
+            origem = 'fontes'
+        else:
+            return None
+    return AtributosIndex(store, origem, version, time.time() - t0)
+
+
+def _load(version, from_sources):
+    """Carrega indice da versao e o publica se ela ainda for a atual."""
+    global _index
+
+    try:
+        index = load_atributos_index(version, from_sources)
+    except Exception as e:
+        print(f"Erro ao carregar indice de atributos: {e}")
+        index = None
+    with _lock:
+        if _version == version:
+            _index = index
+    return index
+
+
+def get_atributos_index():
+    """
+    Retorna indice residente de atributos, ou None enquanto nao houver
+    indice da versao atual (o chamador usa tabela local ou ChromaDB).
+
+    Nunca carrega no caminho da consulta: o indice e carregado em
+    setup/warm-up (preload_atributos_index). Quando a versao muda (nova
+    indexacao, fontes alteradas), o indice antigo e descartado e
+    recarregado em segundo plano a partir da tabela ou do snapshot, sem
+    processar o JSON de atributos. A versao e verificada no maximo uma
+    vez por _VERSION_CHECK_INTERVAL enquanto ha indice carregado.
+    """
+    global _index, _version, _checked_at
+
+    now = time.monotonic()
+    if _index is not None and now - _checked_at < _VERSION_CHECK_INTERVAL:
+        return _index
+
+    with _lock:
+        _checked_at = now
+        version = index_version()
+        if version == _version:
+            # Carregado (ou carregando / sem origem disponivel)
+            return _index
+        _version, _index = version, None
+
+    threading.Thread(target=_load, args=(version, False), daemon=True).start()
+    return None
+
+
+def preload_atributos_index(verbose=True):
+    """
+    Carrega o indice na inicializacao (setup e warm-up), podendo
+    processar o JSON de atributos se nao houver tabela nem snapshot.
+    Exibe resumo se verbose.
+    """
+    global _version, _index, _checked_at
+
+    with _lock:
+        version = index_version()
+        if version == _version and _index is not None:
+            index = _index
+        else:
+            _version, _index = version, None
+            index = None
+    if index is None:
+        index = _load(version, from_sources=True)
+        _checked_at = time.monotonic()
+
+    if index is not None and verbose:
+        stats = index.stats()
+        print(f"  Atributos em memoria: {stats['ncms']} NCMs, {stats['atributos']} atributos, "
+              f"{stats['memoria_mb']:.1f} MB ({stats['origem']}, {stats['carga_s']:.1f}s)")
+    return index
+
+
+def close_atributos_index():
+    """Descarta indice carregado (proximo uso recarrega)."""
+    global _index, _version
+    with _lock:
+        _index = None
+        _version = None
@@ -0,0 +1,323 @@
+# atributos_store.py
+# Armazenamento colunar de atributos por NCM com offsets (formato CSR)
+
+import sys
+import unicodedata
+from collections.abc import Sequence
+
+import numpy as np
+
+# Valor de vigencia para datas ausentes ou invalidas
+NO_DATE = np.iinfo(np.int32).min
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def _fold(text):
+    """Remove acentos e converte para minusculas (comparacao de modalidade)."""
+    text = unicodedata.normalize('NFKD', str(text))
+    return text.encode('ASCII', 'ignore').decode('ASCII').lower()
+
+
+def _date_to_days(value):
+    """Converte 'YYYY-MM-DD' em dias desde 1970-01-01 (NO_DATE se invalido)."""
+    try:
+        date = np.datetime64(value, 'D')
+    except (ValueError, TypeError):
+        return NO_DATE
+    # None e 'NaT' viram NaT sem erro
+    if np.isnat(date):
+        return NO_DATE
+    return int((date - _EPOCH).astype(np.int64))
+
+
+def _days_to_date(days):
+    """Inverso de _date_to_days; NO_DATE vira string vazia."""
+    if days == NO_DATE:
+        return ''
+    return str(_EPOCH + np.timedelta64(int(days), 'D'))
+
+
+class _AtributosSlice(Sequence):
+    """
+    Visao somente leitura dos atributos de um NCM.
+
+    Comporta-se como a listaAtributos original (len, indice, iteracao),
+    montando cada dicionario apenas quando acessado.
+    """
+
+    __slots__ = ('_store', '_start', '_end')
+
+    def __init__(self, store, start, end):
+        self._store = store
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._store.row(self._start + i)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class AtributosStore:
+    """
+    Armazenamento colunar dos atributos de todos os NCMs.
+
+    Substitui o dicionario {ncm: lista_de_dicts} de create_atributos_dict
+    por colunas numpy continuas:
+    - atributo_ids: id do codigo do atributo (indice em atributo_codes)
+    - modalidade: enum int8 (indice em modalidades)
+    - obrigatorio / multivalorado: mascaras booleanas
+    - vigencia: data de inicio de vigencia em dias desde 1970-01-01 (int32)
+    - vigencia_original: valor original das linhas cuja data a coluna
+      vigencia nao reproduz (ausente, nula ou fora do formato
+      'YYYY-MM-DD'), devolvido sem alteracao em row/date
+    - offsets: atributos do i-esimo NCM ficam em [offsets[i], offsets[i+1])
+
+    Busca por NCM e um slice O(1); varreduras como "todos atributos
+    obrigatorios de importacao" sao operacoes vetorizadas (mask,
+    counts_by_ncm, ncms_with).
+
+    Mantem interface de leitura de dicionario (in, len, [], get, items)
+    para substituir atributos_dict nos consumidores existentes.
+    """
+
+    def __init__(self, ncm_codes, offsets, atributo_ids, atributo_codes,
+                 modalidade, modalidades, obrigatorio, multivalorado, vigencia,
+                 vigencia_original=None):
+        self.ncm_codes = np.asarray(ncm_codes, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.atributo_ids = np.asarray(atributo_ids, dtype=np.int32)
+        self.atributo_codes = [sys.intern(c) for c in atributo_codes]
+        self.modalidade = np.asarray(modalidade, dtype=np.int8)
+        self.modalidades = list(modalidades)
+        self.obrigatorio = np.asarray(obrigatorio, dtype=bool)
+        self.multivalorado = np.asarray(multivalorado, dtype=bool)
+        self.vigencia = np.asarray(vigencia, dtype=np.int32)
+        self.vigencia_original = dict(vigencia_original or {})
+        self._index = {code: i for i, code in enumerate(self.ncm_codes.tolist())}
+        self._row_ncm = None
+
+    @classmethod
+    def from_ncm_items(cls, ncm_items):
+        """
+        Constroi store a partir de itens de 'listaNcm' (dict ou iteravel).
+
+        Aceita o gerador de data_loader.iter_atributos_ncm, consumindo um
+        NCM por vez; apenas as colunas compactas sao mantidas.
+        """
+        if isinstance(ncm_items, dict):
+            ncm_items = ncm_items.get('listaNcm', [])
+
+        ncm_codes = []
+        offsets = [0]
+        atributo_ids, modalidade, vigencia = [], [], []
+        obrigatorio, multivalorado = [], []
+        vigencia_original = {}
+        atributo_vocab = {}
+        modalidade_vocab = {}
+        # valor -> (dias, reproduzido pela coluna); poucas datas distintas
+        dates = {}
+
+        for item in ncm_items:
+            ncm_codes.append(item['codigoNcm'])
+            for atributo in item['listaAtributos']:
+                atributo_ids.append(
+                    atributo_vocab.setdefault(atributo['codigo'], len(atributo_vocab))
+                )
+                modalidade.append(
+                    modalidade_vocab.setdefault(atributo['modalidade'], len(modalidade_vocab))
+                )
+                obrigatorio.append(bool(atributo['obrigatorio']))
+                multivalorado.append(bool(atributo['multivalorado']))
+                value = atributo['dataInicioVigencia']
+                try:
+                    days, exact = dates[value]
+                except KeyError:
+                    days = _date_to_days(value)
+                    exact = _days_to_date(days) == value
+                    dates[value] = days, exact
+                except TypeError:
+                    days, exact = NO_DATE, False
+                if not exact:
+                    vigencia_original[len(vigencia)] = value
+                vigencia.append(days)
+            offsets.append(len(atributo_ids))
+
+        return cls(
+            ncm_codes=ncm_codes,
+            offsets=offsets,
+            atributo_ids=atributo_ids,
+            atributo_codes=list(atributo_vocab),
+            modalidade=modalidade,
+            modalidades=list(modalidade_vocab),
+            obrigatorio=obrigatorio,
+            multivalorado=multivalorado,
+            vigencia=vigencia,
+            vigencia_original=vigencia_original
+        )
+
+    @classmethod
+    def from_atributos_dict(cls, atributos_dict):
+        """Constroi store a partir do dicionario de create_atributos_dict."""
+        return cls.from_ncm_items(
+            {'codigoNcm': code, 'listaAtributos': attrs}
+            for code, attrs in atributos_dict.items()
+        )
+
+    # === Interface de dicionario ===
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, ncm_code):
+        return ncm_code in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, ncm_code):
+        i = self._index[ncm_code]
+        return _AtributosSlice(self, int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def get(self, ncm_code, default=None):
+        if ncm_code not in self._index:
+            return default
+        return self[ncm_code]
+
+    def items(self):
+        for ncm_code in self._index:
+            yield ncm_code, self[ncm_code]
+
+    def values(self):
+        for ncm_code in self._index:
+            yield self[ncm_code]
+
+    # === Acesso por linha/slice ===
+
+    @property
+    def num_atributos(self):
+        """Total de atributos (linhas) em todos os NCMs."""
+        return len(self.atributo_ids)
+
+    def slice(self, ncm_code):
+        """Intervalo (inicio, fim) das linhas do NCM, ou None se ausente."""
+        i = self._index.get(ncm_code)
+        if i is None:
+            return None
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def count(self, ncm_code):
+        """Quantidade de atributos do NCM (0 se ausente)."""
+        bounds = self.slice(ncm_code)
+        return bounds[1] - bounds[0] if bounds else 0
+
+    def row(self, r):
+        """Atributo da linha r no formato original de listaAtributos."""
+        return {
+            'codigo': self.atributo_codes[self.atributo_ids[r]],
+            'modalidade': self.modalidades[self.modalidade[r]],
+            'obrigatorio': bool(self.obrigatorio[r]),
+            'multivalorado': bool(self.multivalorado[r]),
+            'dataInicioVigencia': self.date(r)
+        }
+
+    def date(self, r):
+        """Data de inicio de vigencia da linha r, como no arquivo de origem."""
+        if r in self.vigencia_original:
+            return self.vigencia_original[r]
+        return _days_to_date(self.vigencia[r])
+
+    def dates(self, start=0, end=None):
+        """Datas de vigencia das linhas [start, end) (ver date), em lote."""
+        end = self.num_atributos if end is None else end
+        cache = {}
+        result = []
+        for days in self.vigencia[start:end].tolist():
+            date = cache.get(days)
+            if date is None:
+                date = cache[days] = _days_to_date(days)
+            result.append(date)
+        if end - start > len(self.vigencia_original):
+            originals = ((r, v) for r, v in self.vigencia_original.items() if start <= r < end)
+        else:
+            originals = ((r, self.vigencia_original[r]) for r in range(start, end)
+                         if r in self.vigencia_original)
+        for r, value in originals:
+            result[r - start] = value
+        return result
+
+    # === Varreduras vetorizadas ===
+
+    @property
+    def row_ncm(self):
+        """Indice do NCM de cada linha (calculado uma vez, sob demanda)."""
+        if self._row_ncm is None:
+            self._row_ncm = np.repeat(
+                np.arange(len(self.ncm_codes), dtype=np.int32), np.diff(self.offsets)
+            )
+        return self._row_ncm
+
+    def modalidade_id(self, nome):
+        """
+        Id da modalidade pelo nome, ignorando acentos e caixa
+        ('Importacao' equivale a 'Importação'). Retorna -1 se ausente.
+        """
+        folded = _fold(nome)
+        for i, modalidade in enumerate(self.modalidades):
+            if _fold(modalidade) == folded:
+                return i
+        return -1
+
+    def mask(self, modalidade=None, obrigatorio=None, multivalorado=None, vigente_em=None):
+        """
+        Mascara booleana sobre todas as linhas de atributos.
+
+        Filtros opcionais combinados com AND:
+        - modalidade: nome da modalidade (ver modalidade_id)
+        - obrigatorio / multivalorado: True ou False
+        - vigente_em: data 'YYYY-MM-DD'; mantem atributos com inicio de
+          vigencia ate essa data
+        """
+        result = np.ones(self.num_atributos, dtype=bool)
+        if modalidade is not None:
+            result &= self.modalidade == self.modalidade_id(modalidade)
+        if obrigatorio is not None:
+            result &= self.obrigatorio == bool(obrigatorio)
+        if multivalorado is not None:
+            result &= self.multivalorado == bool(multivalorado)
+        if vigente_em is not None:
+            result &= (self.vigencia != NO_DATE) & (self.vigencia <= _date_to_days(vigente_em))
+        return result
+
+    def counts_by_ncm(self, mask=None):
+        """Quantidade de linhas (filtradas por mask) por NCM, na ordem de ncm_codes."""
+        if mask is None:
+            return np.diff(self.offsets)
+        return np.bincount(self.row_ncm[mask], minlength=len(self.ncm_codes))
+
+    def ncms_with(self, mask):
+        """Codigos NCM com pelo menos uma linha em mask."""
+        return self.ncm_codes[self.counts_by_ncm(mask) > 0].tolist()
+
+    def memory_usage(self):
+        """Estimativa em bytes da memoria ocupada pela estrutura."""
+        arrays = (self.ncm_codes, self.offsets, self.atributo_ids, self.modalidade,
+                  self.obrigatorio, self.multivalorado, self.vigencia)
+        total = sum(a.nbytes for a in arrays)
+        total += sum(sys.getsizeof(c) for c in self.atributo_codes)
+        total += sys.getsizeof(self._index) + sum(sys.getsizeof(k) for k in self._index)
+        total += sys.getsizeof(self.vigencia_original)
+        if self._row_ncm is not None:
+            total += self._row_ncm.nbytes
+        return total
@@ -0,0 +1,260 @@
+# atributos_table.py
+# Tabela local (SQLite) de atributos por NCM, consultada por busca exata
+
+import itertools
+import os
+import sqlite3
+
+from config import ATRIBUTOS_DB_FILE, ATRIBUTOS_STORAGE
+
+# Esquema normalizado:
+# - atributo: dimensao com cada codigo de atributo uma unica vez
+# - ncm_atributo: associacao NCM x atributo com modalidade e flags,
+#   chave primaria (ncm_codigo, ordem) serve de indice para busca por NCM
+# - info: pares chave/valor da geracao (versao do arquivo, contagens)
+SCHEMA = """
+CREATE TABLE atributo (
+    id INTEGER PRIMARY KEY,
+    codigo TEXT NOT NULL UNIQUE
+);
+CREATE TABLE ncm_atributo (
+    ncm_codigo TEXT NOT NULL,
+    ordem INTEGER NOT NULL,
+    atributo_id INTEGER NOT NULL REFERENCES atributo(id),
+    modalidade TEXT NOT NULL,
+    obrigatorio INTEGER NOT NULL,
+    multivalorado INTEGER NOT NULL,
+    data_inicio_vigencia TEXT,
+    PRIMARY KEY (ncm_codigo, ordem)
+) WITHOUT ROWID;
+CREATE INDEX idx_ncm_atributo_atributo ON ncm_atributo(atributo_id);
+CREATE TABLE info (
+    chave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+_QUERY_BY_NCM = """
+SELECT na.ncm_codigo, a.codigo, na.modalidade, na.obrigatorio,
+       na.multivalorado, na.data_inicio_vigencia
+FROM ncm_atributo na JOIN atributo a ON a.id = na.atributo_id
+WHERE na.ncm_codigo = ?
+ORDER BY na.ordem
+"""
+
+# Varios NCMs por consulta (IN sobre a chave primaria)
+_QUERY_BY_NCMS = """
+SELECT na.ncm_codigo, a.codigo, na.modalidade, na.obrigatorio,
+       na.multivalorado, na.data_inicio_vigencia
+FROM ncm_atributo na JOIN atributo a ON a.id = na.atributo_id
+WHERE na.ncm_codigo IN ({})
+ORDER BY na.ncm_codigo, na.ordem
+"""
+
+# Codigos por consulta IN (limite de parametros do SQLite)
+_SQL_CHUNK = 900
+
+_connection = None
+_connection_path = None
+
+
+def atributos_table_exists(path=None):
+    """Verifica se a tabela de atributos ja foi gerada."""
+    return os.path.exists(path or ATRIBUTOS_DB_FILE)
+
+
+def get_connection(path=None):
+    """
+    Retorna conexao somente leitura com a tabela de atributos.
+
+    A conexao e aberta uma vez e reutilizada entre consultas
+    (check_same_thread=False: leituras podem vir de outras threads).
+    """
+    global _connection, _connection_path
+
+    path = path or ATRIBUTOS_DB_FILE
+    if _connection is None or _connection_path != path:
+        close_atributos_table()
+        uri = f"file:{os.path.abspath(path)}?mode=ro"
+        _connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        _connection_path = path
+    return _connection
+
+
+def close_atributos_table():
+    """Fecha conexao de leitura (ex.: antes de regravar a tabela)."""
+    global _connection, _connection_path
+
+    if _connection is not None:
+        _connection.close()
+    _connection = None
+    _connection_path = None
+
+
+def build_atributos_table(ncm_items, path=None, info=None):
+    """
+    Grava atributos na tabela SQLite a partir de itens de 'listaNcm'.
+
+    Aceita iteravel de itens (ex.: gerador de data_loader.iter_atributos_ncm,
+    consumido um NCM por vez, sem montar o corpus em memoria) ou um
+    AtributosStore. Valores sao gravados como no arquivo de origem.
+
+    Gera arquivo temporario e substitui o anterior ao final (os.replace),
+    de modo que leitores nunca veem tabela parcial. info (dict) e gravado
+    na tabela info junto com as contagens.
+
+    Retorna quantidade de linhas de associacao NCM x atributo.
+    """
+    path = path or ATRIBUTOS_DB_FILE
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    if hasattr(ncm_items, 'items'):
+        ncm_items = ({'codigoNcm': code, 'listaAtributos': attrs} for code, attrs in ncm_items.items())
+
+    vocab = {}
+    counts = {'atributos': 0, 'ncms': 0}
+
+    def associations():
+        for item in ncm_items:
+            ncm_code = item['codigoNcm']
+            counts['ncms'] += 1
+            for ordem, atributo in enumerate(item['listaAtributos']):
+                atributo_id = vocab.setdefault(atributo['codigo'], len(vocab))
+                counts['atributos'] += 1
+                yield (
+                    ncm_code, ordem, atributo_id, atributo['modalidade'],
+                    int(bool(atributo['obrigatorio'])), int(bool(atributo['multivalorado'])),
+                    atributo['dataInicioVigencia']
+                )
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO ncm_atributo VALUES (?, ?, ?, ?, ?, ?, ?)", associations())
+        conn.executemany(
+            "INSERT INTO atributo (id, codigo) VALUES (?, ?)",
+            ((atributo_id, codigo) for codigo, atributo_id in vocab.items())
+        )
+        info = dict(info or {})
+        info.update(counts)
+        info['codigos_atributo'] = len(vocab)
+        conn.executemany(
+            "INSERT INTO info (chave, valor) VALUES (?, ?)",
+            ((k, str(v)) for k, v in info.items())
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    close_atributos_table()
+    os.replace(tmp_path, path)
+    return counts['atributos']
+
+
+def _row_to_hit(row):
+    """Converte linha da consulta no formato de find_atributos_by_ncm."""
+    ncm_codigo, codigo, modalidade, obrigatorio, multivalorado, vigencia = row
+    return {
+        "tipo": "atributo",
+        "ncm_codigo": ncm_codigo,
+        "atributo_codigo": codigo,
+        "modalidade": modalidade,
+        "obrigatorio": bool(obrigatorio),
+        "multivalorado": bool(multivalorado),
+        "data_inicio_vigencia": vigencia
+    }
+
+
+def find_atributos(ncm_code, limit=None, path=None):
+    """
+    Atributos de um NCM (codigo ja normalizado, ex.: '0101.21.00').
+
+    Busca indexada pela chave primaria (ncm_codigo, ordem), na ordem
+    original do arquivo de atributos. limit=None retorna todos.
+    """
+    query = _QUERY_BY_NCM
+    params = [ncm_code]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
+    rows = get_connection(path).execute(query, params).fetchall()
+    return [_row_to_hit(row) for row in rows]
+
+
+def find_atributos_many(ncm_codes, limit=None, path=None):
+    """
+    Atributos de varios NCMs (codigos ja normalizados) em uma consulta.
+
+    Retorna dict codigo -> lista de atributos, na mesma ordem e formato
+    de find_atributos, com no maximo limit atributos por NCM; NCMs sem
+    atributos mapeiam para lista vazia.
+    """
+    codes = list(dict.fromkeys(ncm_codes))
+    grouped = {code: [] for code in codes}
+    conn = get_connection(path)
+    for start in range(0, len(codes), _SQL_CHUNK):
+        chunk = codes[start:start + _SQL_CHUNK]
+        rows = conn.execute(_QUERY_BY_NCMS.format(','.join('?' * len(chunk))), chunk)
+        for row in rows:
+            hits = grouped[row[0]]
+            if limit is None or len(hits) < limit:
+                hits.append(_row_to_hit(row))
+    return grouped
+
+
+def atributos_table_stats(path=None):
+    """Contagens e informacoes da geracao gravadas na tabela info."""
+    rows = get_connection(path).execute("SELECT chave, valor FROM info").fetchall()
+    stats = dict(rows)
+    for key in ('atributos', 'ncms', 'codigos_atributo'):
+        if key in stats:
+            stats[key] = int(stats[key])
+    return stats
+
+
+def load_atributos_store(path=None):
+    """
+    Reconstroi AtributosStore a partir da tabela (NCMs em ordem de codigo).
+    """
+    from atributos_store import AtributosStore
+
+    rows = get_connection(path).execute("""
+        SELECT na.ncm_codigo, a.codigo, na.modalidade, na.obrigatorio,
+               na.multivalorado, na.data_inicio_vigencia
+        FROM ncm_atributo na JOIN atributo a ON a.id = na.atributo_id
+        ORDER BY na.ncm_codigo, na.ordem
+    """)
+
+    ncm_items = (
+        {
+            'codigoNcm': ncm_code,
+            'listaAtributos': [
+                {
+                    'codigo': codigo,
+                    'modalidade': modalidade,
+                    'obrigatorio': bool(obrigatorio),
+                    'multivalorado': bool(multivalorado),
+                    'dataInicioVigencia': vigencia
+                }
+                for _, codigo, modalidade, obrigatorio, multivalorado, vigencia in group
+            ]
+        }
+        for ncm_code, group in itertools.groupby(rows, key=lambda row: row[0])
+    )
+    return AtributosStore.from_ncm_items(ncm_items)
+
+
+def count_atributos(collection, limit=100000):
+    """
+    Quantidade de atributos disponiveis para consulta.
+
+    Retorna tupla (quantidade, origem): 'tabela' quando ATRIBUTOS_STORAGE
+    for 'sqlite' e a tabela existir, senao conta documentos de atributo
+    no banco vetorial ('banco vetorial').
+    """
+    if ATRIBUTOS_STORAGE == 'sqlite' and atributos_table_exists():
+        return atributos_table_stats().get('atributos', 0), 'tabela'
+    return len(collection.get(where={"tipo": "atributo"}, limit=limit)['ids']), 'banco vetorial'
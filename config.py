@@ -29,6 +29,46 @@ NCM_FILE = "DATA/SubItemNcm.csv"
 # ATRIBUTOS_FILE: JSON com atributos por NCM
 ATRIBUTOS_FILE = "DATA/ATRIBUTOS_POR_NCM_2025_09_30.json"
 
+# Snapshot binario dos dados ja processados (tabela NCM, hierarquia e
+# mapa de atributos), indexado pelo hash do conteudo dos arquivos fonte
+# True: reutiliza snapshot quando fontes nao mudaram (carga em milissegundos)
+# False: sempre reprocessa CSV e JSON
+USE_DATA_SNAPSHOT = True
+# SNAPSHOT_DIR: diretorio onde snapshots sao gravados
+SNAPSHOT_DIR = "cache/snapshots"
+
+# Cache persistente de embeddings (embedding_cache.EmbeddingCache)
+# USE_EMBEDDING_CACHE: encode_text/encode_batch consultam o cache antes de
+#   vetorizar (chave: texto + modelo + backend + normalizacao); reindexar
+#   sem mudar o texto dos documentos nao re-vetoriza nada
+USE_EMBEDDING_CACHE = True
+# Vetores em matriz float32 unica por dimensao (append-only, lida via
+# np.memmap) e indice hash -> linha em SQLite no mesmo diretorio
+# Caches antigos (um .pkl por texto) sao importados com
+# python diagnostico/migrate_cache.py
+EMBEDDING_CACHE_DIR = "cache/embeddings"
+# EMBEDDING_CACHE_MEMORY_MB: camada em memoria (LRU) com os embeddings mais
+#   usados, na frente do disco; 0 desativa
+EMBEDDING_CACHE_MEMORY_MB = 64
+# EMBEDDING_CACHE_DISK_MB: cota do cache em disco; acima dela entradas sao
+#   removidas pela politica EMBEDDING_CACHE_EVICTION; 0 = sem limite
+EMBEDDING_CACHE_DISK_MB = 2048
+# EMBEDDING_CACHE_EVICTION: "lru" (menos recentemente usadas) ou "lfu"
+#   (menos acessadas, empate pela mais antiga)
+EMBEDDING_CACHE_EVICTION = "lru"
+# EMBEDDING_CACHE_CODEC: formato dos vetores gravados em disco
+#   "float32": exato (4 bytes por dimensao, 3 KB por vetor de 768)
+#   "float16": metade do espaco, erro desprezivel para busca por cosseno
+#   "pq": quantizacao por produto, EMBEDDING_CACHE_PQ_SUBVECTORS bytes por
+#         vetor; codebook treinado sobre o proprio cache quando houver
+#         EMBEDDING_CACHE_PQ_TRAIN_SIZE vetores da dimensao (ate la grava
+#         float16). Ver benchmarks.py --codecs (erro de reconstrucao/recall)
+# Vetores ja gravados em outro formato continuam legiveis; convert()
+# regrava o cache no formato atual
+EMBEDDING_CACHE_CODEC = "float32"
+EMBEDDING_CACHE_PQ_SUBVECTORS = 96
+EMBEDDING_CACHE_PQ_TRAIN_SIZE = 20000
+
 # Controla estrategia de indexacao hierarquica
 # False: indexa todos niveis (capitulos, posicoes, subitens, items)
 #        - Mais documentos, melhor contexto geral, possivel ruido
@@ -36,15 +76,146 @@ ATRIBUTOS_FILE = "DATA/ATRIBUTOS_POR_NCM_2025_09_30.json"
 #       - Menos documentos, mais preciso, perde contexto hierarquico
 INDEX_ONLY_ITEMS = False
 
+# Normalizacao avancada de texto (acentos, pontuacao, stopwords)
+# Lida uma unica vez na inicializacao; exporte DISABLE_NORMALIZATION=1
+# para indexar textos sem normalizacao (testes A/B)
+DISABLE_NORMALIZATION = os.environ.get('DISABLE_NORMALIZATION', '0') == '1'
+# Aplica a mesma normalizacao ao texto das consultas antes da vetorizacao
+# False: consulta enviada como digitada (comportamento original)
+NORMALIZE_QUERIES = False
+
+# Armazenamento dos atributos por NCM
+# "vector": um documento vetorizado por par (NCM, atributo) no ChromaDB
+#           (comportamento original)
+# "sqlite": tabela local normalizada (dimensao de atributos + associacao
+#           NCM x atributo) com busca indexada por codigo NCM; o banco
+#           vetorial guarda apenas documentos NCM (indexacao muito mais rapida)
+# Mudar o modo de um banco existente dispara indexacao incremental
+# (com INCREMENTAL_INDEX): documentos de atributo sao removidos ao passar
+# para "sqlite" e vetorizados ao voltar para "vector"
+ATRIBUTOS_STORAGE = "vector"
+# ATRIBUTOS_DB_FILE: arquivo SQLite da tabela de atributos
+ATRIBUTOS_DB_FILE = os.path.join(DB_PATH, "atributos.sqlite3")
+# Indice residente de atributos por NCM (atributos_index): carregado na
+# inicializacao (setup/warm-up) a partir da tabela local, do snapshot ou
+# do JSON de atributos; quando o indice ou as fontes mudam, recarregado
+# em segundo plano da tabela ou do snapshot (nunca do JSON durante uma
+# consulta). Consultas de atributos por NCM sao respondidas em memoria,
+# sem acessar SQLite/ChromaDB; sem indice carregado, usam a tabela local
+# ou o banco vetorial
+# False: cada consulta vai a tabela local ou ao banco vetorial
+ATRIBUTOS_RESIDENT_INDEX = True
+
+# Indexacao incremental quando as fontes mudam (ex.: nova versao do
+# arquivo de atributos)
+# True: compara hash de conteudo de cada documento com o banco existente,
+#       re-vetoriza apenas documentos novos/alterados e remove os excluidos
+# False: banco existente e reutilizado sem alteracoes (use CLEAR_DB)
+INCREMENTAL_INDEX = True
+# INDEX_STATE_FILE: estado da ultima indexacao (versao e hash das fontes,
+# modelo, tempo medio por documento), gravado junto ao banco
+INDEX_STATE_FILE = os.path.join(DB_PATH, "index_state.json")
+# BUILD_JOURNAL_FILE: diario dos lotes ja gravados durante uma indexacao;
+# permite retomar indexacao interrompida sem re-vetorizar lotes concluidos
+BUILD_JOURNAL_FILE = os.path.join(DB_PATH, "build_journal.jsonl")
+
+# Motor de busca dos documentos NCM
+# "chroma": consulta HNSW do ChromaDB com filtro tipo='ncm' (original)
+# "numpy": busca exata em memoria sobre matriz float32 normalizada dos
+#          vetores NCM (vector_index), mapeada em memoria. setup_database
+#          regrava a exportacao sempre que o estado do indice muda (toda
+#          indexacao; em instalacao existente, no primeiro inicio). Filtros
+#          nao suportados e exportacao desatualizada em relacao ao estado
+#          do indice (verificado a cada consulta) usam o ChromaDB.
+#          Ver benchmarks.py --busca
+SEARCH_ENGINE = "numpy"
+# VECTOR_INDEX_DIR: matriz de vetores NCM e metadados alinhados
+VECTOR_INDEX_DIR = os.path.join(DB_PATH, "vetores_ncm")
+
 # Tamanho do lote para indexacao no ChromaDB
 # ChromaDB tem limite de ~5461 documentos por lote
 BATCH_SIZE = 5000
 
+# Profundidade da fila entre vetorizacao e escrita no ChromaDB
+# Lotes vetorizados aguardam gravacao em uma fila limitada; quando cheia,
+# a vetorizacao espera (backpressure). Memoria maxima ~ (profundidade + 2) lotes
+INDEX_PIPELINE_DEPTH = 2
+
 # Modelo de embedding para vetorizacao de texto
 # Modelo multilingue recomendado para textos em portugues
 # Gera vetores de 768 dimensoes que capturam semantica do texto
 EMBEDDING_MODEL = "intfloat/multilingual-e5-base"
 
+# Backend de inferencia do modelo de embedding
+# "torch": PyTorch FP32 (original)
+# "onnx": ONNX Runtime, mesmo modelo exportado (vetores praticamente iguais)
+# "onnx-int8": ONNX com quantizacao dinamica int8 (mais rapido em CPU,
+#              pequena perda de qualidade; ver benchmarks.py --backends)
+# Trocar o backend re-vetoriza o corpus na proxima indexacao
+EMBEDDING_BACKEND = "torch"
+# EMBEDDING_ONNX_DIR: onde modelos exportados para ONNX sao gravados
+EMBEDDING_ONNX_DIR = "cache/onnx"
+# EMBEDDING_QUANTIZATION: instrucoes alvo da quantizacao int8
+# ("arm64", "avx2", "avx512" ou "avx512_vnni")
+EMBEDDING_QUANTIZATION = "avx2"
+
+# Snapshot local fixado do modelo (carga rapida e sem rede)
+# EMBEDDING_PINNED_SNAPSHOT: True exporta o modelo uma unica vez para
+#   EMBEDDING_SNAPSHOT_DIR (pesos em safetensors, mapeados em memoria) e
+#   carrega sempre dali em modo offline; False resolve pelo cache do
+#   Hugging Face a cada inicio (pode acessar a rede)
+# Apague o diretorio do snapshot para baixar o modelo novamente
+EMBEDDING_PINNED_SNAPSHOT = True
+EMBEDDING_SNAPSHOT_DIR = "cache/modelo"
+
+# Servidor de embeddings compartilhado (python embedding_server.py)
+# Com o servidor rodando, CLI, menu, Gradio e diagnosticos usam um unico
+# modelo carregado; sem ele, cada processo carrega o proprio modelo
+# EMBEDDING_SERVER_URL: endereco local do servidor ("" desativa o cliente)
+EMBEDDING_SERVER_URL = os.environ.get('EMBEDDING_SERVER_URL', 'http://127.0.0.1:8765')
+# EMBEDDING_SERVER_TIMEOUT: tempo maximo (s) de uma requisicao de vetorizacao
+EMBEDDING_SERVER_TIMEOUT = 300
+# EMBEDDING_SERVER_MAX_BATCH: textos agrupados de requisicoes concorrentes
+EMBEDDING_SERVER_MAX_BATCH = 256
+# EMBEDDING_SERVER_BATCH_WAIT_MS: espera por outras requisicoes antes de
+# vetorizar um lote (latencia adicional maxima por consulta)
+EMBEDDING_SERVER_BATCH_WAIT_MS = 5
+
+# Inicio do menu (main.py)
+# BACKGROUND_WARM_UP: True exibe o menu imediatamente e, em segundo plano,
+#   importa ChromaDB/sentence-transformers e abre a colecao; False carrega
+#   tudo no primeiro uso. Indexacao pendente sempre roda em primeiro plano
+BACKGROUND_WARM_UP = True
+
+# Lotes de vetorizacao agrupados por comprimento (em tokens)
+# EMBEDDING_TOKEN_BUDGET: maximo de tokens por lote contando padding
+#   (quantidade de textos x maior texto do lote); textos curtos formam
+#   lotes grandes e textos longos lotes pequenos
+EMBEDDING_TOKEN_BUDGET = 8192
+# EMBEDDING_MAX_BATCH: maximo de textos por lote, independente do orcamento
+EMBEDDING_MAX_BATCH = 256
+
+# Pool de processos para vetorizacao do corpus (opcional)
+# EMBEDDING_WORKERS: processos de vetorizacao, cada um com sua copia do
+#   modelo (~1 GB cada); 0 ou 1 desabilita (vetorizacao no processo atual)
+EMBEDDING_WORKERS = 0
+# EMBEDDING_THREADS_PER_WORKER: threads do torch por processo
+#   0: divide nucleos disponiveis igualmente entre os processos
+EMBEDDING_THREADS_PER_WORKER = 0
+# EMBEDDING_PIN_THREADS: fixa cada processo em um bloco exclusivo de
+#   nucleos (os.sched_setaffinity, apenas Linux)
+EMBEDDING_PIN_THREADS = True
+# EMBEDDING_POOL_CHUNK: maximo de textos por tarefa enviada a cada processo
+#   (lotes menores sao divididos igualmente entre os processos)
+EMBEDDING_POOL_CHUNK = 512
+# EMBEDDING_POOL_PREFETCH: lotes enviados ao pool alem do que esta sendo
+#   coletado (mantem os processos ocupados entre lotes; cada lote extra
+#   fica em memoria ate ser gravado)
+EMBEDDING_POOL_PREFETCH = 1
+# EMBEDDING_POOL_MIN_DOCS: indexador usa o pool automaticamente a partir
+#   deste total de documentos (abaixo disso nao compensa iniciar processos)
+EMBEDDING_POOL_MIN_DOCS = 10000
+
 # Modelo LLM padrao para geracao de respostas
 # Usado no modo interativo quando modelo nao especificado
 DEFAULT_MODEL = "gpt-oss-120b"
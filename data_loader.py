@@ -1,11 +1,20 @@
 # data_loader.py
 # Carregamento e normalizacao de dados NCM e atributos
 
+import sys
 import pandas as pd
+import numpy as np
 import json
 import unicodedata
 import re
-from config import NCM_FILE, ATRIBUTOS_FILE
+import codecs
+from functools import lru_cache
+from config import NCM_FILE, ATRIBUTOS_FILE, DISABLE_NORMALIZATION
+
+# Encodings aceitos para o JSON de atributos, em ordem de preferencia
+ATRIBUTOS_ENCODINGS = ['utf-8', 'iso-8859-1', 'latin-1', 'cp1252']
+
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
 
 
 def normalize_ncm_code(code):
@@ -29,6 +38,96 @@ def normalize_ncm_code(code):
     return code
 
 
+class _AsciiFoldTable(dict):
+    """
+    Tabela de traducao para str.translate que remove acentos.
+
+    Cada caractere nao-ASCII e mapeado, na primeira vez que aparece, para
+    sua decomposicao NFKD sem marcas nao-ASCII (equivalente a
+    normalize('NFKD') + encode('ASCII', 'ignore') caractere a caractere).
+    O resultado fica memorizado na propria tabela.
+    """
+
+    def __missing__(self, codepoint):
+        folded = unicodedata.normalize('NFKD', chr(codepoint))
+        folded = folded.encode('ASCII', 'ignore').decode('ASCII')
+        self[codepoint] = folded
+        return folded
+
+
+class TextNormalizer:
+    """
+    Normalizador de texto configurado uma unica vez para uso em lote.
+
+    Produz exatamente o mesmo resultado de normalize_text_advanced, mas:
+    - remove acentos via tabela de traducao (sem NFKD/encode por linha)
+    - usa expressao regular pre-compilada para pontuacao
+    - memoriza as linhas mais recentes em LRU limitado (titulos de
+      capitulo e posicao se repetem milhares de vezes na indexacao)
+
+    normalize_many normaliza uma lista de textos de uma vez e e a API
+    usada pelo indexador e, opcionalmente, pela busca.
+    """
+
+    STOPWORDS = frozenset({'de', 'da', 'do', 'dos', 'das', 'em', 'na', 'no', 'para', 'com', 'o', 'a'})
+
+    def __init__(self, keep_stopwords_if_short=True, cache_size=65536):
+        self.keep_stopwords_if_short = keep_stopwords_if_short
+        self._punctuation = re.compile(r'[^\w\s-]')
+        self._fold_table = _AsciiFoldTable()
+        self._cached = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, text):
+        # 1. Remove acentos mantendo semântica
+        if not text.isascii():
+            text = text.translate(self._fold_table)
+
+        # 2. Lowercase e 3. pontuação -> espaço (mantém hífens)
+        text = self._punctuation.sub(' ', text.lower())
+
+        # 4. split() ja descarta espaços múltiplos
+        words = text.split()
+
+        # 5. Remove stopwords apenas em textos com mais de 3 palavras
+        if self.keep_stopwords_if_short and len(words) > 3:
+            stopwords = self.STOPWORDS
+            words = [w for w in words if w not in stopwords or len(w) > 2]
+
+        return ' '.join(words)
+
+    def normalize(self, text):
+        """Normaliza um texto; valores vazios ou nao-string viram ''."""
+        if not text or not isinstance(text, str):
+            return ""
+        return self._cached(text)
+
+    def normalize_many(self, texts):
+        """Normaliza lista de textos, retornando lista na mesma ordem."""
+        normalize = self.normalize
+        return [normalize(text) for text in texts]
+
+    def cache_info(self):
+        """Estatisticas do LRU (hits, misses, maxsize, currsize)."""
+        return self._cached.cache_info()
+
+
+_normalizers = {}
+
+
+def get_text_normalizer(keep_stopwords_if_short=True):
+    """
+    Retorna instancia compartilhada de TextNormalizer para a configuracao.
+
+    Mantem um normalizador por valor de keep_stopwords_if_short para que
+    o LRU seja reaproveitado entre indexacao e consultas.
+    """
+    normalizer = _normalizers.get(keep_stopwords_if_short)
+    if normalizer is None:
+        normalizer = TextNormalizer(keep_stopwords_if_short=keep_stopwords_if_short)
+        _normalizers[keep_stopwords_if_short] = normalizer
+    return normalizer
+
+
 def normalize_text_advanced(text, keep_stopwords_if_short=True):
     """
     Normalizacao avancada de texto para melhorar busca semantica.
@@ -44,33 +143,31 @@ def normalize_text_advanced(text, keep_stopwords_if_short=True):
 
     Preserva stopwords em textos curtos para nao perder contexto importante.
     Objetivo: melhorar qualidade dos embeddings sem perder semantica.
-    """
-    if not text or not isinstance(text, str):
-        return ""
 
-    # 1. Remove acentos mantendo semântica
-    text = unicodedata.normalize('NFKD', text)
-    text = text.encode('ASCII', 'ignore').decode('ASCII')
-
-    # 2. Lowercase
-    text = text.lower()
+    Delega para o TextNormalizer compartilhado (get_text_normalizer).
+    """
+    return get_text_normalizer(keep_stopwords_if_short).normalize(text)
 
-    # 3. Remove pontuação extra, mantém espaços e hífens
-    text = re.sub(r'[^\w\s-]', ' ', text)
 
-    # 4. Remove espaços múltiplos
-    text = re.sub(r'\s+', ' ', text)
+def normalize_enriched_texts(texts):
+    """
+    Normaliza em lote textos enriquecidos de NCM (uma informacao por linha).
 
-    # 5. Remove stopwords muito comuns (mas não todas)
-    # Lista mínima para não perder semântica importante
-    minimal_stopwords = {'de', 'da', 'do', 'dos', 'das', 'em', 'na', 'no', 'para', 'com', 'o', 'a'}
-    words = text.split()
+    Cada linha e normalizada com TextNormalizer.normalize_many e as linhas
+    nao vazias de cada texto sao unidas com ' | ', mesmo formato de
+    create_enriched_ncm_text com normalizacao ativa.
 
-    # Só remove stopwords se texto tem mais de 3 palavras
-    if keep_stopwords_if_short and len(words) > 3:
-        words = [w for w in words if w not in minimal_stopwords or len(w) > 2]
+    Retorna lista de textos na mesma ordem da entrada.
+    """
+    split_texts = [text.split('\n') for text in texts]
+    flat_lines = [line for lines in split_texts for line in lines]
+    normalized = iter(get_text_normalizer().normalize_many(flat_lines))
 
-    return ' '.join(words).strip()
+    result = []
+    for lines in split_texts:
+        normalized_lines = [next(normalized) for _ in lines]
+        result.append(' | '.join([l for l in normalized_lines if l]))
+    return result
 
 
 def pad_ncm_code(code):
@@ -107,6 +204,37 @@ def pad_ncm_code(code):
         return code.ljust(8, '0')
 
 
+def pad_ncm_codes(codes):
+    """
+    Versao vetorizada de pad_ncm_code para uma Series de codigos.
+
+    Todos os casos de pad_ncm_code equivalem a completar com zeros a
+    direita ate 8 digitos, entao uma unica operacao str.ljust cobre a
+    hierarquia inteira sem loop em Python. Codigos vazios permanecem vazios.
+    """
+    codes = codes.fillna('').astype(str).str.strip()
+    return codes.where(codes == '', codes.str.ljust(8, '0'))
+
+
+def normalize_ncm_codes(codes):
+    """
+    Versao vetorizada de normalize_ncm_code para uma Series de codigos.
+
+    Remove pontos e hifens e formata codigos de 8 digitos como
+    XXXX.XX.XX usando apenas operacoes de string do pandas.
+    Demais codigos sao retornados sem pontos/hifens, como na versao escalar.
+    """
+    clean = (
+        codes.fillna('').astype(str).str.strip()
+        .str.replace('.', '', regex=False)
+        .str.replace('-', '', regex=False)
+    )
+    formatted = (
+        clean.str.slice(0, 4) + '.' + clean.str.slice(4, 6) + '.' + clean.str.slice(6, 8)
+    )
+    return formatted.where(clean.str.len() == 8, clean)
+
+
 def load_ncm_data():
     """
     Carrega dados NCM do arquivo CSV configurado.
@@ -119,8 +247,8 @@ def load_ncm_data():
     - Renomeia colunas para padrao Codigo/Descricao
     - Remove espacos extras dos dados
     - Filtra registros vazios
-    - Aplica padding correto nos codigos (pad_ncm_code)
-    - Gera codigo normalizado com pontos (normalize_ncm_code)
+    - Aplica padding correto nos codigos (pad_ncm_codes, vetorizado)
+    - Gera codigo normalizado com pontos (normalize_ncm_codes, vetorizado)
 
     Retorna DataFrame com colunas: Codigo, Descricao, CodigoNormalizado
     """
@@ -144,11 +272,10 @@ def load_ncm_data():
                 (ncm_df['Código'] != '') | (ncm_df['Descrição'] != '')
             ]
 
-            # Aplica padding baseado no tamanho original
-            mask = ncm_df['Código'] != ''
-            ncm_df.loc[mask, 'Código'] = ncm_df.loc[mask, 'Código'].apply(pad_ncm_code)
+            # Aplica padding baseado no tamanho original (vetorizado)
+            ncm_df['Código'] = pad_ncm_codes(ncm_df['Código'])
 
-            ncm_df['CódigoNormalizado'] = ncm_df['Código'].apply(normalize_ncm_code)
+            ncm_df['CódigoNormalizado'] = normalize_ncm_codes(ncm_df['Código'])
 
             print(f"NCM carregado: {encoding}, {len(ncm_df)} registros")
             return ncm_df
@@ -160,28 +287,193 @@ def load_ncm_data():
     return pd.DataFrame(columns=['Código', 'Descrição', 'CódigoNormalizado'])
 
 
+def detect_file_encoding(path, encodings, sample_size=65536):
+    """
+    Detecta encoding de um arquivo a partir de uma amostra inicial.
+
+    Le apenas os primeiros sample_size bytes e tenta decodifica-los com
+    cada encoding da lista, na ordem informada. Usa decodificador
+    incremental para nao falhar quando a amostra corta um caractere
+    multibyte no meio.
+
+    Retorna o primeiro encoding valido ou None se nenhum funcionar.
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+
+    for encoding in encodings:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+
+    return None
+
+
+def _iter_json_array(f, key, chunk_size):
+    """
+    Percorre incrementalmente os itens do array JSON associado a key.
+
+    Le o arquivo em blocos de chunk_size caracteres, localiza o array
+    '"key": [' e decodifica um objeto por vez com JSONDecoder.raw_decode,
+    descartando do buffer o que ja foi consumido. Memoria fica limitada
+    ao tamanho do bloco mais o maior item individual.
+    """
+    decoder = json.JSONDecoder()
+    marker = f'"{key}"'
+    buffer = ''
+
+    # Localiza a chave do array
+    while True:
+        pos = buffer.find(marker)
+        if pos >= 0:
+            buffer = buffer[pos + len(marker):]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer = buffer[-len(marker):] + chunk
+
+    # Avanca ate o inicio do array
+    while True:
+        pos = buffer.find('[')
+        if pos >= 0:
+            buffer = buffer[pos + 1:]
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+
+    pos = 0
+    while True:
+        pos = _JSON_SEPARATORS.match(buffer, pos).end()
+
+        if buffer.startswith(']', pos):
+            return
+
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                item, end = None, -1
+            if end >= 0:
+                yield item
+                pos = end
+                continue
+
+        chunk = f.read(chunk_size)
+        if not chunk:
+            if pos < len(buffer):
+                raise ValueError(f"JSON truncado no array '{key}'")
+            return
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def read_atributos_header(path=None, sample_size=65536):
+    """
+    Le campos de cabecalho do arquivo de atributos sem carregar a lista.
+
+    Procura os campos escalares que antecedem 'listaNcm' (ex.: 'versao')
+    apenas na amostra inicial do arquivo.
+
+    Retorna dicionario com os campos encontrados (pode ser vazio).
+    """
+    path = path or ATRIBUTOS_FILE
+    try:
+        encoding = detect_file_encoding(path, ATRIBUTOS_ENCODINGS) or 'utf-8'
+        with open(path, 'r', encoding=encoding, errors='replace') as f:
+            sample = f.read(sample_size)
+    except OSError:
+        return {}
+
+    header = {}
+    for match in re.finditer(r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)', sample.split('"listaNcm"')[0]):
+        header[match.group(1)] = json.loads(match.group(2))
+
+    return header
+
+
+def iter_atributos_ncm(path=None, chunk_size=1 << 20):
+    """
+    Gera itens de 'listaNcm' do arquivo de atributos um a um.
+
+    Alternativa em streaming a load_atributos_data: o encoding e detectado
+    por amostragem do inicio do arquivo e o JSON e decodificado
+    incrementalmente, sem montar a estrutura completa em memoria. Cada
+    item e um dicionario com 'codigoNcm' e 'listaAtributos'.
+
+    A amostra pode nao bastar (ex.: latin-1 com inicio todo ASCII): se a
+    decodificacao falhar no meio do arquivo, a leitura recomeca com o
+    proximo encoding da lista, pulando os itens ja entregues.
+
+    Se o arquivo estiver truncado, os itens completos ja lidos sao
+    entregues e um aviso e exibido ao final.
+    """
+    path = path or ATRIBUTOS_FILE
+    try:
+        encoding = detect_file_encoding(path, ATRIBUTOS_ENCODINGS)
+    except OSError as e:
+        print(f"ERRO: Não foi possível carregar atributos: {e}")
+        return
+
+    if encoding is None:
+        print("ERRO: Não foi possível detectar encoding dos atributos")
+        return
+
+    count = 0
+    for encoding in ATRIBUTOS_ENCODINGS[ATRIBUTOS_ENCODINGS.index(encoding):]:
+        try:
+            with open(path, 'r', encoding=encoding) as f:
+                for position, item in enumerate(_iter_json_array(f, 'listaNcm', chunk_size)):
+                    if position < count:
+                        # Ja entregue com o encoding anterior
+                        continue
+                    count += 1
+                    yield item
+            return
+        except UnicodeDecodeError as e:
+            print(f"AVISO: atributos nao estao em {encoding} (byte {e.start} do bloco, "
+                  f"apos {count} NCMs); tentando proximo encoding")
+        except ValueError as e:
+            print(f"AVISO: {e} apos {count} NCMs")
+            return
+
+    print(f"ERRO: Não foi possível decodificar atributos apos {count} NCMs")
+
+
 def load_atributos_data():
     """
     Carrega dados de atributos do arquivo JSON configurado.
 
-    Tenta multiplos encodings ate encontrar um valido.
+    Comeca pelo encoding detectado em amostra do inicio do arquivo e,
+    se a decodificacao falhar adiante, tenta os seguintes da lista.
     JSON contem estrutura com chave 'listaNcm' contendo lista de objetos,
     cada um com 'codigoNcm' e 'listaAtributos'.
 
+    Carrega o arquivo inteiro em memoria; para arquivos grandes prefira
+    iter_atributos_ncm, que percorre 'listaNcm' em streaming.
+
     Retorna dicionario com estrutura original do JSON.
     Em caso de erro, retorna dicionario vazio com chave 'listaNcm'.
     """
-    encodings = ['utf-8', 'iso-8859-1', 'latin-1', 'cp1252']
-    
-    for encoding in encodings:
-        try:
-            with open(ATRIBUTOS_FILE, 'r', encoding=encoding) as f:
-                data = json.load(f)
-            print(f"Atributos carregados: {encoding}, {len(data.get('listaNcm', []))} NCMs")
-            return data
-        except:
-            continue
-    
+    try:
+        encoding = detect_file_encoding(ATRIBUTOS_FILE, ATRIBUTOS_ENCODINGS)
+    except OSError:
+        encoding = None
+
+    if encoding is not None:
+        for encoding in ATRIBUTOS_ENCODINGS[ATRIBUTOS_ENCODINGS.index(encoding):]:
+            try:
+                with open(ATRIBUTOS_FILE, 'r', encoding=encoding) as f:
+                    data = json.load(f)
+                print(f"Atributos carregados: {encoding}, {len(data.get('listaNcm', []))} NCMs")
+                return data
+            except Exception:
+                continue
+
     print("ERRO: Não foi possível carregar atributos")
     return {'listaNcm': []}
 
@@ -215,6 +507,93 @@ def detect_ncm_level(codigo_norm):
     return 'desconhecido'
 
 
+def detect_ncm_levels(codigos_norm):
+    """
+    Versao vetorizada de detect_ncm_level para uma Series de codigos.
+
+    Aplica as mesmas regras com mascaras de tamanho e sufixo:
+    - Capitulo: 2 digitos ou 8 digitos terminando em 000000
+    - Posicao: 4 digitos ou 8 digitos terminando em 0000
+    - Subposicao: 6 digitos ou 8 digitos terminando em 00
+    - Item: demais codigos de 8 digitos
+
+    Retorna Series de strings alinhada ao indice de entrada.
+    """
+    code = codigos_norm.fillna('').astype(str).str.replace('.', '', regex=False)
+    length = code.str.len()
+    is_full = length == 8
+
+    conditions = [
+        (length == 2) | (is_full & code.str.endswith('000000')),
+        (length == 4) | (is_full & code.str.endswith('0000')),
+        (length == 6) | (is_full & code.str.endswith('00')),
+        is_full,
+    ]
+    niveis = np.select(
+        conditions, ['capitulo', 'posicao', 'subposicao', 'item'], default='desconhecido'
+    )
+    return pd.Series(niveis, index=codigos_norm.index, dtype=object)
+
+
+def _last_row_index(mask):
+    """
+    Para cada linha, posicao da ultima linha ate ela (inclusive) com mask
+    verdadeiro, via forward-fill. Retorna array int64 com -1 onde nao ha.
+    """
+    rows = np.arange(len(mask), dtype=np.float64)
+    last = pd.Series(np.where(mask, rows, np.nan)).ffill()
+    return last.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def build_ncm_hierarchy_frame(ncm_df):
+    """
+    Constroi hierarquia NCM em formato colunar, sem loop em Python.
+
+    Mesma semantica de build_ncm_hierarchy:
+    - nivel detectado por mascaras (detect_ncm_levels)
+    - capitulo/posicao pai obtidos por forward-fill da posicao da ultima
+      linha de capitulo/posicao vista, na ordem do arquivo
+    - linhas com codigo vazio sao ignoradas
+    - em codigos repetidos prevalece a ultima ocorrencia
+
+    Custo linear no numero de linhas.
+
+    Retorna DataFrame indexado por codigo NCM com colunas:
+    nivel, capitulo_codigo, capitulo_titulo, posicao_codigo, posicao_titulo
+    (None quando nao ha pai).
+    """
+    columns = ['nivel', 'capitulo_codigo', 'capitulo_titulo', 'posicao_codigo', 'posicao_titulo']
+
+    valid = ncm_df[ncm_df['Código'] != '']
+    if valid.empty:
+        return pd.DataFrame(columns=columns)
+
+    codigos = valid['Código'].to_numpy(dtype=object)
+    titulos = valid['Descrição'].to_numpy(dtype=object)
+    niveis = detect_ncm_levels(valid['CódigoNormalizado']).to_numpy()
+
+    def parent_columns(nivel, width):
+        last = _last_row_index(niveis == nivel)
+        has_parent = last >= 0
+        prefixes = valid['Código'].str.slice(0, width).to_numpy(dtype=object)
+        parent_codigo = np.where(has_parent, prefixes[last], None)
+        parent_titulo = np.where(has_parent, titulos[last], None)
+        return parent_codigo, parent_titulo
+
+    capitulo_codigo, capitulo_titulo = parent_columns('capitulo', 2)
+    posicao_codigo, posicao_titulo = parent_columns('posicao', 4)
+
+    frame = pd.DataFrame({
+        'nivel': niveis,
+        'capitulo_codigo': capitulo_codigo,
+        'capitulo_titulo': capitulo_titulo,
+        'posicao_codigo': posicao_codigo,
+        'posicao_titulo': posicao_titulo,
+    }, index=pd.Index(codigos, name='Código'), dtype=object)
+
+    return frame[~frame.index.duplicated(keep='last')]
+
+
 def build_ncm_hierarchy(ncm_df):
     """
     Constroi dicionario de hierarquia NCM.
@@ -224,40 +603,177 @@ def build_ncm_hierarchy(ncm_df):
     - capitulo: codigo e titulo do capitulo pai
     - posicao: codigo e titulo da posicao pai
 
-    Percorre DataFrame sequencialmente mantendo contexto do capitulo
-    e posicao atual para associar a subitens e items.
+    Calcula niveis e pais de forma vetorizada (build_ncm_hierarchy_frame)
+    e apenas converte o resultado para dicionarios. Entradas com o mesmo
+    pai compartilham o mesmo dicionario de capitulo/posicao.
 
     Retorna dicionario indexado por codigo NCM completo.
     """
+    frame = build_ncm_hierarchy_frame(ncm_df)
+
+    parents = {}
+
+    def parent(codigo, titulo):
+        if codigo is None:
+            return None
+        key = (codigo, titulo)
+        node = parents.get(key)
+        if node is None:
+            node = parents[key] = {'codigo': codigo, 'titulo': titulo}
+        return node
+
     hierarchy = {}
-    
-    current_capitulo = None
-    current_posicao = None
-    
-    for _, row in ncm_df.iterrows():
-        codigo = row['Código']
-        desc = row['Descrição']
-        codigo_norm = row['CódigoNormalizado']
-        
-        if not codigo:
-            continue
-        
-        nivel = detect_ncm_level(codigo_norm)
-        
-        if nivel == 'capitulo':
-            current_capitulo = {'codigo': codigo[:2], 'titulo': desc}
-        elif nivel == 'posicao':
-            current_posicao = {'codigo': codigo[:4], 'titulo': desc}
-        
+    for codigo, nivel, cap_cod, cap_tit, pos_cod, pos_tit in zip(
+        frame.index, frame['nivel'],
+        frame['capitulo_codigo'], frame['capitulo_titulo'],
+        frame['posicao_codigo'], frame['posicao_titulo']
+    ):
         hierarchy[codigo] = {
             'nivel': nivel,
-            'capitulo': current_capitulo,
-            'posicao': current_posicao
+            'capitulo': parent(cap_cod, cap_tit),
+            'posicao': parent(pos_cod, pos_tit)
         }
-    
+
     return hierarchy
 
 
+# Codigos de nivel usados por NcmHierarchy (indice = codigo int8)
+NIVEIS = ('desconhecido', 'capitulo', 'posicao', 'subposicao', 'item')
+
+
+class NcmHierarchy:
+    """
+    Representacao compacta da hierarquia NCM baseada em arrays.
+
+    Em vez de um dicionario por codigo com referencias a dicionarios de
+    capitulo/posicao, mantem uma tabela de nos:
+    - codes: codigos NCM (array numpy de strings)
+    - levels: nivel de cada no como int8 (indice em NIVEIS)
+    - capitulo_idx / posicao_idx: linha do no pai na propria tabela (-1 se nao ha)
+    - title_idx: indice do titulo em titles (apenas capitulos e posicoes)
+    - titles: titulos distintos internados, armazenados uma unica vez
+
+    Busca por codigo e O(1) via dicionario codigo -> linha. get() devolve
+    o mesmo formato de entrada de build_ncm_hierarchy, entao a classe pode
+    substituir o dicionario nos consumidores existentes.
+    """
+
+    def __init__(self, codes, levels, capitulo_idx, posicao_idx, title_idx, titles):
+        self.codes = np.asarray(codes, dtype=str)
+        self.levels = np.asarray(levels, dtype=np.int8)
+        self.capitulo_idx = np.asarray(capitulo_idx, dtype=np.int32)
+        self.posicao_idx = np.asarray(posicao_idx, dtype=np.int32)
+        self.title_idx = np.asarray(title_idx, dtype=np.int32)
+        self.titles = [sys.intern(t) for t in titles]
+        # Ultima ocorrencia prevalece em codigos repetidos
+        self._index = {code: row for row, code in enumerate(self.codes.tolist())}
+
+    @classmethod
+    def from_dataframe(cls, ncm_df):
+        """
+        Constroi hierarquia compacta a partir do DataFrame de load_ncm_data.
+
+        Mesma semantica de build_ncm_hierarchy_frame (niveis por mascara,
+        pais por forward-fill), sem loop em Python.
+        """
+        valid = ncm_df[ncm_df['Código'] != '']
+
+        niveis = detect_ncm_levels(valid['CódigoNormalizado']).to_numpy()
+        levels = pd.Categorical(niveis, categories=NIVEIS).codes.astype(np.int8)
+
+        is_capitulo = levels == NIVEIS.index('capitulo')
+        is_posicao = levels == NIVEIS.index('posicao')
+
+        # Apenas titulos de capitulos e posicoes sao referenciados como pais
+        parent_titles = np.where(
+            is_capitulo | is_posicao, valid['Descrição'].to_numpy(dtype=object), None
+        )
+        title_idx, titles = pd.factorize(parent_titles, use_na_sentinel=True)
+
+        return cls(
+            codes=valid['Código'].to_numpy(dtype=object),
+            levels=levels,
+            capitulo_idx=_last_row_index(is_capitulo),
+            posicao_idx=_last_row_index(is_posicao),
+            title_idx=title_idx,
+            titles=list(titles)
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, codigo):
+        return codigo in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, codigo):
+        entry = self.get(codigo)
+        if entry is None:
+            raise KeyError(codigo)
+        return entry
+
+    def _parent(self, row, width):
+        if row < 0:
+            return None
+        return {
+            'codigo': str(self.codes[row])[:width],
+            'titulo': self.titles[self.title_idx[row]]
+        }
+
+    def level(self, codigo):
+        """Nivel do codigo ('desconhecido' se ausente), sem montar dicionarios."""
+        row = self._index.get(codigo)
+        return NIVEIS[self.levels[row]] if row is not None else 'desconhecido'
+
+    def get(self, codigo, default=None):
+        """
+        Retorna entrada no formato de build_ncm_hierarchy ou default.
+
+        Formato: {'nivel': str, 'capitulo': {'codigo', 'titulo'} ou None,
+        'posicao': {'codigo', 'titulo'} ou None}
+        """
+        row = self._index.get(codigo)
+        if row is None:
+            return default
+
+        return {
+            'nivel': NIVEIS[self.levels[row]],
+            'capitulo': self._parent(int(self.capitulo_idx[row]), 2),
+            'posicao': self._parent(int(self.posicao_idx[row]), 4)
+        }
+
+    def items(self):
+        """Itera pares (codigo, entrada) na ordem do arquivo."""
+        for codigo in self._index:
+            yield codigo, self.get(codigo)
+
+    def memory_usage(self):
+        """
+        Estimativa em bytes da memoria ocupada pela estrutura.
+
+        Soma arrays numpy, titulos e o indice codigo -> linha (chaves e
+        tabela do dicionario).
+        """
+        arrays = (self.codes, self.levels, self.capitulo_idx, self.posicao_idx, self.title_idx)
+        total = sum(a.nbytes for a in arrays)
+        total += sys.getsizeof(self.titles) + sum(sys.getsizeof(t) for t in self.titles)
+        total += sys.getsizeof(self._index) + sum(sys.getsizeof(k) for k in self._index)
+        return total
+
+
+def build_ncm_hierarchy_compact(ncm_df):
+    """
+    Constroi hierarquia NCM compacta (NcmHierarchy).
+
+    Alternativa de menor memoria a build_ncm_hierarchy, com a mesma
+    interface de leitura (get, in, len). Preferida para processos de longa
+    duracao e para manter varias versoes de dados carregadas.
+    """
+    return NcmHierarchy.from_dataframe(ncm_df)
+
+
 def create_atributos_dict(atributos_data):
     """
     Cria dicionario de busca rapida de atributos por codigo NCM.
@@ -265,18 +781,39 @@ def create_atributos_dict(atributos_data):
     Extrai 'listaNcm' do JSON e mapeia cada codigoNcm para sua
     listaAtributos correspondente.
 
+    Aceita tanto o dicionario completo do JSON quanto um iteravel de
+    itens de 'listaNcm' (ex.: gerador de iter_atributos_ncm).
+
     Retorna dicionario: {codigo_ncm: lista_de_atributos}
     """
     atributos_dict = {}
-    
-    for item in atributos_data.get('listaNcm', []):
+
+    if isinstance(atributos_data, dict):
+        atributos_data = atributos_data.get('listaNcm', [])
+
+    for item in atributos_data:
         ncm_code = item['codigoNcm']
         atributos_dict[ncm_code] = item['listaAtributos']
     
     return atributos_dict
 
 
-def create_enriched_ncm_text(row, hierarchy, atributos_dict):
+def count_atributos_by_ncm(ncm_items=None):
+    """
+    Quantidade de atributos por codigo NCM, em uma passada de streaming.
+
+    Consome itens de 'listaNcm' (padrao: iter_atributos_ncm) sem guardar
+    as listas de atributos: memoria proporcional ao numero de NCMs.
+    Aceito por create_enriched_ncm_text no lugar de atributos_dict.
+
+    Retorna dicionario: {codigo_ncm: quantidade}
+    """
+    if ncm_items is None:
+        ncm_items = iter_atributos_ncm()
+    return {item['codigoNcm']: len(item['listaAtributos']) for item in ncm_items}
+
+
+def create_enriched_ncm_text(row, hierarchy, atributos_dict, normalize=None):
     """
     Cria texto enriquecido para indexacao vetorial de um NCM.
 
@@ -293,6 +830,11 @@ def create_enriched_ncm_text(row, hierarchy, atributos_dict):
 
     Aplica normalizacao avancada de texto (opcional via env DISABLE_NORMALIZATION)
     para melhorar embeddings removendo acentos, stopwords e pontuacao.
+    normalize=None segue a configuracao; False retorna texto bruto para
+    normalizacao posterior em lote (normalize_enriched_texts).
+
+    atributos_dict mapeia codigo NCM para a lista de atributos ou apenas
+    para a quantidade (count_atributos_by_ncm).
 
     Retorna string formatada pronta para vetorizacao.
     """
@@ -333,22 +875,23 @@ def create_enriched_ncm_text(row, hierarchy, atributos_dict):
     # Adiciona indicador de nível para ajudar no ranking
     texto += f"\nNível: {nivel}"
 
-    # Indica se tem atributos cadastrados
+    # Indica se tem atributos cadastrados (lista ou quantidade, ver
+    # count_atributos_by_ncm)
     if codigo_norm in atributos_dict:
-        num_attrs = len(atributos_dict[codigo_norm])
+        num_attrs = atributos_dict[codigo_norm]
+        if not isinstance(num_attrs, int):
+            num_attrs = len(num_attrs)
         texto += f"\nAtributos: {num_attrs} cadastrados"
 
     # Aplica normalização avançada para melhorar embeddings (OPCIONAL)
     # Pode ser desabilitada para testes A/B via variável de ambiente
-    import os
-    USE_NORMALIZATION = os.environ.get('DISABLE_NORMALIZATION', '0') != '1'
+    # DISABLE_NORMALIZATION (lida uma única vez em config.py)
+    if normalize is None:
+        normalize = not DISABLE_NORMALIZATION
 
-    if USE_NORMALIZATION:
+    if normalize:
         # Normaliza cada linha
-        lines = texto.split('\n')
-        normalized_lines = [normalize_text_advanced(line, keep_stopwords_if_short=True) for line in lines]
-        texto_normalizado = ' | '.join([l for l in normalized_lines if l])
-        return texto_normalizado
+        return normalize_enriched_texts([texto])[0]
     else:
         # Retorna SEM normalização (para testes A/B)
         return texto
@@ -0,0 +1,343 @@
+# data_snapshot.py
+# Snapshot binario dos dados NCM processados, indexado por hash do conteudo
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config import NCM_FILE, ATRIBUTOS_FILE, SNAPSHOT_DIR, USE_DATA_SNAPSHOT
+
+# Versao do formato do snapshot. Incrementar quando a logica de
+# carregamento/normalizacao mudar, invalidando snapshots antigos.
+SNAPSHOT_FORMAT = 4
+
+_SEPARATOR = '\x00'
+
+# Ultimo hash calculado de cada arquivo fonte com (tamanho, mtime_ns) do
+# arquivo na ocasiao: verificacao rapida de fontes alteradas
+DIGEST_FILE = 'hashes_fontes.json'
+
+
+def _digest_path():
+    return os.path.join(SNAPSHOT_DIR, DIGEST_FILE)
+
+
+def _load_digests():
+    try:
+        with open(_digest_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_digest(path, stat, digest):
+    """Registra hash do arquivo (falha de gravacao apenas desativa o atalho)."""
+    digests = _load_digests()
+    digests[os.path.abspath(path)] = {'stat': stat, 'sha256': digest}
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tmp = _digest_path() + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(digests, f, indent=2)
+        os.replace(tmp, _digest_path())
+    except OSError:
+        pass
+
+
+def _file_digest(path, chunk_size=1 << 20, cached=False):
+    """
+    Calcula hash SHA-256 do conteudo de um arquivo em blocos.
+
+    Com cached=True, reutiliza o ultimo hash calculado se tamanho e
+    mtime do arquivo nao mudaram (sem reler o arquivo). Todo calculo
+    completo atualiza esse registro.
+
+    Retorna string hexadecimal ou 'ausente' se arquivo nao existir.
+    """
+    if not os.path.exists(path):
+        return 'ausente'
+
+    st = os.stat(path)
+    stat = [st.st_size, st.st_mtime_ns]
+    if cached:
+        entry = _load_digests().get(os.path.abspath(path))
+        if entry and entry.get('stat') == stat:
+            return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    _save_digest(path, stat, digest)
+    return digest
+
+
+def snapshot_key(ncm_file=None, atributos_file=None, cached=False):
+    """
+    Gera chave do snapshot a partir do conteudo dos arquivos fonte.
+
+    Combina versao do formato com hash de cada arquivo, de modo que
+    qualquer alteracao nas fontes (ou no formato) gera chave nova.
+
+    cached=True (verificacoes de indice atualizado na inicializacao)
+    confia no hash registrado enquanto tamanho e mtime dos arquivos nao
+    mudarem; carga de snapshot e indexacao usam o hash completo.
+    """
+    ncm_file = ncm_file or NCM_FILE
+    atributos_file = atributos_file or ATRIBUTOS_FILE
+
+    key = hashlib.sha256()
+    key.update(f"formato={SNAPSHOT_FORMAT}".encode('utf-8'))
+    key.update(_file_digest(ncm_file, cached=cached).encode('utf-8'))
+    key.update(_file_digest(atributos_file, cached=cached).encode('utf-8'))
+    return key.hexdigest()[:16]
+
+
+def _pack_strings(values):
+    """Concatena strings em um unico buffer UTF-8 separado por NUL."""
+    text = _SEPARATOR.join('' if v is None else str(v) for v in values)
+    return np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+
+
+def _unpack_strings(buffer, count):
+    """Inverso de _pack_strings: retorna lista com count strings."""
+    if count == 0:
+        return []
+    return buffer.tobytes().decode('utf-8').split(_SEPARATOR)
+
+
+def _pack_hierarchy(hierarchy):
+    """
+    Converte hierarquia compacta (NcmHierarchy) em arrays.
+
+    Os arrays da tabela de nos sao gravados diretamente; codigos e
+    titulos vao como buffers de strings.
+    """
+    return {
+        'hier_codes': _pack_strings(hierarchy.codes.tolist()),
+        'hier_levels': hierarchy.levels,
+        'hier_capitulo': hierarchy.capitulo_idx,
+        'hier_posicao': hierarchy.posicao_idx,
+        'hier_title_idx': hierarchy.title_idx,
+        'hier_titles': _pack_strings(hierarchy.titles),
+    }, {'hierarquia': len(hierarchy.codes), 'titulos': len(hierarchy.titles)}
+
+
+def _unpack_hierarchy(arrays, counts):
+    """Reconstroi NcmHierarchy a partir dos arrays."""
+    from data_loader import NcmHierarchy
+
+    return NcmHierarchy(
+        codes=_unpack_strings(arrays['hier_codes'], counts['hierarquia']),
+        levels=arrays['hier_levels'],
+        capitulo_idx=arrays['hier_capitulo'],
+        posicao_idx=arrays['hier_posicao'],
+        title_idx=arrays['hier_title_idx'],
+        titles=_unpack_strings(arrays['hier_titles'], counts['titulos'])
+    )
+
+
+def _pack_atributos(store):
+    """
+    Converte AtributosStore em arrays.
+
+    Colunas numericas sao gravadas diretamente; obrigatorio/multivalorado
+    como bitsets (np.packbits) e vocabularios como buffers de strings.
+    """
+    return {
+        'attr_ncm_codes': _pack_strings(store.ncm_codes.tolist()),
+        'attr_offsets': store.offsets,
+        'attr_ids': store.atributo_ids,
+        'attr_vocab': _pack_strings(store.atributo_codes),
+        'attr_modalidade': store.modalidade,
+        'attr_modalidades': _pack_strings(store.modalidades),
+        'attr_obrigatorio': np.packbits(store.obrigatorio),
+        'attr_multivalorado': np.packbits(store.multivalorado),
+        'attr_vigencia': store.vigencia,
+        # Datas fora de 'YYYY-MM-DD' (linha + valor original em JSON)
+        'attr_vigencia_orig_rows': np.fromiter(store.vigencia_original, dtype=np.int64),
+        'attr_vigencia_orig_values': _pack_strings(
+            [json.dumps(v, ensure_ascii=False) for v in store.vigencia_original.values()]
+        ),
+    }, {
+        'ncm_atributos': len(store.ncm_codes),
+        'atributos': store.num_atributos,
+        'codigos_atributo': len(store.atributo_codes),
+        'modalidades': len(store.modalidades),
+        'vigencias_originais': len(store.vigencia_original)
+    }
+
+
+def _unpack_atributos(arrays, counts):
+    """Reconstroi AtributosStore a partir dos arrays."""
+    from atributos_store import AtributosStore
+
+    n_attrs = counts['atributos']
+    return AtributosStore(
+        ncm_codes=_unpack_strings(arrays['attr_ncm_codes'], counts['ncm_atributos']),
+        offsets=arrays['attr_offsets'],
+        atributo_ids=arrays['attr_ids'],
+        atributo_codes=_unpack_strings(arrays['attr_vocab'], counts['codigos_atributo']),
+        modalidade=arrays['attr_modalidade'],
+        modalidades=_unpack_strings(arrays['attr_modalidades'], counts['modalidades']),
+        obrigatorio=np.unpackbits(arrays['attr_obrigatorio'], count=n_attrs).astype(bool),
+        multivalorado=np.unpackbits(arrays['attr_multivalorado'], count=n_attrs).astype(bool),
+        vigencia=arrays['attr_vigencia'],
+        vigencia_original=zip(
+            arrays['attr_vigencia_orig_rows'].tolist(),
+            map(json.loads, _unpack_strings(arrays['attr_vigencia_orig_values'], counts['vigencias_originais']))
+        )
+    )
+
+
+def save_snapshot(key, ncm_df, hierarchy, atributos_dict, snapshot_dir=None):
+    """
+    Grava snapshot dos dados processados.
+
+    Formato:
+    - {key}.npz: arrays numpy (strings concatenadas em buffers UTF-8,
+      indices e flags em arrays tipados), sem pickle
+    - {key}.json: arquivo lateral com contagens e informacoes da geracao
+
+    Retorna caminho do arquivo .npz gravado.
+    """
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+    arrays = {
+        'ncm_index': ncm_df.index.to_numpy(dtype=np.int64),
+        'ncm_codigo': _pack_strings(ncm_df['Código']),
+        'ncm_descricao': _pack_strings(ncm_df['Descrição']),
+        'ncm_normalizado': _pack_strings(ncm_df['CódigoNormalizado']),
+    }
+    counts = {'ncm': len(ncm_df)}
+
+    hier_arrays, hier_counts = _pack_hierarchy(hierarchy)
+    attr_arrays, attr_counts = _pack_atributos(atributos_dict)
+    arrays.update(hier_arrays)
+    arrays.update(attr_arrays)
+    counts.update(hier_counts)
+    counts.update(attr_counts)
+
+    npz_path = snapshot_dir / f"{key}.npz"
+    tmp_path = snapshot_dir / f"{key}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, npz_path)
+
+    side = {
+        'formato': SNAPSHOT_FORMAT,
+        'key': key,
+        'criado_em': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'fontes': {'ncm': NCM_FILE, 'atributos': ATRIBUTOS_FILE},
+        'contagens': counts
+    }
+    with open(snapshot_dir / f"{key}.json", 'w', encoding='utf-8') as f:
+        json.dump(side, f, indent=2, ensure_ascii=False)
+
+    return npz_path
+
+
+def load_snapshot(key, snapshot_dir=None, atributos=True):
+    """
+    Carrega snapshot gravado por save_snapshot.
+
+    Retorna tupla (ncm_df, hierarchy, atributos_dict), com hierarchy
+    como NcmHierarchy e atributos_dict como AtributosStore, ou None se o
+    snapshot nao existir ou estiver incompleto/corrompido. Com
+    atributos=False, os arrays de atributos nao sao lidos e
+    atributos_dict e None.
+    """
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    npz_path = snapshot_dir / f"{key}.npz"
+    side_path = snapshot_dir / f"{key}.json"
+
+    if not npz_path.exists() or not side_path.exists():
+        return None
+
+    try:
+        with open(side_path, 'r', encoding='utf-8') as f:
+            side = json.load(f)
+        if side.get('formato') != SNAPSHOT_FORMAT:
+            return None
+        counts = side['contagens']
+
+        with np.load(npz_path, allow_pickle=False) as arrays:
+            n = counts['ncm']
+            ncm_df = pd.DataFrame({
+                'Código': _unpack_strings(arrays['ncm_codigo'], n),
+                'Descrição': _unpack_strings(arrays['ncm_descricao'], n),
+                'CódigoNormalizado': _unpack_strings(arrays['ncm_normalizado'], n),
+            }, index=arrays['ncm_index'])
+            hierarchy = _unpack_hierarchy(arrays, counts)
+            atributos_dict = _unpack_atributos(arrays, counts) if atributos else None
+
+        return ncm_df, hierarchy, atributos_dict
+
+    except Exception as e:
+        print(f"Snapshot invalido ({key}): {e}")
+        return None
+
+
+def load_parsed_data(use_snapshot=None, snapshot_dir=None, atributos=True):
+    """
+    Retorna dados NCM processados, reutilizando snapshot quando possivel.
+
+    Se existir snapshot para o hash atual dos arquivos fonte, carrega-o
+    diretamente. Caso contrario, processa CSV e JSON (streaming) com
+    data_loader, constroi hierarquia compacta (NcmHierarchy) e store
+    colunar de atributos (AtributosStore) e grava novo snapshot para as
+    proximas execucoes.
+
+    Com atributos=False (indexacao, que percorre o JSON de atributos em
+    streaming), atributos_dict e None: o snapshot e lido sem os arrays
+    de atributos e, sem snapshot, o JSON nao e processado (nenhum
+    snapshot e gravado).
+
+    Usado por setup_database, diagnosticos e benchmarks para evitar
+    reprocessar as fontes a cada execucao.
+
+    Retorna tupla: (ncm_df, hierarchy, atributos_dict)
+    """
+    from data_loader import load_ncm_data, iter_atributos_ncm, build_ncm_hierarchy_compact
+    from atributos_store import AtributosStore
+
+    if use_snapshot is None:
+        use_snapshot = USE_DATA_SNAPSHOT
+
+    key = None
+    if use_snapshot:
+        t0 = time.time()
+        key = snapshot_key()
+        data = load_snapshot(key, snapshot_dir, atributos=atributos)
+        if data is not None:
+            print(f"Snapshot carregado: {key} ({time.time()-t0:.2f}s)")
+            return data
+        print(f"Snapshot nao encontrado para {key}, processando fontes...")
+
+    ncm_df = load_ncm_data()
+    atributos_dict = AtributosStore.from_ncm_items(iter_atributos_ncm()) if atributos else None
+    hierarchy = build_ncm_hierarchy_compact(ncm_df)
+
+    if use_snapshot and atributos and not ncm_df.empty:
+        try:
+            path = save_snapshot(key, ncm_df, hierarchy, atributos_dict, snapshot_dir)
+            print(f"Snapshot gravado: {path}")
+        except Exception as e:
+            print(f"Erro ao gravar snapshot: {e}")
+
+    return ncm_df, hierarchy, atributos_dict
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    ncm_df, hierarchy, atributos_dict = load_parsed_data()
+    print(f"NCM: {len(ncm_df)} registros")
+    print(f"Hierarquia: {len(hierarchy)} niveis")
+    print(f"Atributos: {len(atributos_dict)} NCMs mapeados")
+    print(f"Tempo: {time.time()-t0:.3f}s")
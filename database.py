@@ -1,8 +1,13 @@
 # database.py
 # Gerenciamento do banco vetorial ChromaDB
 
-import chromadb
-from config import DB_PATH, COLLECTION_NAME
+import functools
+import json
+import os
+import threading
+
+import numpy as np
+from config import DB_PATH, COLLECTION_NAME, INDEX_STATE_FILE, BUILD_JOURNAL_FILE
 
 
 def get_client():
@@ -12,10 +17,43 @@ def get_client():
     Utiliza PersistentClient para armazenar dados em disco no diretorio
     especificado em DB_PATH. Permite reutilizar banco entre execucoes
     sem necessidade de reindexacao.
+
+    chromadb e importado aqui, no primeiro uso, e nao ao importar este
+    modulo (inicio rapido de CLI e diagnosticos que nao usam o banco).
     """
+    import chromadb
     return chromadb.PersistentClient(path=DB_PATH)
 
 
+@functools.lru_cache(maxsize=None)
+def _chroma_accepts_numpy():
+    """ChromaDB >= 0.5 aceita arrays numpy diretamente em add/query."""
+    import chromadb
+    try:
+        major, minor = (int(p) for p in chromadb.__version__.split('.')[:2])
+    except (AttributeError, ValueError):
+        return False
+    return (major, minor) >= (0, 5)
+
+
+def to_chroma_embeddings(vectors):
+    """
+    Converte vetores para gravacao/consulta no ChromaDB.
+
+    Unica conversao do caminho de vetores: embeddings circulam como
+    arrays float32 continuos (n x dimensao) e so aqui, na fronteira com
+    o banco, sao adaptados. Versoes do ChromaDB que aceitam numpy recebem
+    o proprio array; versoes antigas recebem listas (float32 -> float
+    direto, sem array float64 intermediario).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    if _chroma_accepts_numpy():
+        return vectors
+    return vectors.tolist()
+
+
 def clear_collection(client):
     """
     Remove colecao existente do banco se existir.
@@ -47,4 +85,178 @@ def get_or_create_collection(client, clear=False):
         except:
             collection = client.create_collection(COLLECTION_NAME)
     
-    return collection
\ No newline at end of file
+    return collection
+
+
+class LazyCollection:
+    """
+    Proxy da colecao ChromaDB carregada no primeiro uso.
+
+    Metodos e atributos (count, query, get, ...) sao repassados a colecao
+    real, obtida por loader() uma unica vez no primeiro acesso. Com
+    preload, warm_up() tenta abrir a colecao em thread de fundo enquanto
+    o menu e exibido; preload retorna None quando a abertura exige
+    trabalho interativo (indexacao com log), que fica para o primeiro uso
+    em primeiro plano via loader.
+    """
+
+    def __init__(self, loader, preload=None):
+        self._loader = loader
+        self._preload = preload
+        self._collection = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """Inicia preload em thread de fundo (uma vez)."""
+        if self._preload is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._run_preload, name="warm-up", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run_preload(self):
+        try:
+            self._collection = self._preload()
+        except Exception:
+            # Carga em primeiro plano repete a abertura e mostra o erro
+            pass
+
+    @property
+    def loaded(self):
+        """Indica se a colecao ja foi aberta."""
+        return self._collection is not None
+
+    def load(self):
+        """Colecao real (aguarda warm-up em andamento; abre se necessario)."""
+        if self._collection is None:
+            if self._thread is not None:
+                self._thread.join()
+            with self._lock:
+                if self._collection is None:
+                    self._collection = self._loader()
+        return self._collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+# Valores de 'status' no estado do indice
+STATUS_IN_PROGRESS = 'em_andamento'
+STATUS_COMPLETE = 'completo'
+
+
+def is_index_complete(state=None):
+    """
+    Verifica se o indice pode ser usado para consultas.
+
+    Falso apenas quando ha indexacao em andamento ou interrompida; banco
+    legado sem estado e considerado completo.
+    """
+    state = load_index_state() if state is None else state
+    return state.get('status', STATUS_COMPLETE) == STATUS_COMPLETE
+
+
+def load_index_state():
+    """
+    Carrega estado da ultima indexacao gravado por save_index_state.
+
+    O estado registra a impressao digital das fontes indexadas (hash dos
+    arquivos, versao do arquivo de atributos, modelo de embedding) e o
+    tempo medio de vetorizacao por documento.
+
+    Retorna dicionario vazio se banco nunca foi indexado com estado
+    (banco legado) ou se arquivo estiver corrompido.
+    """
+    if not os.path.exists(INDEX_STATE_FILE):
+        return {}
+    try:
+        with open(INDEX_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Estado do indice invalido ({INDEX_STATE_FILE}): {e}")
+        return {}
+
+
+def save_index_state(state):
+    """
+    Grava estado da indexacao em INDEX_STATE_FILE (escrita atomica).
+    """
+    os.makedirs(os.path.dirname(INDEX_STATE_FILE) or '.', exist_ok=True)
+    tmp_path = INDEX_STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, INDEX_STATE_FILE)
+
+
+class BuildJournal:
+    """
+    Diario de lotes gravados durante uma indexacao.
+
+    Arquivo JSON lines em BUILD_JOURNAL_FILE: a primeira linha identifica
+    a indexacao (impressao digital das fontes, tamanho do lote) e cada
+    linha seguinte registra um lote ja gravado no banco:
+    {"fluxo": "NCM", "lote": 3, "documentos": 5000}
+
+    Cada registro e gravado com flush + fsync logo apos o commit do lote,
+    de modo que, apos queda ou Ctrl-C, a indexacao pode ser retomada a
+    partir do ultimo lote registrado (ver indexer.index_document_stream).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or BUILD_JOURNAL_FILE
+        self.header = {}
+        self.batches = {}
+
+    def start(self, header):
+        """Inicia diario novo, descartando registros anteriores."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.header = dict(header)
+        self.batches = {}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        """
+        Le diario existente. Retorna True se houver cabecalho valido.
+
+        Uma ultima linha incompleta (queda durante a escrita) e ignorada.
+        """
+        self.header = {}
+        self.batches = {}
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if i == 0:
+                    self.header = entry
+                else:
+                    self.batches[entry['fluxo']] = max(
+                        self.batches.get(entry['fluxo'], 0), entry['lote'] + 1
+                    )
+        return bool(self.header)
+
+    def committed(self, fluxo):
+        """Quantidade de lotes consecutivos ja gravados do fluxo."""
+        return self.batches.get(fluxo, 0)
+
+    def record(self, fluxo, lote, documentos):
+        """Registra lote gravado (chamado pela thread escritora)."""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'fluxo': fluxo, 'lote': lote, 'documentos': documentos}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.batches[fluxo] = lote + 1
+
+    def finish(self):
+        """Remove diario apos indexacao concluida."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
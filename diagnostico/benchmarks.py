@@ -0,0 +1,1068 @@
+#!/usr/bin/env python3
+# benchmarks.py
+# Micro-benchmarks de desempenho do pipeline RAG NCM
+
+"""
+BENCHMARKS DE DESEMPENHO
+
+Mede throughput e latencia de etapas isoladas do pipeline para
+acompanhar otimizacoes e detectar regressoes.
+
+Uso:
+    python diagnostico/benchmarks.py --normalizacao     # Normalizacao de texto (linhas/s)
+    python diagnostico/benchmarks.py --hierarquia       # Memoria/latencia da hierarquia NCM
+    python diagnostico/benchmarks.py --batching         # Lotes por comprimento em encode_batch
+    python diagnostico/benchmarks.py --backends         # torch x onnx x onnx-int8 (velocidade/recall)
+    python diagnostico/benchmarks.py --memoria          # Pico de RSS de uma indexacao completa
+    python diagnostico/benchmarks.py --cache            # Reindexacao com cache de embeddings frio x quente
+    python diagnostico/benchmarks.py --inicializacao    # Carga do modelo: Hub x snapshot local
+    python diagnostico/benchmarks.py --importacao       # Tempo de import por modulo (-X importtime)
+    python diagnostico/benchmarks.py --codecs           # Cache float32 x float16 x pq (bytes/recall)
+    python diagnostico/benchmarks.py --busca            # Latencia top-k: ChromaDB x NumPy exato
+    python diagnostico/benchmarks.py --lote             # Busca em lote x individual (1/32/1024 consultas)
+    python diagnostico/benchmarks.py --contexto         # Latencia da busca com atributos (N+1 x lote)
+    python diagnostico/benchmarks.py --atributos        # Atributos por NCM: indice em memoria x SQLite
+"""
+
+import argparse
+import random
+import re
+import subprocess
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def _timeit(func, repeat=3):
+    """Executa func repeat vezes e retorna (melhor tempo, ultimo resultado)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _deep_sizeof(obj, seen=None):
+    """Tamanho aproximado em bytes de obj incluindo dicts/listas aninhados."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_sizeof(v, seen) for v in obj)
+    return size
+
+
+def _legacy_normalize_text(text, keep_stopwords_if_short=True):
+    """Implementacao original de normalize_text_advanced (referencia)."""
+    if not text or not isinstance(text, str):
+        return ""
+
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ASCII', 'ignore').decode('ASCII')
+    text = text.lower()
+    text = re.sub(r'[^\w\s-]', ' ', text)
+    text = re.sub(r'\s+', ' ', text)
+
+    minimal_stopwords = {'de', 'da', 'do', 'dos', 'das', 'em', 'na', 'no', 'para', 'com', 'o', 'a'}
+    words = text.split()
+
+    if keep_stopwords_if_short and len(words) > 3:
+        words = [w for w in words if w not in minimal_stopwords or len(w) > 2]
+
+    return ' '.join(words).strip()
+
+
+def _load_enriched_lines():
+    """Gera linhas brutas (sem normalizacao) dos textos enriquecidos de NCM."""
+    from data_snapshot import load_parsed_data
+    from data_loader import create_enriched_ncm_text
+
+    ncm_df, hierarchy, atributos_dict = load_parsed_data()
+
+    lines = []
+    for _, row in ncm_df.iterrows():
+        text = create_enriched_ncm_text(row, hierarchy, atributos_dict, normalize=False)
+        if text:
+            lines.extend(text.split('\n'))
+    return lines
+
+
+def _load_ncm_corpus(sample=None, seed=0, keep_prefixes=()):
+    """
+    Codigos normalizados e textos enriquecidos de NCM como indexados
+    (normalizados conforme config).
+
+    Se sample for informado, retorna amostra aleatoria reprodutivel,
+    incluindo sempre os NCMs cujos 4 primeiros digitos estao em
+    keep_prefixes (ex.: capitulos esperados no ground truth).
+
+    Retorna tupla (codigos, documentos).
+    """
+    from data_snapshot import load_parsed_data
+    from data_loader import create_enriched_ncm_text, normalize_enriched_texts
+    from config import DISABLE_NORMALIZATION
+
+    ncm_df, hierarchy, atributos_dict = load_parsed_data()
+
+    corpus = []
+    for _, row in ncm_df.iterrows():
+        text = create_enriched_ncm_text(row, hierarchy, atributos_dict, normalize=False)
+        if text and text.strip():
+            corpus.append((row['CódigoNormalizado'], text))
+
+    if sample and sample < len(corpus):
+        keep_prefixes = set(keep_prefixes)
+        kept = [c for c in corpus if c[0][:4] in keep_prefixes]
+        rest = [c for c in corpus if c[0][:4] not in keep_prefixes]
+        corpus = kept + random.Random(seed).sample(rest, max(0, min(len(rest), sample - len(kept))))
+
+    codes = [code for code, _ in corpus]
+    documents = [text for _, text in corpus]
+    if not DISABLE_NORMALIZATION:
+        documents = normalize_enriched_texts(documents)
+    return codes, documents
+
+
+def _load_enriched_documents(sample=None, seed=0):
+    """Textos enriquecidos de NCM como indexados (ver _load_ncm_corpus)."""
+    return _load_ncm_corpus(sample, seed)[1]
+
+
+def _ground_truth_cases():
+    """Casos (consulta, prefixo NCM esperado) de diagnostico/ground_truth_cases."""
+    from diagnostico.ground_truth_cases import TEST_CASES
+    return [tuple(case) if not isinstance(case, dict)
+            else (case['query'], case['expected_ncm_prefix']) for case in TEST_CASES]
+
+
+# Script executado em subprocesso por benchmark_build_memory: indexacao
+# completa em banco temporario (config alterado antes dos imports)
+_BUILD_SCRIPT = r"""
+import os, resource, shutil, sys, tempfile
+root = sys.argv[1]
+legacy = sys.argv[2] == 'listas'
+cache_dir = sys.argv[3] if len(sys.argv) > 3 else ''
+sys.path.insert(0, root)
+os.chdir(root)
+
+import config
+tmp = tempfile.mkdtemp(prefix='benchmark_build_')
+config.DB_PATH = tmp
+config.INDEX_STATE_FILE = os.path.join(tmp, 'index_state.json')
+config.BUILD_JOURNAL_FILE = os.path.join(tmp, 'build_journal.jsonl')
+config.ATRIBUTOS_DB_FILE = os.path.join(tmp, 'atributos.sqlite3')
+config.VECTOR_INDEX_DIR = os.path.join(tmp, 'vetores_ncm')
+config.CLEAR_DB = True
+# Cache de embeddings apenas quando indicado (diretorio proprio do benchmark)
+config.USE_EMBEDDING_CACHE = bool(cache_dir)
+if cache_dir:
+    config.EMBEDDING_CACHE_DIR = cache_dir
+
+if legacy:
+    # Caminho anterior: vetores convertidos para listas de float Python
+    import indexer
+    _encode = indexer.encode_batch
+    indexer.encode_batch = lambda texts, **kw: _encode(texts, **kw).astype(float).tolist()
+
+try:
+    from setup import setup_database
+    setup_database()
+finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+print('MAXRSS_KB=%d' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _run_build_subprocess(mode, cache_dir=''):
+    """
+    Executa indexacao completa em subprocesso e retorna (pico RSS em MB, tempo).
+
+    Pico lido de resource.getrusage (ru_maxrss, KB no Linux) no proprio
+    subprocesso, isolando a medicao do processo do benchmark. cache_dir
+    vazio desativa o cache de embeddings.
+    """
+    root = str(Path(__file__).parent.parent)
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-c', _BUILD_SCRIPT, root, mode, cache_dir],
+        capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - t0
+
+    for line in proc.stdout.splitlines():
+        if line.startswith('MAXRSS_KB='):
+            return int(line.split('=')[1]) / 1024, elapsed
+
+    print(f"  Falha na indexacao ({mode}), codigo {proc.returncode}:")
+    print('\n'.join(proc.stderr.splitlines()[-15:]))
+    return None, elapsed
+
+
+def benchmark_build_memory(modes=('float32', 'listas')):
+    """
+    Mede pico de memoria (RSS) de uma indexacao completa.
+
+    Cada modo roda setup_database com CLEAR_DB=True em banco temporario,
+    em subprocesso proprio:
+    - float32: vetores em arrays float32 ate a gravacao (atual)
+    - listas: vetores convertidos para listas de float Python (anterior)
+
+    Banco configurado em DB_PATH nao e alterado.
+    """
+    print("\n" + "="*70)
+    print("BENCHMARK: PICO DE MEMORIA NA INDEXACAO COMPLETA")
+    print("="*70)
+
+    results = {}
+    for mode in modes:
+        print(f"\nIndexando ({mode})...")
+        peak_mb, elapsed = _run_build_subprocess(mode)
+        results[mode] = {'pico_rss_mb': peak_mb, 'tempo_s': elapsed}
+
+    print(f"\n{'Vetores':<12}{'Pico RSS (MB)':>16}{'Tempo (s)':>12}")
+    for mode, r in results.items():
+        peak = f"{r['pico_rss_mb']:.0f}" if r['pico_rss_mb'] is not None else 'falhou'
+        print(f"{mode:<12}{peak:>16}{r['tempo_s']:>12.1f}")
+
+    return results
+
+
+# Script executado em subprocesso por benchmark_model_startup: processo
+# novo que importa e carrega o modelo (config alterado antes dos imports)
+_STARTUP_SCRIPT = r"""
+import os, sys, time
+t0 = time.perf_counter()
+root = sys.argv[1]
+sys.path.insert(0, root)
+os.chdir(root)
+
+import config
+config.EMBEDDING_PINNED_SNAPSHOT = sys.argv[2] == 'snapshot'
+
+from embedding_backends import load_embedder
+t1 = time.perf_counter()
+model = load_embedder()
+t2 = time.perf_counter()
+model.encode('aquecimento')
+t3 = time.perf_counter()
+print('TEMPOS=%f,%f,%f' % (t1 - t0, t2 - t1, t3 - t2))
+"""
+
+
+def _run_startup_subprocess(mode):
+    """Carrega o modelo em processo novo; retorna (imports, carga, 1a consulta) em s."""
+    root = str(Path(__file__).parent.parent)
+    proc = subprocess.run(
+        [sys.executable, '-c', _STARTUP_SCRIPT, root, mode],
+        capture_output=True, text=True
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith('TEMPOS='):
+            return tuple(float(v) for v in line.split('=')[1].split(','))
+
+    print(f"  Falha ao carregar modelo ({mode}), codigo {proc.returncode}:")
+    print('\n'.join(proc.stderr.splitlines()[-15:]))
+    return None
+
+
+def benchmark_model_startup(repeat=3, modes=('hub', 'snapshot')):
+    """
+    Mede inicio a frio do modelo de embedding em processos novos.
+
+    - hub: SentenceTransformer(EMBEDDING_MODEL) resolvido pelo cache do
+      Hugging Face (comportamento anterior)
+    - snapshot: snapshot local fixado em safetensors, modo offline
+      (exportado antes da medicao se ainda nao existir)
+
+    Cada medicao separa imports, carga do modelo e primeira consulta;
+    reporta a mediana das repeticoes.
+    """
+    import statistics
+    from embedding_backends import export_snapshot, snapshot_dir
+
+    print("\n" + "="*70)
+    print("BENCHMARK: INICIALIZACAO DO MODELO DE EMBEDDING")
+    print("="*70)
+
+    if 'snapshot' in modes:
+        export_snapshot()
+        print(f"\nSnapshot: {snapshot_dir()}")
+
+    results = {}
+    for mode in modes:
+        runs = []
+        for _ in range(repeat):
+            timings = _run_startup_subprocess(mode)
+            if timings is not None:
+                runs.append(timings)
+        if runs:
+            results[mode] = {
+                'imports_s': statistics.median(r[0] for r in runs),
+                'carga_s': statistics.median(r[1] for r in runs),
+                'primeira_consulta_s': statistics.median(r[2] for r in runs),
+            }
+
+    print(f"\n{'Origem':<12}{'Imports(s)':>12}{'Carga(s)':>10}{'1a consulta(s)':>16}{'Total(s)':>10}")
+    for mode, r in results.items():
+        total = r['imports_s'] + r['carga_s'] + r['primeira_consulta_s']
+        print(f"{mode:<12}{r['imports_s']:>12.2f}{r['carga_s']:>10.2f}"
+              f"{r['primeira_consulta_s']:>16.2f}{total:>10.2f}")
+
+    if 'hub' in results and 'snapshot' in results:
+        print(f"\nCarga com snapshot: {results['snapshot']['carga_s']/results['hub']['carga_s']:.0%} "
+              f"do tempo pelo Hub")
+
+    return results
+
+
+def _import_times(module):
+    """
+    Importa module em processo novo com -X importtime.
+
+    Retorna (tempo total em s, dict pacote de topo -> tempo proprio em s).
+    """
+    root = str(Path(__file__).parent.parent)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=root
+    )
+    if proc.returncode != 0:
+        print(f"  Falha ao importar {module}:")
+        print('\n'.join(proc.stderr.splitlines()[-5:]))
+        return None, {}
+
+    total = 0
+    packages = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Modulos de nivel superior (sem recuo) somam o tempo total
+        if not name[1:].startswith(' '):
+            total += int(cumulative_us)
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1e6
+    return total / 1e6, packages
+
+
+def benchmark_import_time(modules=('main', 'menu', 'setup', 'search', 'indexer'), top=8):
+    """
+    Relatorio de tempo de importacao por modulo de entrada.
+
+    Cada modulo e importado em processo novo com python -X importtime;
+    mostra tempo total e os pacotes com maior tempo proprio (soma dos
+    submodulos). Modulos de entrada nao devem importar chromadb,
+    sentence_transformers/torch ou pandas no import (carga sob demanda).
+    """
+    print("\n" + "="*70)
+    print("BENCHMARK: TEMPO DE IMPORTACAO")
+    print("="*70)
+
+    heavy = ('chromadb', 'torch', 'sentence_transformers', 'transformers', 'pandas', 'gradio')
+    results = {}
+    for module in modules:
+        total, packages = _import_times(module)
+        if total is None:
+            continue
+        results[module] = {'total_s': total, 'pacotes': packages}
+
+        loaded = [p for p in heavy if p in packages]
+        print(f"\nimport {module}: {1000*total:.0f} ms"
+              f" | pesados: {', '.join(loaded) if loaded else 'nenhum'}")
+        ranking = sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        for package, seconds in ranking:
+            print(f"  {package:<30}{1000*seconds:>10.1f} ms")
+
+    return results
+
+
+def benchmark_build_cache():
+    """
+    Compara tempo de reindexacao completa com cache de embeddings frio e
+    quente.
+
+    Duas indexacoes completas (CLEAR_DB=True, banco temporario) em
+    subprocessos, compartilhando um diretorio de cache temporario: a
+    primeira vetoriza tudo e preenche o cache; a segunda simula
+    reindexacao apos ajuste de configuracao que nao muda o texto dos
+    documentos. Cache e banco configurados nao sao alterados.
+    """
+    import shutil
+    import tempfile
+
+    print("\n" + "="*70)
+    print("BENCHMARK: REINDEXACAO COM CACHE DE EMBEDDINGS")
+    print("="*70)
+
+    cache_dir = tempfile.mkdtemp(prefix='benchmark_cache_')
+    results = {}
+    try:
+        for label in ('frio', 'quente'):
+            print(f"\nIndexando (cache {label})...")
+            peak_mb, elapsed = _run_build_subprocess('float32', cache_dir)
+            results[label] = {'tempo_s': elapsed, 'pico_rss_mb': peak_mb}
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"\n{'Cache':<10}{'Tempo (s)':>12}{'Pico RSS (MB)':>16}")
+    for label, r in results.items():
+        peak = f"{r['pico_rss_mb']:.0f}" if r['pico_rss_mb'] is not None else 'falhou'
+        print(f"{label:<10}{r['tempo_s']:>12.1f}{peak:>16}")
+    if results.get('quente', {}).get('tempo_s'):
+        print(f"\nAceleracao: {results['frio']['tempo_s'] / results['quente']['tempo_s']:.1f}x")
+
+    return results
+
+
+def benchmark_text_normalization(repeat=3):
+    """
+    Compara normalizacao original (por linha) com TextNormalizer.
+
+    Usa as linhas reais dos textos enriquecidos de NCM (descricoes,
+    titulos de capitulo/posicao, nivel, atributos) e mede:
+    - original: NFKD + encode + re.sub nao compilado por linha
+    - normalizer frio: TextNormalizer novo (LRU vazio) via normalize_many
+    - normalizer quente: mesma instancia com LRU ja populado
+
+    Verifica tambem que os resultados sao identicos.
+    """
+    from data_loader import TextNormalizer
+
+    print("\n" + "="*70)
+    print("BENCHMARK: NORMALIZACAO DE TEXTO")
+    print("="*70)
+
+    lines = _load_enriched_lines()
+    unique = len(set(lines))
+    print(f"\nLinhas: {len(lines)} ({unique} distintas, {100*(1-unique/len(lines)):.1f}% repetidas)")
+
+    t_legacy, expected = _timeit(lambda: [_legacy_normalize_text(l) for l in lines], repeat)
+    t_cold, got_cold = _timeit(lambda: TextNormalizer().normalize_many(lines), repeat)
+
+    normalizer = TextNormalizer()
+    normalizer.normalize_many(lines)
+    t_warm, got_warm = _timeit(lambda: normalizer.normalize_many(lines), repeat)
+
+    identical = expected == got_cold == got_warm
+
+    print(f"\n{'Metodo':<28}{'Tempo (s)':>12}{'Linhas/s':>14}{'Ganho':>10}")
+    for name, elapsed in [("original (por linha)", t_legacy),
+                          ("TextNormalizer (frio)", t_cold),
+                          ("TextNormalizer (quente)", t_warm)]:
+        rate = len(lines) / elapsed if elapsed else float('inf')
+        print(f"{name:<28}{elapsed:>12.4f}{rate:>14,.0f}{t_legacy/elapsed:>9.1f}x")
+
+    print(f"\nResultados identicos: {'sim' if identical else 'NAO'}")
+    print(f"LRU: {normalizer.cache_info()}")
+
+    return {
+        "linhas": len(lines),
+        "original_s": t_legacy,
+        "frio_s": t_cold,
+        "quente_s": t_warm,
+        "identicos": identical
+    }
+
+
+def benchmark_hierarchy(repeat=3):
+    """
+    Compara hierarquia em dicionarios (build_ncm_hierarchy) com NcmHierarchy.
+
+    Mede memoria ocupada, tempo de construcao e latencia media de get()
+    por codigo, e confere que as entradas retornadas sao iguais.
+    """
+    from data_loader import load_ncm_data, build_ncm_hierarchy, build_ncm_hierarchy_compact
+
+    print("\n" + "="*70)
+    print("BENCHMARK: HIERARQUIA NCM")
+    print("="*70)
+
+    ncm_df = load_ncm_data()
+
+    t_dict, hierarchy = _timeit(lambda: build_ncm_hierarchy(ncm_df), repeat)
+    t_compact, compact = _timeit(lambda: build_ncm_hierarchy_compact(ncm_df), repeat)
+
+    codes = list(hierarchy)
+    t_get_dict, _ = _timeit(lambda: [hierarchy.get(c) for c in codes], repeat)
+    t_get_compact, _ = _timeit(lambda: [compact.get(c) for c in codes], repeat)
+
+    mem_dict = _deep_sizeof(hierarchy)
+    mem_compact = compact.memory_usage()
+    identical = all(hierarchy[c] == compact.get(c) for c in codes)
+
+    print(f"\nCodigos: {len(codes)}")
+    print(f"\n{'Estrutura':<20}{'Memoria (MB)':>14}{'Construcao (s)':>16}{'get (us)':>10}")
+    print(f"{'dict de dicts':<20}{mem_dict/1024**2:>14.2f}{t_dict:>16.4f}"
+          f"{t_get_dict/len(codes)*1e6:>10.2f}")
+    print(f"{'NcmHierarchy':<20}{mem_compact/1024**2:>14.2f}{t_compact:>16.4f}"
+          f"{t_get_compact/len(codes)*1e6:>10.2f}")
+    print(f"\nReducao de memoria: {mem_dict/mem_compact:.1f}x")
+    print(f"Entradas identicas: {'sim' if identical else 'NAO'}")
+
+    return {
+        "memoria_dict": mem_dict,
+        "memoria_compacta": mem_compact,
+        "identicas": identical
+    }
+
+
+def benchmark_embedding_batching(repeat=1, sample=2000):
+    """
+    Compara lotes fixos em ordem de chegada com lotes por comprimento.
+
+    - fixo: fatias de 32 textos na ordem original (encode_batch anterior)
+    - por comprimento: encode_batch atual (plan_batches com
+      EMBEDDING_TOKEN_BUDGET / EMBEDDING_MAX_BATCH)
+
+    Reporta documentos/s, razao de padding (tokens processados / tokens
+    reais) e confere que os vetores voltam na ordem original.
+    """
+    import numpy as np
+    from embeddings import get_embedder, encode_batch, token_lengths, plan_batches, padding_ratio
+
+    print("\n" + "="*70)
+    print("BENCHMARK: LOTES DE VETORIZACAO")
+    print("="*70)
+
+    documents = _load_enriched_documents(sample)
+    embedder = get_embedder()
+    lengths = token_lengths(documents)
+    print(f"\nDocumentos: {len(documents)} (tokens: media {lengths.mean():.0f}, "
+          f"min {lengths.min()}, max {lengths.max()})")
+
+    fixed_batches = [np.arange(i, min(i + 32, len(documents))) for i in range(0, len(documents), 32)]
+    bucketed_batches = plan_batches(lengths)
+
+    def encode_fixed():
+        return np.vstack([
+            embedder.encode([documents[i] for i in idx], batch_size=len(idx), show_progress_bar=False)
+            for idx in fixed_batches
+        ])
+
+    encode_fixed()  # aquecimento
+    t_fixed, expected = _timeit(encode_fixed, repeat)
+    t_bucketed, got = _timeit(lambda: np.asarray(encode_batch(documents, show_progress=False)), repeat)
+
+    max_diff = float(np.abs(expected - got).max())
+
+    print(f"\n{'Metodo':<22}{'Lotes':>8}{'Padding':>10}{'Tempo (s)':>12}{'Docs/s':>10}{'Ganho':>8}")
+    for name, batches, elapsed in [("fixo (32, chegada)", fixed_batches, t_fixed),
+                                   ("por comprimento", bucketed_batches, t_bucketed)]:
+        print(f"{name:<22}{len(batches):>8}{padding_ratio(lengths, batches):>9.2f}x"
+              f"{elapsed:>12.2f}{len(documents)/elapsed:>10.1f}{t_fixed/elapsed:>7.2f}x")
+
+    print(f"\nOrdem preservada (dif. maxima entre vetores): {max_diff:.2e}")
+
+    return {
+        "documentos": len(documents),
+        "fixo_s": t_fixed,
+        "comprimento_s": t_bucketed,
+        "padding_fixo": padding_ratio(lengths, fixed_batches),
+        "padding_comprimento": padding_ratio(lengths, bucketed_batches),
+        "dif_maxima": max_diff
+    }
+
+
+def benchmark_embedding_backends(sample=2000, backends=None):
+    """
+    Compara backends de embedding (embedding_backends) em velocidade e qualidade.
+
+    Para cada backend (torch FP32 como referencia, onnx, onnx-int8):
+    - indexacao: documentos/s vetorizando o corpus amostrado
+    - consulta: latencia media e p95 de uma consulta isolada
+    - recall: acerto top-1/top-5 do ground truth por prefixo NCM (busca
+      exata por cosseno no corpus amostrado, que inclui os capitulos esperados)
+    - concordancia com FP32: sobreposicao dos top-10 e cosseno medio
+      entre vetores do mesmo documento
+    """
+    import numpy as np
+    from embedding_backends import BACKENDS, load_embedder, backend_id
+
+    print("\n" + "="*70)
+    print("BENCHMARK: BACKENDS DE EMBEDDING")
+    print("="*70)
+
+    cases = _ground_truth_cases()
+    queries = [q for q, _ in cases]
+    codes, documents = _load_ncm_corpus(sample, keep_prefixes=[p for _, p in cases])
+    prefixes = np.array([c[:4].replace('.', '') for c in codes])
+    print(f"\nCorpus: {len(documents)} documentos | Consultas: {len(queries)}")
+
+    backends = backends or BACKENDS
+    results = {}
+    reference = None
+
+    for backend in backends:
+        print(f"\n[{backend_id(backend)}] carregando...")
+        t0 = time.perf_counter()
+        model = load_embedder(backend)
+        load_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        doc_vecs = model.encode(documents, batch_size=64, normalize_embeddings=True,
+                                show_progress_bar=False)
+        index_s = time.perf_counter() - t0
+
+        model.encode(queries[:5], normalize_embeddings=True)  # aquecimento
+        latencies = []
+        query_vecs = []
+        for q in queries:
+            t0 = time.perf_counter()
+            query_vecs.append(model.encode(q, normalize_embeddings=True))
+            latencies.append(time.perf_counter() - t0)
+        query_vecs = np.vstack(query_vecs)
+
+        top10 = np.argsort(-(query_vecs @ doc_vecs.T), axis=1)[:, :10]
+        expected = np.array([p for _, p in cases])
+        top1 = float(np.mean(prefixes[top10[:, 0]] == expected))
+        top5 = float(np.mean([(prefixes[row[:5]] == exp).any() for row, exp in zip(top10, expected)]))
+
+        entry = {
+            'carga_s': load_s,
+            'docs_s': len(documents) / index_s,
+            'consulta_ms': 1000 * float(np.mean(latencies)),
+            'consulta_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+            'top1': top1,
+            'top5': top5,
+        }
+        if reference is None:
+            reference = (doc_vecs, top10)
+        else:
+            ref_docs, ref_top10 = reference
+            entry['sobreposicao_top10'] = float(np.mean([
+                len(set(a) & set(b)) / 10 for a, b in zip(top10, ref_top10)
+            ]))
+            entry['cosseno_docs'] = float(np.mean(np.sum(doc_vecs * ref_docs, axis=1)))
+        results[backend_id(backend)] = entry
+        del model
+
+    print(f"\n{'Backend':<20}{'Carga(s)':>9}{'Docs/s':>9}{'Consulta(ms)':>14}{'p95':>8}"
+          f"{'Top1':>7}{'Top5':>7}{'Top10=FP32':>12}{'Cos':>7}")
+    for name, r in results.items():
+        overlap = f"{100*r['sobreposicao_top10']:.0f}%" if 'sobreposicao_top10' in r else 'ref'
+        cos = f"{r['cosseno_docs']:.4f}" if 'cosseno_docs' in r else 'ref'
+        print(f"{name:<20}{r['carga_s']:>9.1f}{r['docs_s']:>9.1f}{r['consulta_ms']:>14.1f}"
+              f"{r['consulta_p95_ms']:>8.1f}{100*r['top1']:>6.0f}%{100*r['top5']:>6.0f}%"
+              f"{overlap:>12}{cos:>7}")
+
+    return results
+
+
+def benchmark_cache_codecs(sample=2000, subvectors=None):
+    """
+    Compara formatos de armazenamento do cache de embeddings (embedding_codecs).
+
+    Vetoriza o corpus amostrado e as consultas do ground truth com o
+    modelo atual; para float32 (referencia), float16 e pq (codebook
+    treinado no proprio corpus), reconstroi os vetores dos documentos e mede:
+    - bytes por vetor em disco
+    - erro relativo medio de reconstrucao e cosseno com o original
+    - recall top-1/top-5 por prefixo NCM e sobreposicao dos top-10 com float32
+      (consultas exatas contra documentos reconstruidos)
+    """
+    import numpy as np
+    from embeddings import encode_array_local
+    from embedding_codecs import CODECS, train_pq, encode_vectors, decode_vectors, bytes_per_vector
+
+    print("\n" + "="*70)
+    print("BENCHMARK: FORMATOS DO CACHE DE EMBEDDINGS")
+    print("="*70)
+
+    cases = _ground_truth_cases()
+    queries = [q for q, _ in cases]
+    codes, documents = _load_ncm_corpus(sample, keep_prefixes=[p for _, p in cases])
+    prefixes = np.array([c[:4].replace('.', '') for c in codes])
+    expected = np.array([p for _, p in cases])
+    print(f"\nCorpus: {len(documents)} documentos | Consultas: {len(queries)}")
+
+    doc_vecs = encode_array_local(documents)
+    query_vecs = encode_array_local(queries, show_progress=False)
+    query_vecs /= np.linalg.norm(query_vecs, axis=1, keepdims=True)
+    dim = doc_vecs.shape[1]
+
+    t0 = time.perf_counter()
+    codebook = train_pq(doc_vecs, subvectors)
+    print(f"Codebook PQ: {codebook.shape[0]} subvetores ({time.perf_counter()-t0:.1f}s)")
+
+    results = {}
+    reference = None
+    for codec in CODECS:
+        t0 = time.perf_counter()
+        decoded = decode_vectors(encode_vectors(doc_vecs, codec, codebook), codec, codebook)
+        codec_s = time.perf_counter() - t0
+
+        norms = np.linalg.norm(doc_vecs, axis=1)
+        error = np.linalg.norm(doc_vecs - decoded, axis=1) / norms
+        cosine = np.sum(doc_vecs * decoded, axis=1) / (norms * np.linalg.norm(decoded, axis=1))
+
+        unit = decoded / np.linalg.norm(decoded, axis=1, keepdims=True)
+        top10 = np.argsort(-(query_vecs @ unit.T), axis=1)[:, :10]
+        if reference is None:
+            reference = top10
+
+        results[codec] = {
+            'bytes_vetor': bytes_per_vector(dim, codec, codebook),
+            'codec_s': codec_s,
+            'erro_relativo': float(error.mean()),
+            'cosseno': float(cosine.mean()),
+            'top1': float(np.mean(prefixes[top10[:, 0]] == expected)),
+            'top5': float(np.mean([(prefixes[row[:5]] == exp).any() for row, exp in zip(top10, expected)])),
+            'sobreposicao_top10': float(np.mean([
+                len(set(a) & set(b)) / 10 for a, b in zip(top10, reference)
+            ])),
+        }
+
+    print(f"\n{'Formato':<10}{'Bytes':>7}{'Reducao':>9}{'Codif.(s)':>11}{'Erro rel.':>11}"
+          f"{'Cos':>8}{'Top1':>7}{'Top5':>7}{'Top10=f32':>11}")
+    full = results['float32']['bytes_vetor']
+    for codec, r in results.items():
+        print(f"{codec:<10}{r['bytes_vetor']:>7}{full / r['bytes_vetor']:>8.0f}x{r['codec_s']:>11.2f}"
+              f"{r['erro_relativo']:>11.4f}{r['cosseno']:>8.4f}{100*r['top1']:>6.0f}%"
+              f"{100*r['top5']:>6.0f}%{100*r['sobreposicao_top10']:>10.0f}%")
+
+    return results
+
+
+def benchmark_search_engines(k=30, repeat=3):
+    """
+    Compara motores de busca NCM (SEARCH_ENGINE) no banco indexado.
+
+    Para as consultas do ground truth (vetorizadas uma vez), mede a
+    latencia de top-k no ChromaDB (HNSW com filtro tipo='ncm') e no
+    indice exato em memoria (vector_index), alem de:
+    - recall top-1/top-5 por prefixo NCM em cada motor
+    - sobreposicao dos top-k do HNSW com o resultado exato
+    Requer banco ja indexado; exporta os vetores se ainda nao exportados.
+    """
+    import numpy as np
+    from embeddings import encode_text
+    from database import to_chroma_embeddings
+    from search import prepare_query
+    from setup import open_collection, export_vector_index
+    from vector_index import get_vector_index
+
+    print("\n" + "="*70)
+    print("BENCHMARK: MOTORES DE BUSCA (ChromaDB x NumPy exato)")
+    print("="*70)
+
+    collection = open_collection()
+    index = get_vector_index()
+    if index is None:
+        export_vector_index(collection)
+        index = get_vector_index()
+    print(f"\nVetores NCM: {len(index)} x {index.dimension} | Colecao: {collection.count()} documentos")
+
+    cases = _ground_truth_cases()
+    expected = [p for _, p in cases]
+    vectors = [encode_text(prepare_query(q)) for q, _ in cases]
+    where = {'tipo': 'ncm'}
+
+    engines = {
+        'chroma': lambda v: collection.query(query_embeddings=to_chroma_embeddings(v), n_results=k, where=where),
+        'numpy': lambda v: index.query(v, k=k, filters=where),
+    }
+
+    results = {}
+    ranked_ids = {}
+    for name, query in engines.items():
+        query(vectors[0])  # aquecimento
+        latencies, ids, top1, top5 = [], [], [], []
+        for v, exp in zip(vectors, expected):
+            best = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                res = query(v)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            latencies.append(best)
+            ids.append(res['ids'][0])
+            prefixes = [(m.get('codigo_normalizado') or m.get('codigo') or '')[:4].replace('.', '')
+                        for m in res['metadatas'][0]]
+            top1.append(prefixes[:1] == [exp])
+            top5.append(exp in prefixes[:5])
+        ranked_ids[name] = ids
+        results[name] = {
+            'consulta_ms': 1000 * float(np.mean(latencies)),
+            'consulta_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+            'top1': float(np.mean(top1)),
+            'top5': float(np.mean(top5)),
+        }
+
+    for name, r in results.items():
+        r['sobreposicao'] = float(np.mean([
+            len(set(a) & set(b)) / max(len(b), 1) for a, b in zip(ranked_ids[name], ranked_ids['numpy'])
+        ]))
+
+    print(f"\n{'Motor':<10}{'Consulta(ms)':>14}{'p95':>8}{'Top1':>7}{'Top5':>7}{f'Top{k}=exato':>13}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['consulta_ms']:>14.2f}{r['consulta_p95_ms']:>8.2f}{100*r['top1']:>6.0f}%"
+              f"{100*r['top5']:>6.0f}%{100*r['sobreposicao']:>12.0f}%")
+    speedup = results['chroma']['consulta_ms'] / results['numpy']['consulta_ms']
+    print(f"\nNumPy {speedup:.1f}x mais rapido que ChromaDB (media)")
+
+    return results
+
+
+def _equivalent_ranking(single, batch, distance_tol):
+    """
+    Compara duas listas de (codigo, distancia) posicao a posicao: mesmo
+    tamanho, distancias a no maximo distance_tol e mesmo codigo, exceto
+    quando os dois codigos tem distancias empatadas (diferenca ate
+    distance_tol) em ambas as listas, caso em que a ordem entre eles
+    depende do arredondamento.
+    """
+    if len(single) != len(batch):
+        return False
+    single_dist = dict(single)
+    batch_dist = dict(batch)
+    for (code_a, dist_a), (code_b, dist_b) in zip(single, batch):
+        if abs(dist_a - dist_b) > distance_tol:
+            return False
+        if code_a == code_b:
+            continue
+        if code_b not in single_dist or code_a not in batch_dist:
+            return False
+        if abs(single_dist[code_b] - dist_a) > distance_tol or abs(batch_dist[code_a] - dist_b) > distance_tol:
+            return False
+    return True
+
+
+def benchmark_batch_search(sizes=(1, 32, 1024), k=10, seed=0, distance_tol=1e-4):
+    """
+    Throughput de busca hierarquica: uma consulta por vez
+    (find_ncm_hierarchical em laco) x lote (find_ncm_hierarchical_batch,
+    uma vetorizacao e uma consulta multi-vetor).
+
+    Consultas sao descricoes NCM distintas (amostra aleatoria), com o
+    cache de embeddings desativado para medir a vetorizacao. Tambem
+    compara os resultados do lote com os da versao individual: os
+    vetores de consulta do lote nao sao bit a bit iguais aos individuais
+    (arredondamento float32 do modelo e do produto de matrizes), entao
+    as distancias coincidem apenas dentro de distance_tol. Uma lista e
+    equivalente se, em cada posicao, a distancia difere no maximo
+    distance_tol e o codigo e o mesmo (ou a troca e entre empatados,
+    ver _equivalent_ranking). Requer banco ja indexado.
+    """
+    import numpy as np
+    from data_snapshot import load_parsed_data
+    from embeddings import get_embedder, embedding_cache_disabled
+    from setup import open_collection
+    from search import find_ncm_hierarchical, find_ncm_hierarchical_batch
+
+    print("\n" + "="*70)
+    print("BENCHMARK: BUSCA EM LOTE")
+    print("="*70)
+
+    collection = open_collection()
+    get_embedder()
+    ncm_df, _, _ = load_parsed_data()
+    descriptions = sorted({d for d in ncm_df['Descrição'].tolist() if d and len(d) > 10})
+    queries = random.Random(seed).sample(descriptions, min(len(descriptions), max(sizes)))
+
+    find_ncm_hierarchical_batch(collection, queries[:4], k=k)  # aquecimento
+
+    def ranking(hits):
+        return [(r.get('codigo_normalizado'), r.get('distance', 0.0)) for r in hits]
+
+    results = {}
+    print(f"\n{'Consultas':>10}{'Individual(s)':>15}{'Lote(s)':>10}{'Consultas/s':>13}"
+          f"{'Lote/s':>10}{'Ganho':>8}{'Mesmos ids':>12}{'Equiv.':>8}{'Max |d|':>10}")
+    with embedding_cache_disabled():
+        for size in sizes:
+            batch_queries = queries[:size]
+
+            t0 = time.perf_counter()
+            single = [ranking(find_ncm_hierarchical(collection, q, k=k)) for q in batch_queries]
+            single_s = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            batch = [ranking(hits) for hits in find_ncm_hierarchical_batch(collection, batch_queries, k=k)]
+            batch_s = time.perf_counter() - t0
+
+            same_ids = float(np.mean([[c for c, _ in a] == [c for c, _ in b] for a, b in zip(single, batch)]))
+            equivalent = float(np.mean([_equivalent_ranking(a, b, distance_tol) for a, b in zip(single, batch)]))
+            max_diff = max((abs(da - db) for a, b in zip(single, batch) for (_, da), (_, db) in zip(a, b)),
+                           default=0.0)
+            results[size] = {
+                'individual_s': single_s,
+                'lote_s': batch_s,
+                'consultas_s': size / single_s,
+                'lote_consultas_s': size / batch_s,
+                'mesmos_ids': same_ids,
+                'equivalentes': equivalent,
+                'max_diferenca_distancia': max_diff,
+            }
+            print(f"{size:>10}{single_s:>15.2f}{batch_s:>10.2f}{size / single_s:>13.1f}"
+                  f"{size / batch_s:>10.1f}{single_s / batch_s:>7.1f}x{100*same_ids:>11.0f}%"
+                  f"{100*equivalent:>7.0f}%{max_diff:>10.1e}")
+
+    print(f"\nEquivalente: distancias a no maximo {distance_tol:g} em cada posicao; "
+          f"codigos trocados apenas entre empatados")
+    return results
+
+
+def benchmark_context_retrieval(k=8, repeat=3):
+    """
+    Decomposicao da latencia de find_ncm_hierarchical_with_context
+    (caminho usado pelo CLI e pelo Gradio antes da chamada ao LLM).
+
+    Para cada consulta do ground truth (embedding ja em cache), mede:
+    - busca: find_ncm_hierarchical (vetorizacao + top-k)
+    - atributos individuais: find_atributos_by_ncm por NCM (anterior)
+    - atributos em lote: find_atributos_by_ncm_many (uma consulta)
+    Requer banco ja indexado.
+    """
+    import numpy as np
+    from setup import open_collection
+    from search import find_ncm_hierarchical, find_atributos_by_ncm, find_atributos_by_ncm_many
+
+    print("\n" + "="*70)
+    print("BENCHMARK: LATENCIA DA BUSCA COM CONTEXTO")
+    print("="*70)
+
+    collection = open_collection()
+    queries = [q for q, _ in _ground_truth_cases()]
+    for q in queries:
+        find_ncm_hierarchical(collection, q, k=k)  # aquecimento (modelo e cache)
+
+    stages = {'busca': [], 'atributos_individual': [], 'atributos_lote': []}
+    mismatches = 0
+    for q in queries:
+        elapsed, ncm_results = _timeit(lambda: find_ncm_hierarchical(collection, q, k=k, prefer_items=True), repeat)
+        stages['busca'].append(elapsed)
+
+        codes = [ncm.get('codigo_normalizado') or ncm.get('codigo') for ncm in ncm_results]
+        elapsed, single = _timeit(lambda: [find_atributos_by_ncm(collection, c, k=10) for c in codes], repeat)
+        stages['atributos_individual'].append(elapsed)
+        elapsed, batch = _timeit(lambda: find_atributos_by_ncm_many(collection, codes, k=10), repeat)
+        stages['atributos_lote'].append(elapsed)
+        mismatches += sum(a != batch[c] for a, c in zip(single, codes))
+
+    print(f"\nConsultas: {len(queries)} | NCMs por consulta: {k}")
+    print(f"\n{'Etapa':<24}{'Media(ms)':>11}{'p95(ms)':>10}")
+    for name, values in stages.items():
+        print(f"{name:<24}{1000*np.mean(values):>11.2f}{1000*np.percentile(values, 95):>10.2f}")
+
+    before = np.mean(stages['busca']) + np.mean(stages['atributos_individual'])
+    after = np.mean(stages['busca']) + np.mean(stages['atributos_lote'])
+    print(f"\nTotal antes: {1000*before:.2f} ms | depois: {1000*after:.2f} ms "
+          f"({before / after:.1f}x)")
+    print(f"Listas de atributos diferentes entre individual e lote: {mismatches}")
+
+    return {name: 1000 * float(np.mean(values)) for name, values in stages.items()}
+
+
+def benchmark_atributos_lookup(sample=1000, k=20, repeat=3, seed=0):
+    """
+    Latencia de busca de atributos por NCM: indice residente em memoria
+    (atributos_index) x tabela local SQLite (atributos_table).
+
+    Mede carga e memoria do indice e o tempo medio por consulta (us)
+    sobre uma amostra de codigos NCM com atributos; confere se as duas
+    fontes retornam as mesmas listas.
+    """
+    import numpy as np
+    from atributos_index import load_atributos_index
+    from atributos_table import atributos_table_exists, find_atributos
+
+    print("\n" + "="*70)
+    print("BENCHMARK: BUSCA DE ATRIBUTOS POR NCM")
+    print("="*70)
+
+    index = load_atributos_index()
+    stats = index.stats()
+    print(f"\nIndice: {stats['ncms']} NCMs, {stats['atributos']} atributos, "
+          f"{stats['memoria_mb']:.1f} MB, carga {stats['carga_s']:.2f}s ({stats['origem']})")
+
+    codes = list(index.store)
+    codes = random.Random(seed).sample(codes, min(sample, len(codes)))
+
+    lookups = {'memoria': lambda c: index.find(c, limit=k)}
+    if atributos_table_exists():
+        lookups['sqlite'] = lambda c: find_atributos(c, limit=k)
+
+    results = {}
+    answers = {}
+    for name, lookup in lookups.items():
+        elapsed, answers[name] = _timeit(lambda: [lookup(c) for c in codes], repeat)
+        results[name] = 1e6 * elapsed / len(codes)
+
+    print(f"\n{'Fonte':<10}{'us/consulta':>13}")
+    for name, us in results.items():
+        print(f"{name:<10}{us:>13.1f}")
+    if 'sqlite' in answers:
+        same = float(np.mean([a == b for a, b in zip(answers['memoria'], answers['sqlite'])]))
+        print(f"\nMemoria {results['sqlite'] / results['memoria']:.1f}x mais rapido | "
+              f"listas iguais: {100*same:.0f}%")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks de desempenho do pipeline RAG NCM",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument('--normalizacao', action='store_true', help='Normalizacao de texto')
+    parser.add_argument('--hierarquia', action='store_true', help='Hierarquia NCM compacta')
+    parser.add_argument('--batching', action='store_true', help='Lotes por comprimento na vetorizacao')
+    parser.add_argument('--backends', action='store_true', help='Backends de embedding (torch/onnx/onnx-int8)')
+    parser.add_argument('--memoria', action='store_true', help='Pico de RSS da indexacao completa (subprocesso)')
+    parser.add_argument('--cache', action='store_true', help='Reindexacao completa com cache frio x quente (subprocesso)')
+    parser.add_argument('--inicializacao', action='store_true', help='Inicio a frio do modelo: Hub x snapshot local')
+    parser.add_argument('--importacao', action='store_true', help='Tempo de import dos modulos de entrada')
+    parser.add_argument('--codecs', action='store_true', help='Formatos do cache de embeddings (float32/float16/pq)')
+    parser.add_argument('--busca', action='store_true', help='Motores de busca NCM (ChromaDB x NumPy exato)')
+    parser.add_argument('--lote', action='store_true', help='Busca hierarquica em lote x uma consulta por vez')
+    parser.add_argument('--contexto', action='store_true', help='Latencia da busca com atributos por etapa')
+    parser.add_argument('--atributos', action='store_true', help='Atributos por NCM: indice residente x tabela SQLite')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeticoes por medicao (melhor tempo)')
+    parser.add_argument('--amostra', type=int, default=2000, help='Documentos usados nos benchmarks de embedding')
+
+    args = parser.parse_args()
+
+    if not any([args.normalizacao, args.hierarquia, args.batching, args.backends, args.memoria,
+                args.cache, args.inicializacao, args.importacao, args.codecs,
+                args.busca, args.lote, args.contexto, args.atributos]):
+        parser.print_help()
+        sys.exit(0)
+
+    if args.normalizacao:
+        benchmark_text_normalization(repeat=args.repeat)
+    if args.hierarquia:
+        benchmark_hierarchy(repeat=args.repeat)
+    if args.batching:
+        benchmark_embedding_batching(repeat=args.repeat, sample=args.amostra)
+    if args.backends:
+        benchmark_embedding_backends(sample=args.amostra)
+    if args.memoria:
+        benchmark_build_memory()
+    if args.cache:
+        benchmark_build_cache()
+    if args.inicializacao:
+        benchmark_model_startup(repeat=args.repeat)
+    if args.importacao:
+        benchmark_import_time()
+    if args.codecs:
+        benchmark_cache_codecs(sample=args.amostra)
+    if args.busca:
+        benchmark_search_engines(repeat=args.repeat)
+    if args.lote:
+        benchmark_batch_search()
+    if args.contexto:
+        benchmark_context_retrieval(repeat=args.repeat)
+    if args.atributos:
+        benchmark_atributos_lookup(repeat=args.repeat)
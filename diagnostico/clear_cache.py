@@ -15,13 +15,17 @@ Uso:
     python clear_cache.py --model e5   # Limpa apenas modelos com 'e5' no nome
 """
 
-import os
 import shutil
+import sys
 import argparse
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
 
-def clear_cache(cache_dir="cache/embeddings", model_filter=None):
+from config import EMBEDDING_CACHE_DIR
+
+
+def clear_cache(cache_dir=EMBEDDING_CACHE_DIR, model_filter=None):
     """
     Limpa cache de embeddings
 
@@ -35,19 +39,20 @@ def clear_cache(cache_dir="cache/embeddings", model_filter=None):
         print(f"❌ Cache não encontrado em: {cache_path}")
         return
 
-    # Conta arquivos antes
-    pkl_files = list(cache_path.glob("*.pkl"))
-    json_files = list(cache_path.glob("*.json"))
+    from embedding_cache import EmbeddingCache
 
-    total_files = len(pkl_files) + len(json_files)
-    cache_size_mb = sum(f.stat().st_size for f in pkl_files + json_files) / (1024 * 1024)
+    cache = EmbeddingCache(cache_dir)
+    stats = cache.get_stats()
+    pkl_files = list(cache_path.glob("*.pkl"))
 
     print("\n" + "="*60)
     print("LIMPEZA DE CACHE DE EMBEDDINGS")
     print("="*60)
     print(f"Diretório: {cache_path.absolute()}")
-    print(f"Arquivos: {total_files} ({len(pkl_files)} embeddings + {len(json_files)} metadata)")
-    print(f"Tamanho: {cache_size_mb:.2f} MB")
+    print(f"Entradas: {stats['total_entries']}")
+    if pkl_files:
+        print(f"Arquivos .pkl antigos: {len(pkl_files)}")
+    print(f"Tamanho: {stats['cache_size_mb']:.2f} MB")
 
     if model_filter:
         print(f"Filtro: apenas modelos contendo '{model_filter}'")
@@ -56,44 +61,21 @@ def clear_cache(cache_dir="cache/embeddings", model_filter=None):
     response = input("\n⚠️  Deseja limpar o cache? [s/N]: ").strip().lower()
     if response not in ['s', 'sim', 'y', 'yes']:
         print("❌ Operação cancelada")
+        cache.close()
         return
 
     # Remove
     if model_filter:
-        # Limpeza parcial (baseada em metadata)
-        import json
-        metadata_file = cache_path / "metadata.json"
-
-        if not metadata_file.exists():
-            print("❌ metadata.json não encontrado. Use limpeza completa (sem --model)")
-            return
-
-        with open(metadata_file, 'r') as f:
-            metadata = json.load(f)
-
-        entries_to_remove = []
-        for hash_key, meta in metadata.get("entries", {}).items():
-            if model_filter.lower() in meta.get("model", "").lower():
-                entries_to_remove.append(hash_key)
-
-        print(f"\n🗑️  Removendo {len(entries_to_remove)} entradas...")
-
-        removed = 0
-        for hash_key in entries_to_remove:
-            cache_file = cache_path / f"{hash_key}.pkl"
-            if cache_file.exists():
-                cache_file.unlink()
-                removed += 1
-            del metadata["entries"][hash_key]
-
-        # Salva metadata atualizado
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
-
-        print(f"✓ Removidos {removed} arquivos")
+        # Limpeza parcial (por modelo, via índice)
+        models = [m for m in stats['models'] if model_filter.lower() in m.lower()]
+        print(f"\n🗑️  Removendo {sum(stats['entries_per_model'][m] for m in models)} entradas...")
+        for model in models:
+            cache.clear(model)
+        cache.close()
 
     else:
         # Limpeza completa
+        cache.close()
         print(f"\n🗑️  Removendo todo o cache...")
         shutil.rmtree(cache_path)
         cache_path.mkdir(parents=True, exist_ok=True)
@@ -119,8 +101,8 @@ if __name__ == "__main__":
     parser.add_argument(
         '--cache-dir',
         type=str,
-        default='cache/embeddings',
-        help='Diretório do cache (padrão: cache/embeddings)'
+        default=EMBEDDING_CACHE_DIR,
+        help=f'Diretório do cache (padrão: {EMBEDDING_CACHE_DIR})'
     )
 
     args = parser.parse_args()
@@ -13,6 +13,7 @@ Testa cada hipótese de problema:
 Uso:
     python diagnose.py --all                 # Todos os testes
     python diagnose.py --cache               # Apenas cache
+    python diagnose.py --cache-concorrencia  # Gravação no cache por vários processos
     python diagnose.py --normalization       # Apenas normalização
     python diagnose.py --ground-truth        # Apenas ground truth
 """
@@ -30,72 +31,64 @@ def check_cache_integrity():
 
     Problemas detectados:
     - Modelos com nome genérico
-    - Embeddings duplicados
-    - Tamanho inconsistente
+    - Entradas apontando para linhas inexistentes da matriz
+    - Linhas órfãs (espaço recuperável com compact)
+    - Cache antigo (.pkl) ainda não migrado
     """
     print("\n" + "="*70)
     print("DIAGNÓSTICO 1: INTEGRIDADE DO CACHE")
     print("="*70)
 
-    cache_dir = Path("cache/embeddings")
-    metadata_file = cache_dir / "metadata.json"
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+    from config import EMBEDDING_CACHE_DIR
+    from embedding_cache import EmbeddingCache, INDEX_FILE
 
-    if not metadata_file.exists():
+    cache_dir = Path(EMBEDDING_CACHE_DIR)
+    if not (cache_dir / INDEX_FILE).exists() and not any(cache_dir.glob("*.pkl")):
         print("❌ Cache não encontrado ou vazio")
         return {"status": "empty", "issues": []}
 
-    # Carrega metadata
-    with open(metadata_file, 'r') as f:
-        metadata = json.load(f)
-
-    entries = metadata.get("entries", {})
+    cache = EmbeddingCache(str(cache_dir))
+    stats = cache.get_stats()
+    models = stats["entries_per_model"]
 
     # Análise
     issues = []
-    models = {}
-    total_size = 0
 
     print(f"\n📊 Estatísticas do Cache:")
-    print(f"  Total de entradas: {len(entries)}")
-
-    for hash_key, meta in entries.items():
-        model_name = meta.get("model", "unknown")
-
-        # Conta por modelo
-        if model_name not in models:
-            models[model_name] = 0
-        models[model_name] += 1
+    print(f"  Total de entradas: {stats['total_entries']}")
+    print(f"  Tamanho total: {stats['cache_size_mb']:.2f} MB")
+
+    # Entradas x linhas de cada matriz (uma por dimensão e formato)
+    matrices = cache.describe()
+    for matrix in matrices:
+        dim, codec, rows, count = matrix["dim"], matrix["codec"], matrix["rows"], matrix["referenced"]
+        if codec == 'pq' and not matrix["has_codebook"]:
+            issues.append(f"Entradas {dim}d em PQ sem codebook (pq_{dim}.npy ausente)")
+            continue
+        print(f"  Matriz {dim}d {codec}: {rows} linhas, {count} referenciadas "
+              f"({matrix['bytes_per_vector']} bytes/vetor)")
+        if matrix["max_row"] is not None and matrix["max_row"] >= rows:
+            issues.append(f"Entradas {dim}d {codec} apontam para linhas inexistentes (matriz truncada)")
+        elif rows > count:
+            issues.append(f"{rows - count} linhas órfãs na matriz {dim}d {codec} (recuperável com compact)")
+    if any(matrix["codec"] != cache.codec for matrix in matrices):
+        print(f"  Entradas fora do formato atual ({cache.codec}): regrave com cache.convert()")
+
+    pkl_count = sum(1 for _ in cache_dir.glob("*.pkl"))
+    if pkl_count:
+        issues.append(f"{pkl_count} arquivos .pkl antigos: migre com python diagnostico/migrate_cache.py")
 
-        # Verifica arquivo existe
-        cache_file = cache_dir / f"{hash_key}.pkl"
-        if cache_file.exists():
-            total_size += cache_file.stat().st_size
-        else:
-            issues.append(f"Arquivo faltando: {hash_key}")
-
-    print(f"  Tamanho total: {total_size / (1024**2):.2f} MB")
     print(f"\n📁 Distribuição por Modelo:")
 
     for model_name, count in sorted(models.items(), key=lambda x: -x[1]):
         print(f"  {model_name}: {count} embeddings")
 
         # Detecta problemas
-        if "SentenceTransformer" in model_name or "unknown" in model_name:
+        if "SentenceTransformer" in model_name or "unknown" in model_name or "desconhecido" in model_name:
             issues.append(f"⚠️  Modelo com nome genérico: {model_name} ({count} embeddings)")
 
-    # Verifica duplicados
-    text_hashes = {}
-    for hash_key, meta in entries.items():
-        text_len = meta.get("text_length", 0)
-        key = f"{meta.get('model')}_{text_len}"
-
-        if key not in text_hashes:
-            text_hashes[key] = 0
-        text_hashes[key] += 1
-
-    duplicates = {k: v for k, v in text_hashes.items() if v > 100}
-    if duplicates:
-        issues.append(f"Possíveis duplicados: {len(duplicates)} grupos")
+    cache.close()
 
     # Resultado
     print(f"\n🔍 Problemas Detectados: {len(issues)}")
@@ -113,6 +106,81 @@ def check_cache_integrity():
         return {"status": "ok", "issues": [], "models": models}
 
 
+def _concurrent_vector(text, dim):
+    """Vetor determinístico do texto (cada processo sabe o que deveria ler)."""
+    import hashlib
+    import numpy as np
+    seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def _concurrent_writer(args):
+    """Processo de check_cache_concurrency: grava lotes próprios no cache compartilhado."""
+    import numpy as np
+    cache_dir, worker, batches, batch_size, dim = args
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+    from embedding_cache import EmbeddingCache
+
+    cache = EmbeddingCache(cache_dir, memory_mb=0, disk_mb=0, codec='float32')
+    for batch in range(batches):
+        texts = [f"processo {worker} lote {batch} texto {i}" for i in range(batch_size)]
+        cache.put_many(texts, "concorrencia", np.stack([_concurrent_vector(t, dim) for t in texts]))
+    cache.close()
+    return batches * batch_size
+
+
+def check_cache_concurrency(processes=4, batches=200, batch_size=4, dim=64):
+    """
+    Verifica gravação concorrente no cache de embeddings
+
+    Vários processos gravam textos distintos no mesmo diretório (cache
+    temporário); depois cada texto precisa devolver o próprio vetor.
+    Sem a trava entre processos, linhas da matriz se sobrepõem e textos
+    passam a devolver vetores de outros, sem erro.
+    """
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+    import numpy as np
+
+    print("\n" + "="*70)
+    print("DIAGNÓSTICO: GRAVAÇÃO CONCORRENTE NO CACHE")
+    print("="*70)
+
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+    from embedding_cache import EmbeddingCache
+
+    cache_dir = tempfile.mkdtemp(prefix='diagnose_cache_')
+    try:
+        with Pool(processes) as pool:
+            written = sum(pool.map(
+                _concurrent_writer,
+                [(cache_dir, worker, batches, batch_size, dim) for worker in range(processes)]
+            ))
+
+        texts = [f"processo {worker} lote {batch} texto {i}"
+                 for worker in range(processes) for batch in range(batches) for i in range(batch_size)]
+        cache = EmbeddingCache(cache_dir, memory_mb=0, disk_mb=0, codec='float32')
+        vectors, missing = cache.get_many(texts, "concorrencia")
+        cache.close()
+
+        missing = set(missing)
+        wrong = sum(
+            1 for i, text in enumerate(texts)
+            if i not in missing and not np.array_equal(vectors[i], _concurrent_vector(text, dim))
+        )
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"\n  {processes} processos, {written} entradas gravadas")
+    print(f"  Ausentes: {len(missing)} | Vetor de outro texto: {wrong}")
+    if missing or wrong:
+        print("  ❌ Gravação concorrente corrompeu o cache")
+        return {"status": "corrupted", "missing": len(missing), "wrong": wrong}
+    print("  ✅ Todas as entradas devolvem o próprio vetor")
+    return {"status": "ok", "missing": 0, "wrong": 0}
+
+
 def test_normalization_impact():
     """
     Testa impacto da normalização
@@ -304,6 +372,7 @@ def run_all_diagnostics():
 
     # 1. Cache
     results['cache'] = check_cache_integrity()
+    results['cache_concurrency'] = check_cache_concurrency()
 
     # 2. Normalização
     results['normalization'] = test_normalization_impact()
@@ -324,6 +393,9 @@ def run_all_diagnostics():
     if results['cache']['status'] == 'corrupted':
         issues_found.append("⚠️  Cache corrompido")
 
+    if results['cache_concurrency']['status'] == 'corrupted':
+        issues_found.append("⚠️  Gravação concorrente no cache corrompe entradas")
+
     if results['normalization']['status'] == 'aggressive':
         issues_found.append("⚠️  Normalização muito agressiva")
 
@@ -363,6 +435,7 @@ if __name__ == "__main__":
 
     parser.add_argument('--all', action='store_true', help='Todos os testes')
     parser.add_argument('--cache', action='store_true', help='Apenas cache')
+    parser.add_argument('--cache-concorrencia', action='store_true', help='Gravação concorrente no cache')
     parser.add_argument('--normalization', action='store_true', help='Apenas normalização')
     parser.add_argument('--ground-truth', action='store_true', help='Apenas ground truth')
     parser.add_argument('--baseline', action='store_true', help='Apenas baseline')
@@ -370,7 +443,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # Se nenhum argumento, executa tudo
-    if not any([args.all, args.cache, args.normalization, args.ground_truth, args.baseline]):
+    if not any([args.all, args.cache, args.cache_concorrencia, args.normalization,
+                args.ground_truth, args.baseline]):
         args.all = True
 
     if args.all:
@@ -378,6 +452,8 @@ if __name__ == "__main__":
     else:
         if args.cache:
             check_cache_integrity()
+        if args.cache_concorrencia:
+            check_cache_concurrency()
         if args.normalization:
             test_normalization_impact()
         if args.ground_truth:
@@ -6,7 +6,9 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import numpy as np
-from embeddings import encode_text
+from search import find_similars_batch
+from config import ATRIBUTOS_STORAGE
+from atributos_table import atributos_table_exists, count_atributos, load_atributos_store
 
 
 def get_quality_label(distance):
@@ -32,16 +34,12 @@ def analyze_distance_distribution(collection, sample_queries):
     all_distances = []
     query_results = {}
 
-    for query in sample_queries:
-        emb = encode_text(query).astype(float).tolist()
-        results = collection.query(
-            query_embeddings=[emb],
-            n_results=10,
-            where={"tipo": "ncm"}
-        )
+    # Todas as consultas em uma vetorizacao e uma busca
+    batch = find_similars_batch(collection, sample_queries, k=10, filters={"tipo": "ncm"})
 
-        if results and results.get('distances'):
-            distances = results['distances'][0]
+    for query, hits in zip(sample_queries, batch):
+        if hits:
+            distances = [hit['distance'] for hit in hits]
             all_distances.extend(distances)
             query_results[query] = {
                 'min': min(distances),
@@ -102,28 +100,23 @@ def evaluate_known_ncm_queries(collection):
 
     print("\nTestando queries conhecidas:\n")
 
-    for query, expected_prefix in test_cases:
-        emb = encode_text(query).astype(float).tolist()
-        search_results = collection.query(
-            query_embeddings=[emb],
-            n_results=5,
-            where={"tipo": "ncm"}
-        )
+    # Todas as consultas em uma vetorizacao e uma busca
+    batch = find_similars_batch(collection, [query for query, _ in test_cases], k=5, filters={"tipo": "ncm"})
 
-        if not search_results or not search_results.get('metadatas'):
+    for (query, expected_prefix), top_results in zip(test_cases, batch):
+        if not top_results:
             print(f"  FALHA: '{query}' - sem resultados")
             results.append({'query': query, 'hit': False, 'top1': False})
             continue
 
-        top_results = search_results['metadatas'][0]
-        top_distances = search_results['distances'][0]
+        top_distances = [hit['distance'] for hit in top_results]
 
         found = False
         top1_match = False
         found_pos = -1
 
         for i, meta in enumerate(top_results):
-            ncm_code = meta.get('codigo_normalizado', '') or meta.get('codigo', '')
+            ncm_code = meta.get('codigo_normalizado') or meta.get('codigo') or ''
             prefix = ncm_code[:4].replace('.', '')
 
             if prefix == expected_prefix:
@@ -157,12 +150,53 @@ def evaluate_known_ncm_queries(collection):
     return accuracy, top1_accuracy, results
 
 
-def analyze_attribute_coverage(collection):
-    """Analisa cobertura de atributos por NCM"""
+def _attribute_coverage_from_store(store):
+    """Cobertura de atributos calculada com varreduras vetorizadas no AtributosStore"""
+    total = store.num_atributos
+    if total == 0:
+        print("Nenhum atributo encontrado.")
+        return
+
+    counts = store.counts_by_ncm()
+    counts = counts[counts > 0]
+    obrigatorios = int(store.obrigatorio.sum())
+
+    print(f"\nTotal de atributos: {total}")
+    print(f"NCMs com atributos: {len(counts)}")
+    print(f"\nPor modalidade:")
+    print(f"  Importação: {int(store.mask(modalidade='Importacao').sum())}")
+    print(f"  Exportação: {int(store.mask(modalidade='Exportacao').sum())}")
+    print(f"\nObrigatórios: {obrigatorios} ({100*obrigatorios/total:.1f}%)")
+
+    obrig_imp = store.ncms_with(store.mask(modalidade='Importacao', obrigatorio=True))
+    print(f"NCMs com atributo obrigatório de importação: {len(obrig_imp)}")
+
+    if len(counts):
+        print(f"\nAtributos por NCM:")
+        print(f"  Média: {np.mean(counts):.1f}")
+        print(f"  Mediana: {int(np.median(counts))}")
+        print(f"  Min: {counts.min()}, Max: {counts.max()}")
+
+
+def analyze_attribute_coverage(collection, store=None):
+    """
+    Analisa cobertura de atributos por NCM
+
+    Se store (AtributosStore) for informado, usa o armazenamento colunar
+    em vez de varrer os metadados de atributos do banco. Com
+    ATRIBUTOS_STORAGE='sqlite', o store e carregado da tabela local.
+    """
     print("\n" + "="*70)
     print("ANÁLISE: COBERTURA DE ATRIBUTOS")
     print("="*70)
 
+    if store is None and ATRIBUTOS_STORAGE == 'sqlite' and atributos_table_exists():
+        store = load_atributos_store()
+
+    if store is not None:
+        _attribute_coverage_from_store(store)
+        return
+
     try:
         # Busca todos atributos
         atributos = collection.get(where={"tipo": "atributo"}, limit=100000)
@@ -225,8 +259,8 @@ def comprehensive_diagnostic(collection):
         print(f"  Documentos NCM: erro ao contar")
 
     try:
-        attr_count = len(collection.get(where={"tipo": "atributo"}, limit=100000)['ids'])
-        print(f"  Documentos Atributo: {attr_count}")
+        attr_count, origem = count_atributos(collection)
+        print(f"  Atributos ({origem}): {attr_count}")
     except:
         print(f"  Documentos Atributo: erro ao contar")
 
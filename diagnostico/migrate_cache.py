@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# migrate_cache.py
+# Importa cache de embeddings antigo (um .pkl por texto) para o formato memmap
+
+"""
+MIGRACAO DO CACHE DE EMBEDDINGS
+
+O cache antigo grava um arquivo .pkl por texto e um metadata.json com
+todas as entradas. O formato atual (embedding_cache.EmbeddingCache) usa
+uma matriz por dimensao (no formato EMBEDDING_CACHE_CODEC) e um indice
+SQLite. As chaves (hash de modelo + texto) sao preservadas: textos ja
+vetorizados continuam em cache.
+
+Uso:
+    python diagnostico/migrate_cache.py                    # Importa de cache/embeddings
+    python diagnostico/migrate_cache.py --origem OUTRO_DIR # Importa de outro diretorio
+    python diagnostico/migrate_cache.py --remover          # Apaga .pkl apos importar
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import EMBEDDING_CACHE_DIR
+
+
+def migrate_cache(source_dir=None, cache_dir=None, remove=False):
+    """
+    Importa .pkl de source_dir (padrao: o proprio diretorio do cache)
+    para o cache em cache_dir. Retorna quantidade de entradas importadas.
+    """
+    from embedding_cache import EmbeddingCache
+
+    cache_dir = cache_dir or EMBEDDING_CACHE_DIR
+    source = Path(source_dir or cache_dir)
+
+    print("\n" + "="*60)
+    print("MIGRACAO DO CACHE DE EMBEDDINGS")
+    print("="*60)
+    print(f"Origem: {source.absolute()}")
+    print(f"Destino: {Path(cache_dir).absolute()}")
+
+    pkl_count = sum(1 for _ in source.glob("*.pkl")) if source.exists() else 0
+    if pkl_count == 0:
+        print("Nenhum arquivo .pkl encontrado")
+        return 0
+    print(f"Arquivos .pkl: {pkl_count}")
+
+    t0 = time.time()
+    cache = EmbeddingCache(cache_dir)
+    imported = cache.import_pickle_cache(source, remove=remove)
+    print(f"\n✓ {imported} entradas importadas ({time.time()-t0:.1f}s)")
+    if remove:
+        print("✓ Arquivos .pkl e metadata.json removidos")
+    cache.print_stats()
+    cache.close()
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Importa cache de embeddings antigo (.pkl)",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--origem', type=str, default=None,
+                        help='Diretorio do cache antigo (padrao: EMBEDDING_CACHE_DIR)')
+    parser.add_argument('--cache-dir', type=str, default=EMBEDDING_CACHE_DIR,
+                        help=f'Diretorio do cache novo (padrao: {EMBEDDING_CACHE_DIR})')
+    parser.add_argument('--remover', action='store_true',
+                        help='Remove .pkl e metadata.json apos importar')
+    args = parser.parse_args()
+
+    migrate_cache(args.origem, args.cache_dir, remove=args.remover)
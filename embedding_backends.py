@@ -0,0 +1,226 @@
+# embedding_backends.py
+# Backends de inferencia do modelo de embedding (PyTorch, ONNX, ONNX int8)
+
+import json
+import os
+import re
+import time
+
+from config import (
+    EMBEDDING_MODEL, EMBEDDING_BACKEND, EMBEDDING_ONNX_DIR, EMBEDDING_QUANTIZATION,
+    EMBEDDING_PINNED_SNAPSHOT, EMBEDDING_SNAPSHOT_DIR
+)
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+SNAPSHOT_MANIFEST = 'snapshot.json'
+
+
+def backend_id(backend=None):
+    """
+    Identificador do backend gravado junto ao indice.
+
+    Inclui a configuracao de quantizacao para onnx-int8
+    (ex.: 'onnx-int8/avx2'), pois vetores de quantizacoes diferentes
+    nao sao identicos.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'onnx-int8':
+        return f"{backend}/{EMBEDDING_QUANTIZATION}"
+    return backend
+
+
+def embedding_signature(backend=None):
+    """
+    Modelo + backend: identifica como os vetores do indice foram gerados.
+
+    Para o backend original (torch) e apenas o nome do modelo, mantendo
+    validos os hashes de conteudo de indices gerados antes dos backends.
+    """
+    backend = backend_id(backend)
+    if backend == 'torch':
+        return EMBEDDING_MODEL
+    return f"{EMBEDDING_MODEL}|{backend}"
+
+
+def _model_dir(base, model_name=None):
+    """Subdiretorio de base com o nome do modelo (caracteres seguros)."""
+    model_name = model_name or EMBEDDING_MODEL
+    return os.path.join(base, re.sub(r'[^\w.-]', '_', model_name))
+
+
+def _onnx_dir(model_name=None):
+    """Diretorio local do modelo exportado para ONNX."""
+    return _model_dir(EMBEDDING_ONNX_DIR, model_name)
+
+
+def snapshot_dir(model_name=None):
+    """Diretorio do snapshot local fixado do modelo."""
+    return _model_dir(EMBEDDING_SNAPSHOT_DIR, model_name)
+
+
+def load_snapshot_manifest(model_name=None):
+    """
+    Manifesto do snapshot (modelo, versoes, arquivos) ou None se o
+    snapshot nao existe, esta incompleto ou e de outro modelo.
+    """
+    model_name = model_name or EMBEDDING_MODEL
+    path = snapshot_dir(model_name)
+    try:
+        with open(os.path.join(path, SNAPSHOT_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('modelo') != model_name:
+        return None
+    for name in manifest.get('arquivos', {}):
+        if not os.path.exists(os.path.join(path, name)):
+            return None
+    return manifest
+
+
+def export_snapshot(model_name=None):
+    """
+    Exporta o modelo para um snapshot local fixado (uma unica vez).
+
+    Baixa/resolve o modelo pelo cache do Hugging Face, grava em
+    EMBEDDING_SNAPSHOT_DIR com pesos em safetensors (carregados via mmap,
+    sem desserializar pickle) e escreve um manifesto com modelo, versoes
+    e tamanho de cada arquivo. O manifesto e gravado por ultimo: snapshot
+    sem manifesto e considerado incompleto e exportado de novo.
+
+    Retorna diretorio do snapshot.
+    """
+    import sentence_transformers
+    from sentence_transformers import SentenceTransformer
+
+    model_name = model_name or EMBEDDING_MODEL
+    path = snapshot_dir(model_name)
+    if load_snapshot_manifest(model_name) is not None:
+        return path
+
+    print(f"Exportando snapshot local de {model_name} para {path}...")
+    model = SentenceTransformer(model_name)
+    model.save_pretrained(path, safe_serialization=True)
+
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            files[os.path.relpath(full, path)] = os.path.getsize(full)
+
+    manifest = {
+        'modelo': model_name,
+        'sentence_transformers': sentence_transformers.__version__,
+        'criado_em': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'arquivos': files
+    }
+    tmp_path = os.path.join(path, SNAPSHOT_MANIFEST + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(path, SNAPSHOT_MANIFEST))
+    return path
+
+
+def _enable_offline():
+    """Impede acesso ao Hugging Face Hub neste processo."""
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+
+
+def model_source(model_name=None):
+    """
+    Origem do modelo base: snapshot local (EMBEDDING_PINNED_SNAPSHOT,
+    exportado se necessario) ou nome no Hugging Face Hub.
+    """
+    if EMBEDDING_PINNED_SNAPSHOT:
+        return export_snapshot(model_name)
+    return model_name or EMBEDDING_MODEL
+
+
+def _quantized_file(quantization=None):
+    """Nome do arquivo int8 gerado por export_dynamic_quantized_onnx_model."""
+    return f"onnx/model_qint8_{quantization or EMBEDDING_QUANTIZATION}.onnx"
+
+
+def export_onnx(model_name=None):
+    """
+    Exporta modelo para ONNX (uma unica vez) em EMBEDDING_ONNX_DIR.
+
+    Retorna diretorio do modelo exportado.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    path = _onnx_dir(model_name)
+    if not os.path.exists(os.path.join(path, 'onnx', 'model.onnx')):
+        print(f"Exportando {model_name or EMBEDDING_MODEL} para ONNX em {path}...")
+        model = SentenceTransformer(model_source(model_name), backend='onnx')
+        model.save_pretrained(path)
+    return path
+
+
+def export_onnx_int8(model_name=None, quantization=None):
+    """
+    Gera variante ONNX com quantizacao dinamica int8 (pesos int8,
+    ativacoes quantizadas em tempo de execucao), uma unica vez.
+
+    quantization: 'arm64', 'avx2', 'avx512' ou 'avx512_vnni'
+    (EMBEDDING_QUANTIZATION), conforme instrucoes da CPU.
+
+    Retorna diretorio do modelo exportado.
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    quantization = quantization or EMBEDDING_QUANTIZATION
+    path = export_onnx(model_name)
+    if not os.path.exists(os.path.join(path, _quantized_file(quantization))):
+        print(f"Quantizando modelo ONNX para int8 ({quantization})...")
+        model = SentenceTransformer(path, backend='onnx')
+        export_dynamic_quantized_onnx_model(model, quantization, path)
+    return path
+
+
+def load_embedder(backend=None):
+    """
+    Carrega SentenceTransformer com o backend escolhido.
+
+    - torch: modelo original em FP32 (PyTorch)
+    - onnx: mesmo modelo exportado para ONNX Runtime
+    - onnx-int8: ONNX com quantizacao dinamica int8 para CPU
+
+    Exportacoes ficam em EMBEDDING_ONNX_DIR e sao reutilizadas. Com
+    EMBEDDING_PINNED_SNAPSHOT, o modelo e carregado do snapshot local em
+    modo offline (sem consultar o Hub); exportacoes ausentes sao geradas
+    antes de desligar o acesso a rede.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND invalido: {backend} (use {', '.join(BACKENDS)})")
+
+    if backend == 'torch':
+        path, kwargs = model_source(), {}
+    elif backend == 'onnx':
+        path, kwargs = export_onnx(), {'backend': 'onnx'}
+    else:
+        path, kwargs = export_onnx_int8(), {
+            'backend': 'onnx',
+            'model_kwargs': {'file_name': _quantized_file()}
+        }
+
+    if EMBEDDING_PINNED_SNAPSHOT:
+        _enable_offline()
+        kwargs['local_files_only'] = True
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(path, **kwargs)
+
+
+def describe_source(backend=None):
+    """Descricao curta de onde o modelo e carregado (para logs e menu)."""
+    backend = backend or EMBEDDING_BACKEND
+    if backend != 'torch':
+        return f"{backend_id(backend)} em {_onnx_dir()}"
+    if EMBEDDING_PINNED_SNAPSHOT:
+        return f"snapshot local {snapshot_dir()}"
+    return "Hugging Face Hub"
@@ -2,48 +2,267 @@
 # Sistema de cache para embeddings de documentos
 
 
-import pickle
 import hashlib
-import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional, List
 import numpy as np
 
+from config import (
+    EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MEMORY_MB, EMBEDDING_CACHE_DISK_MB,
+    EMBEDDING_CACHE_EVICTION, EMBEDDING_CACHE_CODEC, EMBEDDING_CACHE_PQ_TRAIN_SIZE
+)
+from embedding_codecs import (
+    CODECS, encode_vectors, decode_vectors, row_format, bytes_per_vector, train_pq
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Índice hash -> linha: cada entrada aponta para uma linha da matriz de
+# vetores da sua dimensão e formato (vetores_<dim>.<f32|f16|pq>);
+# ultimo_acesso/acessos orientam a remoção quando o disco passa da cota
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entrada (
+    chave TEXT PRIMARY KEY,
+    dimensao INTEGER NOT NULL,
+    linha INTEGER NOT NULL,
+    modelo TEXT NOT NULL,
+    tamanho_texto INTEGER NOT NULL,
+    ultimo_acesso REAL NOT NULL DEFAULT 0,
+    acessos INTEGER NOT NULL DEFAULT 0,
+    codec TEXT NOT NULL DEFAULT 'float32'
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_entrada_modelo ON entrada(modelo);
+"""
+
+INDEX_FILE = "index.sqlite3"
+
+# Trava entre processos que compartilham o diretório do cache
+LOCK_FILE = "cache.lock"
+
+# Limite de parâmetros por consulta IN (...) no SQLite
+_SQL_CHUNK = 900
+
+# Acessos acumulados em memória antes de gravar no índice
+_ACCESS_FLUSH = 1000
+
+# Após remover por cota, o disco fica nesta fração da cota (evita
+# regravar as matrizes a cada novo lote)
+_EVICTION_TARGET = 0.9
+
+# Linhas por bloco ao regravar matrizes (compact/convert)
+_REWRITE_CHUNK = 65536
+
+# Ordem de remoção por política
+_EVICTION_ORDER = {
+    'lru': "ultimo_acesso",
+    'lfu': "acessos, ultimo_acesso",
+}
+
+
+class MemoryLRU:
+    """
+    Camada em memória: embeddings mais recentemente usados até um
+    orçamento de bytes (vetor + custo aproximado da entrada).
+    """
+
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        vector = self._items.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def put(self, key: str, vector: np.ndarray):
+        """Guarda cópia do vetor (desacoplada do memmap), removendo as menos recentes."""
+        size = vector.nbytes + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes + self.ENTRY_OVERHEAD
+
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        self._items[key] = vector
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            _, old = self._items.popitem(last=False)
+            self.bytes -= old.nbytes + self.ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+
+class ProcessLock:
+    """
+    Trava de arquivo entre processos (fcntl.flock; no Windows,
+    msvcrt.locking, sempre exclusiva).
+
+    Reentrante dentro do mesmo processo: chamadas aninhadas apenas
+    contam profundidade (o chamador serializa threads com seu próprio
+    lock). Não promove trava compartilhada para exclusiva.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+        self._depth = 0
+
+    @contextmanager
+    def hold(self, shared: bool = False):
+        if self._depth == 0:
+            self._acquire(shared)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._release()
+
+    def _acquire(self, shared: bool):
+        self._file = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            return
+        self._file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK desiste após ~10s: continua esperando
+                continue
+
+    def _release(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
 
 class EmbeddingCache:
     """
     Cache persistente de embeddings para acelerar benchmark e indexação.
 
     Features:
-    - Cache em disco usando pickle
+    - Vetores em um único arquivo por dimensão e formato (append-only),
+      lidos via np.memmap: consulta em lote é uma leitura vetorizada
+    - Formato em disco float32, float16 ou quantização por produto
+      (codec, EMBEDDING_CACHE_CODEC), decodificado na leitura
+    - Índice hash -> linha em SQLite (sem um arquivo por texto)
     - Hash MD5 para identificação única (texto + modelo)
     - Invalidação automática ao mudar modelo
-    - Estatísticas de hit/miss
+    - Estatísticas de hit/miss/remoção por camada
+
+    Duas camadas: LRU em memória (memory_mb, EMBEDDING_CACHE_MEMORY_MB)
+    na frente do disco; acertos no disco são promovidos para a memória.
+    O disco tem cota própria (disk_mb, EMBEDDING_CACHE_DISK_MB): ao
+    passar dela, entradas são removidas pela política de eviction ('lru'
+    pelo último acesso ou 'lfu' pela quantidade de acessos) até
+    _EVICTION_TARGET da cota, e as matrizes são compactadas.
+
+    Formato 'pq' usa codebook por dimensão treinado sobre o próprio cache
+    (train_pq, automático com EMBEDDING_CACHE_PQ_TRAIN_SIZE vetores);
+    antes disso grava float16. Entradas em outro formato continuam
+    legíveis; convert() regrava tudo no formato atual.
+
+    Escrita: vetores são anexados à matriz antes de o índice ser gravado
+    (transação única por lote); linhas órfãs de uma gravação interrompida
+    nunca são referenciadas e somem em compact().
+
+    Vários processos podem usar o mesmo diretório (CLI, Gradio, menu,
+    diagnósticos): gravações (contagem de linhas, append e INSERTs),
+    compactação e conversão seguram trava exclusiva em cache.lock;
+    leituras seguram trava compartilhada entre a consulta ao índice e a
+    leitura da matriz (linhas não mudam no meio). Matrizes e codebooks
+    regravados por outro processo são reabertos (inode/mtime).
     """
 
-    def __init__(self, cache_dir: str = "cache/embeddings"):
-        self.cache_dir = Path(cache_dir)
+    def __init__(self, cache_dir: str = None, memory_mb: float = None, disk_mb: float = None,
+                 eviction: str = None, codec: str = None):
+        self.cache_dir = Path(cache_dir or EMBEDDING_CACHE_DIR)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
 
-        # Arquivo de metadata
-        self.metadata_file = self.cache_dir / "metadata.json"
-        self.metadata = self._load_metadata()
+        memory_mb = EMBEDDING_CACHE_MEMORY_MB if memory_mb is None else memory_mb
+        self.disk_quota = int((EMBEDDING_CACHE_DISK_MB if disk_mb is None else disk_mb) * 1024 * 1024)
+        self.eviction = eviction or EMBEDDING_CACHE_EVICTION
+        if self.eviction not in _EVICTION_ORDER:
+            raise ValueError(f"Politica de eviction invalida: {self.eviction} "
+                             f"(use {', '.join(_EVICTION_ORDER)})")
 
-        # Estatísticas
+        self.codec = codec or EMBEDDING_CACHE_CODEC
+        if self.codec not in CODECS:
+            raise ValueError(f"Formato de cache invalido: {self.codec} (use {', '.join(CODECS)})")
+
+        self._lock = threading.RLock()
+        self._process_lock = ProcessLock(self.cache_dir / LOCK_FILE)
+        self._conn = self._connect()
+        self._matrices = {}
+        self._codebooks = {}
+        self._memory = MemoryLRU(int(memory_mb * 1024 * 1024))
+        self._pending_access = {}
+
+        # Estatísticas (hits/misses somam as duas camadas)
         self.hits = 0
         self.misses = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_evictions = 0
 
-    def _load_metadata(self) -> dict:
-        """Carrega metadata do cache"""
-        if self.metadata_file.exists():
-            with open(self.metadata_file, 'r') as f:
-                return json.load(f)
-        return {"version": "1.0", "entries": {}}
+        if any(self.cache_dir.glob("*.pkl")):
+            print(f"Cache antigo (.pkl) encontrado em {self.cache_dir}: "
+                  f"importe com python diagnostico/migrate_cache.py")
 
-    def _save_metadata(self):
-        """Salva metadata do cache"""
-        with open(self.metadata_file, 'w') as f:
-            json.dump(self.metadata, f, indent=2)
+    def _connect(self) -> sqlite3.Connection:
+        """Abre índice, criando ou atualizando o esquema."""
+        conn = sqlite3.connect(str(self.cache_dir / INDEX_FILE), timeout=60, check_same_thread=False)
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(entrada)")}
+        with conn:
+            # Índices criados antes da cota de disco
+            if 'ultimo_acesso' not in columns:
+                conn.execute("ALTER TABLE entrada ADD COLUMN ultimo_acesso REAL NOT NULL DEFAULT 0")
+            if 'acessos' not in columns:
+                conn.execute("ALTER TABLE entrada ADD COLUMN acessos INTEGER NOT NULL DEFAULT 0")
+            # Índices criados antes dos formatos compactos (tudo float32)
+            if 'codec' not in columns:
+                conn.execute("ALTER TABLE entrada ADD COLUMN codec TEXT NOT NULL DEFAULT 'float32'")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entrada_acesso ON entrada(ultimo_acesso)")
+        return conn
 
     def _get_hash(self, text: str, model_name: str) -> str:
         """
@@ -53,101 +272,565 @@ class EmbeddingCache:
         key = f"{model_name}:{text}"
         return hashlib.md5(key.encode('utf-8')).hexdigest()
 
-    def get(self, text: str, model_name: str) -> Optional[np.ndarray]:
+    @contextmanager
+    def _exclusive(self):
+        """Trava de escrita: threads deste processo e demais processos."""
+        with self._lock, self._process_lock.hold():
+            yield
+
+    @contextmanager
+    def _shared(self):
+        """Trava de leitura (gravações de outros processos esperam)."""
+        with self._lock, self._process_lock.hold(shared=True):
+            yield
+
+    # === Matrizes de vetores ===
+
+    def _matrix_file(self, dim: int, codec: str = 'float32') -> Path:
+        return self.cache_dir / f"vetores_{dim}.{CODECS[codec]}"
+
+    def _matrix_files(self):
+        """Arquivos de matriz existentes: (dimensao, codec, caminho)."""
+        suffixes = {suffix: codec for codec, suffix in CODECS.items()}
+        for path in self.cache_dir.glob("vetores_*"):
+            codec = suffixes.get(path.suffix[1:])
+            if codec is not None:
+                yield int(path.stem.split('_')[1]), codec, path
+
+    def _codebook_file(self, dim: int) -> Path:
+        return self.cache_dir / f"pq_{dim}.npy"
+
+    def _codebook(self, dim: int) -> Optional[np.ndarray]:
+        """Codebook PQ da dimensão (None se ainda não treinado; relido se regravado)."""
+        try:
+            mtime = self._codebook_file(dim).stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        cached = self._codebooks.get(dim)
+        if cached is None or cached[0] != mtime:
+            cached = self._codebooks[dim] = (mtime, np.load(self._codebook_file(dim)) if mtime else None)
+        return cached[1]
+
+    def _row_bytes(self, dim: int, codec: str) -> int:
+        return bytes_per_vector(dim, codec, self._codebook(dim))
+
+    def _row_count(self, dim: int, codec: str = 'float32') -> int:
+        """Linhas completas gravadas na matriz da dimensão/formato."""
+        path = self._matrix_file(dim, codec)
+        return path.stat().st_size // self._row_bytes(dim, codec) if path.exists() else 0
+
+    def _matrix(self, dim: int, codec: str = 'float32') -> Optional[np.memmap]:
         """
-        Recupera embedding do cache se existir.
+        Matriz da dimensão/formato mapeada em memória (somente leitura),
+        remapeada se cresceu ou foi substituída (compact em outro processo).
+        """
+        group = (dim, codec)
+        path = self._matrix_file(dim, codec)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._matrices.pop(group, None)
+            return None
+        rows = stat.st_size // self._row_bytes(dim, codec)
+        inode, matrix = self._matrices.get(group, (None, None))
+        if matrix is None or len(matrix) != rows or inode != stat.st_ino:
+            if rows == 0:
+                return None
+            dtype, width = row_format(dim, codec, self._codebook(dim))
+            matrix = np.memmap(path, dtype=dtype, mode='r', shape=(rows, width))
+            self._matrices[group] = (stat.st_ino, matrix)
+        return matrix
 
+    def _read(self, dim: int, codec: str, rows) -> np.ndarray:
+        """Vetores float32 das linhas indicadas (decodificados)."""
+        return decode_vectors(self._matrix(dim, codec)[rows], codec, self._codebook(dim))
+
+    def _write_codec(self, dim: int) -> str:
+        """Formato de novas gravações ('pq' sem codebook grava float16)."""
+        if self.codec == 'pq' and self._codebook(dim) is None:
+            return 'float16'
+        return self.codec
+
+    def _append(self, vectors: np.ndarray, codec: str) -> int:
         """
-        hash_key = self._get_hash(text, model_name)
-        cache_file = self.cache_dir / f"{hash_key}.pkl"
+        Codifica vetores float32 e anexa à matriz da dimensão/formato.
 
-        if cache_file.exists():
-            try:
-                with open(cache_file, 'rb') as f:
-                    embedding = pickle.load(f)
-                self.hits += 1
-                return embedding
-            except Exception as e:
-                print(f"Erro ao ler cache {hash_key}: {e}")
-                cache_file.unlink()  # Remove arquivo corrompido
+        Descarta resto de linha parcial (gravação interrompida) antes de
+        anexar. Retorna índice da primeira linha gravada. Chamar com
+        _exclusive(): a linha inicial só vale até o INSERT das entradas.
+        """
+        dim = vectors.shape[1]
+        data = encode_vectors(vectors, codec, self._codebook(dim))
+        row_bytes = self._row_bytes(dim, codec)
+        path = self._matrix_file(dim, codec)
+        start = self._row_count(dim, codec)
+        with open(path, 'ab') as f:
+            if f.tell() != start * row_bytes:
+                f.truncate(start * row_bytes)
+            f.write(np.ascontiguousarray(data).tobytes())
+            f.flush()
+        self._matrices.pop((dim, codec), None)
+        return start
 
-        self.misses += 1
-        return None
+    # === Consulta e gravação em lote ===
 
-    def set(self, text: str, model_name: str, embedding: np.ndarray):
+    def _lookup(self, keys: List[str]) -> dict:
+        """Mapa chave -> (dimensao, codec, linha) das chaves presentes no índice."""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        for i in range(0, len(unique), _SQL_CHUNK):
+            chunk = unique[i:i + _SQL_CHUNK]
+            rows = self._conn.execute(
+                f"SELECT chave, dimensao, codec, linha FROM entrada "
+                f"WHERE chave IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            found.update((key, (dim, codec, row)) for key, dim, codec, row in rows)
+        return found
+
+    def get_many(self, texts: List[str], model_name: str) -> tuple[Optional[np.ndarray], List[int]]:
         """
-        Salva embedding no cache.
+        Recupera embeddings de vários textos em uma leitura vetorizada.
 
+        Consulta primeiro a camada em memória; chaves restantes são lidas
+        do disco de uma vez (uma leitura por formato), decodificadas para
+        float32 e promovidas para a memória.
+
+        Retorna (vetores, faltantes): vetores é array float32 (n x dimensao)
+        com linhas zeradas nos textos ausentes (None se nenhum estiver em
+        cache); faltantes são as posições sem embedding em cache.
         """
-        hash_key = self._get_hash(text, model_name)
-        cache_file = self.cache_dir / f"{hash_key}.pkl"
+        keys = [self._get_hash(text, model_name) for text in texts]
+        with self._shared():
+            in_memory = {}
+            pending = []
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    pending.append(i)
+                else:
+                    in_memory[i] = vector
 
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump(embedding, f)
-
-            # Atualiza metadata
-            self.metadata["entries"][hash_key] = {
-                "model": model_name,
-                "text_length": len(text),
-                "embedding_shape": embedding.shape
-            }
-            self._save_metadata()
+            found = self._lookup([keys[i] for i in pending]) if pending else {}
+            on_disk = [i for i in pending if keys[i] in found]
+            missing = [i for i in pending if keys[i] not in found]
 
-        except Exception as e:
-            print(f"Erro ao salvar cache {hash_key}: {e}")
+            self.disk_hits += len(on_disk)
+            self.disk_misses += len(missing)
+            self.hits += len(in_memory) + len(on_disk)
+            self.misses += len(missing)
+            if not in_memory and not on_disk:
+                return None, missing
 
-    def get_batch(self, texts: List[str], model_name: str) -> tuple[List[Optional[np.ndarray]], List[int]]:
+            dims = {found[keys[i]][0] for i in on_disk} | {v.shape[0] for v in in_memory.values()}
+            if len(dims) > 1:
+                raise ValueError(f"Modelo {model_name} com dimensoes diferentes no cache: {sorted(dims)}")
+            dim = dims.pop()
+
+            vectors = np.zeros((len(keys), dim), dtype=np.float32)
+            if in_memory:
+                vectors[list(in_memory)] = np.stack(list(in_memory.values()))
+            if on_disk:
+                groups = {}
+                for i in on_disk:
+                    _, codec, row = found[keys[i]]
+                    positions, rows = groups.setdefault(codec, ([], []))
+                    positions.append(i)
+                    rows.append(row)
+                for codec, (positions, rows) in groups.items():
+                    vectors[positions] = self._read(dim, codec, np.asarray(rows, dtype=np.int64))
+                for i in on_disk:
+                    self._memory.put(keys[i], vectors[i])
+
+            self._touch([keys[i] for i in in_memory] + [keys[i] for i in on_disk])
+        return vectors, missing
+
+    def _touch(self, keys):
+        """Registra acessos (gravados no índice em lote, ver _flush_access)."""
+        now = time.time()
+        for key in keys:
+            count, _ = self._pending_access.get(key, (0, 0))
+            self._pending_access[key] = (count + 1, now)
+        if len(self._pending_access) >= _ACCESS_FLUSH:
+            self._flush_access()
+
+    def _flush_access(self):
+        """Grava acessos pendentes (ultimo_acesso/acessos) no índice."""
+        if not self._pending_access:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE entrada SET acessos = acessos + ?, ultimo_acesso = ? WHERE chave = ?",
+                ((count, ts, key) for key, (count, ts) in self._pending_access.items())
+            )
+        self._pending_access.clear()
+
+    def put_many(self, texts: List[str], model_name: str, embeddings) -> int:
         """
-        Recupera múltiplos embeddings do cache.
+        Grava embeddings de vários textos (um append e uma transação).
 
+        Textos já presentes em cache (ou repetidos no lote) são ignorados.
+        Retorna quantidade de entradas novas.
         """
-        embeddings = []
-        missing_indices = []
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings[None, :]
+        keys = [self._get_hash(text, model_name) for text in texts]
+
+        with self._exclusive():
+            existing = self._lookup(keys)
+            new = {}
+            for i, key in enumerate(keys):
+                if key not in existing and key not in new:
+                    new[key] = i
+            if not new:
+                return 0
 
-        for i, text in enumerate(texts):
-            emb = self.get(text, model_name)
-            embeddings.append(emb)
-            if emb is None:
-                missing_indices.append(i)
+            positions = list(new.values())
+            added = self._put_rows(
+                list(new), [model_name] * len(positions),
+                [len(texts[i]) for i in positions], embeddings[positions]
+            )
+            for key, i in new.items():
+                self._memory.put(key, embeddings[i])
+            self._maybe_train_pq(embeddings.shape[1])
+            self._enforce_quota()
+            return added
+
+    def _put_rows(self, keys, models, text_lengths, vectors) -> int:
+        """Anexa vetores e grava entradas do índice (chaves já deduplicadas)."""
+        dim = vectors.shape[1]
+        with self._exclusive():
+            codec = self._write_codec(dim)
+            start = self._append(vectors, codec)
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO entrada "
+                    "(chave, dimensao, linha, modelo, tamanho_texto, ultimo_acesso, acessos, codec) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 1, ?)",
+                    ((key, dim, start + i, model, length, now, codec)
+                     for i, (key, model, length) in enumerate(zip(keys, models, text_lengths)))
+                )
+        return len(keys)
+
+    def _disk_bytes(self) -> int:
+        """Bytes ocupados pelas matrizes de vetores."""
+        return sum(path.stat().st_size for _, _, path in self._matrix_files())
 
-        return embeddings, missing_indices
+    def _groups(self) -> dict:
+        """Entradas por (dimensao, codec)."""
+        return {
+            (dim, codec): count for dim, codec, count in
+            self._conn.execute("SELECT dimensao, codec, COUNT(*) FROM entrada GROUP BY dimensao, codec")
+        }
+
+    def _enforce_quota(self) -> int:
+        """
+        Remove entradas pela política de eviction se as matrizes passarem
+        da cota de disco, até _EVICTION_TARGET da cota, e compacta.
+
+        Retorna quantidade de entradas removidas.
+        """
+        if self.disk_quota <= 0:
+            return 0
+        total = self._disk_bytes()
+        if total <= self.disk_quota:
+            return 0
+
+        self._flush_access()
+        # Linhas órfãs já liberam espaço na compactação
+        groups = self._groups()
+        row_bytes = {group: self._row_bytes(*group) for group in groups}
+        referenced = sum(count * row_bytes[group] for group, count in groups.items())
+        to_free = referenced - int(self.disk_quota * _EVICTION_TARGET)
+
+        victims = []
+        freed = 0
+        if to_free > 0:
+            order = _EVICTION_ORDER[self.eviction]
+            for key, dim, codec in self._conn.execute(
+                f"SELECT chave, dimensao, codec FROM entrada ORDER BY {order}"
+            ):
+                victims.append(key)
+                freed += row_bytes[(dim, codec)]
+                if freed >= to_free:
+                    break
+
+        with self._conn:
+            self._conn.executemany("DELETE FROM entrada WHERE chave = ?", ((key,) for key in victims))
+        self.disk_evictions += len(victims)
+        self.compact()
+        return len(victims)
+
+    # === API por texto (compatível com o cache anterior) ===
+
+    def get(self, text: str, model_name: str) -> Optional[np.ndarray]:
+        """
+        Recupera embedding do cache se existir.
+
+        """
+        vectors, missing = self.get_many([text], model_name)
+        return None if missing else vectors[0]
+
+    def set(self, text: str, model_name: str, embedding: np.ndarray):
+        """
+        Salva embedding no cache.
+
+        """
+        self.put_many([text], model_name, embedding)
+
+    def get_batch(self, texts: List[str], model_name: str) -> tuple[List[Optional[np.ndarray]], List[int]]:
+        """
+        Recupera múltiplos embeddings do cache.
+
+        """
+        vectors, missing = self.get_many(texts, model_name)
+        missing_set = set(missing)
+        embeddings = [
+            None if i in missing_set else vectors[i]
+            for i in range(len(texts))
+        ]
+        return embeddings, missing
 
     def set_batch(self, texts: List[str], model_name: str, embeddings: List[np.ndarray], show_progress: bool = True):
         """
         Salva múltiplos embeddings no cache de forma otimizada.
 
         """
+        added = self.put_many(texts, model_name, embeddings)
         if show_progress:
-            print(f"Salvando {len(texts)} embeddings no cache...")
+            print(f"✓ Cache atualizado com {added} novos embeddings")
 
-        for idx, (text, emb) in enumerate(zip(texts, embeddings)):
-            # Salva embedding sem atualizar metadata a cada vez 
-            hash_key = self._get_hash(text, model_name)
-            cache_file = self.cache_dir / f"{hash_key}.pkl"
+    # === Manutenção ===
 
-            try:
-                with open(cache_file, 'wb') as f:
-                    pickle.dump(emb, f)
+    def import_pickle_cache(self, source_dir=None, chunk_size: int = 10000, remove: bool = False) -> int:
+        """
+        Importa cache antigo (um .pkl por texto + metadata.json).
 
-                # Atualiza metadata em memória
-                self.metadata["entries"][hash_key] = {
-                    "model": model_name,
-                    "text_length": len(text),
-                    "embedding_shape": emb.shape
-                }
+        As chaves (hash de modelo + texto) são preservadas, então entradas
+        importadas continuam sendo encontradas pelos mesmos textos. Arquivos
+        sem entrada no metadata são importados com modelo 'desconhecido'.
+        Com remove=True, apaga .pkl e metadata.json importados.
 
-            except Exception as e:
-                print(f"Erro ao salvar cache {hash_key}: {e}")
+        Retorna quantidade de entradas importadas.
+        """
+        import json
+        import pickle
 
-            # Mostra progresso a cada 10000
-            if show_progress and ((idx + 1) % 10000 == 0 or (idx + 1) == len(texts)):
-                print(f"  Salvos: {idx + 1}/{len(texts)} ({(idx+1)/len(texts)*100:.1f}%)")
+        source = Path(source_dir) if source_dir else self.cache_dir
+        metadata_file = source / "metadata.json"
+        entries = {}
+        if metadata_file.exists():
+            with open(metadata_file, 'r') as f:
+                entries = json.load(f).get("entries", {})
 
-        # Salva metadata apenas uma vez no final 
-        self._save_metadata()
-        if show_progress:
-            print(f"✓ Cache atualizado com {len(texts)} novos embeddings")
+        files = sorted(source.glob("*.pkl"))
+        imported = 0
+        for start in range(0, len(files), chunk_size):
+            batch = {}
+            for path in files[start:start + chunk_size]:
+                try:
+                    with open(path, 'rb') as f:
+                        vector = np.asarray(pickle.load(f), dtype=np.float32).ravel()
+                except Exception as e:
+                    print(f"  Ignorado {path.name}: {e}")
+                    continue
+                batch.setdefault(len(vector), []).append((path.stem, vector))
+
+            with self._exclusive():
+                for dim, items in batch.items():
+                    existing = self._lookup([key for key, _ in items])
+                    items = [(key, vec) for key, vec in items if key not in existing]
+                    if not items:
+                        continue
+                    meta = [entries.get(key, {}) for key, _ in items]
+                    imported += self._put_rows(
+                        [key for key, _ in items],
+                        [m.get("model", "desconhecido") for m in meta],
+                        [m.get("text_length", 0) for m in meta],
+                        np.vstack([vec for _, vec in items])
+                    )
+            print(f"  Importados: {min(start + chunk_size, len(files))}/{len(files)} arquivos")
+
+        with self._exclusive():
+            for dim in {dim for dim, _ in self._groups()}:
+                self._maybe_train_pq(dim)
+            self._enforce_quota()
+
+        if remove:
+            for path in files:
+                path.unlink(missing_ok=True)
+            metadata_file.unlink(missing_ok=True)
+        return imported
+
+    def compact(self) -> int:
+        """
+        Regrava matrizes apenas com linhas referenciadas pelo índice
+        (recupera espaço de entradas removidas e de gravações interrompidas).
+
+        Retorna quantidade de linhas descartadas.
+        """
+        dropped = 0
+        with self._exclusive():
+            groups = self._groups()
+            for dim, codec, path in list(self._matrix_files()):
+                if (dim, codec) not in groups:
+                    dropped += self._row_count(dim, codec)
+                    self._matrices.pop((dim, codec), None)
+                    path.unlink()
+
+            for dim, codec in groups:
+                keys, rows = zip(*self._conn.execute(
+                    "SELECT chave, linha FROM entrada WHERE dimensao = ? AND codec = ? ORDER BY linha",
+                    (dim, codec)
+                ))
+                total = self._row_count(dim, codec)
+                if len(rows) == total:
+                    continue
+
+                path = self._matrix_file(dim, codec)
+                tmp = path.with_suffix('.tmp')
+                with open(tmp, 'wb') as f:
+                    matrix = self._matrix(dim, codec)
+                    for i in range(0, len(rows), _REWRITE_CHUNK):
+                        f.write(np.ascontiguousarray(matrix[list(rows[i:i + _REWRITE_CHUNK])]).tobytes())
+                self._matrices.pop((dim, codec), None)
+                del matrix
+
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE entrada SET linha = ? WHERE chave = ?",
+                        ((new_row, key) for new_row, key in enumerate(keys))
+                    )
+                    os.replace(tmp, path)
+                dropped += total - len(rows)
+        return dropped
+
+    def _convert_group(self, dim: int, source: str, target: str) -> int:
+        """Regrava entradas de (dim, source) no formato target."""
+        keys, rows = zip(*self._conn.execute(
+            "SELECT chave, linha FROM entrada WHERE dimensao = ? AND codec = ? ORDER BY linha",
+            (dim, source)
+        ))
+        for i in range(0, len(keys), _REWRITE_CHUNK):
+            chunk_keys = keys[i:i + _REWRITE_CHUNK]
+            vectors = self._read(dim, source, np.asarray(rows[i:i + _REWRITE_CHUNK], dtype=np.int64))
+            start = self._append(vectors, target)
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE entrada SET codec = ?, linha = ? WHERE chave = ?",
+                    ((target, start + j, key) for j, key in enumerate(chunk_keys))
+                )
+        return len(keys)
+
+    def convert(self, codec: str = None) -> int:
+        """
+        Regrava entradas gravadas em outro formato no formato codec
+        (padrão: o formato do cache) e compacta.
+
+        Para 'pq', dimensões sem codebook treinado ficam em float16.
+        Retorna quantidade de entradas convertidas.
+        """
+        codec = codec or self.codec
+        if codec not in CODECS:
+            raise ValueError(f"Formato de cache invalido: {codec} (use {', '.join(CODECS)})")
+
+        converted = 0
+        with self._exclusive():
+            for dim, source in self._groups():
+                target = codec
+                if target == 'pq' and self._codebook(dim) is None:
+                    target = 'float16'
+                if source != target:
+                    converted += self._convert_group(dim, source, target)
+            self.compact()
+        return converted
+
+    def train_pq(self, dim: int, sample_size: int = None, subvectors: int = None, seed: int = 0):
+        """
+        Treina codebook PQ da dimensão com amostra do próprio cache.
+
+        Entradas já quantizadas com codebook anterior são regravadas em
+        float16 antes da troca; se o formato do cache for 'pq', todas as
+        entradas da dimensão são então quantizadas.
+
+        Retorna codebook (subvetores x centroides x dim/subvetores).
+        """
+        sample_size = sample_size or EMBEDDING_CACHE_PQ_TRAIN_SIZE
+        with self._exclusive():
+            entries = self._conn.execute(
+                "SELECT codec, linha FROM entrada WHERE dimensao = ?", (dim,)
+            ).fetchall()
+            if not entries:
+                raise ValueError(f"Nenhum vetor de dimensao {dim} no cache para treinar PQ")
+
+            rng = np.random.default_rng(seed)
+            sample = [entries[i] for i in rng.choice(len(entries), min(sample_size, len(entries)), replace=False)]
+            groups = {}
+            for codec, row in sample:
+                groups.setdefault(codec, []).append(row)
+            vectors = np.vstack([
+                self._read(dim, codec, np.sort(np.asarray(rows, dtype=np.int64)))
+                for codec, rows in groups.items()
+            ])
+
+            t0 = time.time()
+            codebook = train_pq(vectors, subvectors, seed=seed)
+            print(f"Codebook PQ {dim}d treinado com {len(vectors)} vetores: "
+                  f"{codebook.shape[0]} bytes por vetor ({time.time()-t0:.1f}s)")
+
+            if (dim, 'pq') in self._groups():
+                self._convert_group(dim, 'pq', 'float16')
+
+            path = self._codebook_file(dim)
+            tmp = path.with_suffix('.tmp.npy')
+            np.save(tmp, codebook)
+            os.replace(tmp, path)
+            self._codebooks.pop(dim, None)
+            self._matrices.pop((dim, 'pq'), None)
+
+            if self.codec == 'pq':
+                self.convert()
+            else:
+                self.compact()
+        return codebook
+
+    def _maybe_train_pq(self, dim: int):
+        """Treina PQ automaticamente quando a dimensão atinge EMBEDDING_CACHE_PQ_TRAIN_SIZE."""
+        if self.codec != 'pq' or self._codebook(dim) is not None:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM entrada WHERE dimensao = ?", (dim,)).fetchone()[0]
+        if count >= EMBEDDING_CACHE_PQ_TRAIN_SIZE:
+            self.train_pq(dim)
+
+    def reconstruction_check(self, vectors, codec: str = None) -> dict:
+        """
+        Erro de reconstrução de vetores originais no formato codec
+        (padrão: formato do cache; 'pq' usa o codebook da dimensão).
+
+        Retorna bytes por vetor, erro relativo médio (||x - x'|| / ||x||)
+        e cosseno médio entre original e reconstruído.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        dim = vectors.shape[1]
+        codec = codec or self.codec
+        if codec == 'pq' and self._codebook(dim) is None:
+            codec = 'float16'
+
+        codebook = self._codebook(dim)
+        decoded = decode_vectors(encode_vectors(vectors, codec, codebook), codec, codebook)
+        norms = np.linalg.norm(vectors, axis=1)
+        error = np.linalg.norm(vectors - decoded, axis=1) / np.maximum(norms, 1e-12)
+        cosine = np.einsum('ij,ij->i', vectors, decoded) / np.maximum(
+            norms * np.linalg.norm(decoded, axis=1), 1e-12
+        )
+        return {
+            "codec": codec,
+            "bytes_per_vector": bytes_per_vector(dim, codec, codebook),
+            "relative_error": float(error.mean()),
+            "cosine": float(cosine.mean())
+        }
 
     def clear(self, model_name: Optional[str] = None):
         """
@@ -155,51 +838,113 @@ class EmbeddingCache:
 
         """
         if model_name is None:
-            # Limpa tudo
-            import shutil
-            if self.cache_dir.exists():
-                shutil.rmtree(self.cache_dir)
-            self.cache_dir.mkdir(parents=True, exist_ok=True)
-            self.metadata = {"version": "1.0", "entries": {}}
-            self._save_metadata()
+            # Limpa tudo (mantém a trava: outros processos podem estar esperando)
+            with self._exclusive():
+                self._conn.close()
+                self._matrices.clear()
+                self._codebooks.clear()
+                self._memory.clear()
+                self._pending_access.clear()
+                for path in self.cache_dir.iterdir():
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    elif path.name != LOCK_FILE:
+                        path.unlink()
+                self._conn = self._connect()
             print("Cache completo limpo")
         else:
-            # Limpa apenas modelo específico
-            entries_to_remove = []
-            for hash_key, meta in self.metadata["entries"].items():
-                if meta["model"] == model_name:
-                    cache_file = self.cache_dir / f"{hash_key}.pkl"
-                    if cache_file.exists():
-                        cache_file.unlink()
-                    entries_to_remove.append(hash_key)
-
-            for hash_key in entries_to_remove:
-                del self.metadata["entries"][hash_key]
-
-            self._save_metadata()
-            print(f"Cache do modelo {model_name} limpo ({len(entries_to_remove)} entries)")
+            # Limpa apenas modelo específico (espaço liberado em compact)
+            with self._exclusive(), self._conn:
+                removed = self._conn.execute("DELETE FROM entrada WHERE modelo = ?", (model_name,)).rowcount
+                # Chaves da memória não indicam o modelo
+                self._memory.clear()
+            self.compact()
+            print(f"Cache do modelo {model_name} limpo ({removed} entries)")
 
     def get_stats(self) -> dict:
         """
         Retorna estatísticas do cache.
 
+        hits/misses somam as duas camadas; 'memoria' e 'disco' trazem
+        contadores de hit/miss/remoção de cada camada.
         """
-        total_entries = len(self.metadata["entries"])
+        with self._lock:
+            self._flush_access()
+            per_model = dict(self._conn.execute("SELECT modelo, COUNT(*) FROM entrada GROUP BY modelo"))
+            formats = {}
+            for (dim, codec), count in self._groups().items():
+                entry = formats.setdefault(codec, {"entries": 0, "bytes": 0})
+                entry["entries"] += count
+                entry["bytes"] += count * self._row_bytes(dim, codec)
+            for entry in formats.values():
+                entry["bytes_per_vector"] = entry.pop("bytes") / entry["entries"]
+            disk_bytes = self._disk_bytes()
+            memory = {
+                "entries": len(self._memory),
+                "size_mb": self._memory.bytes / (1024 * 1024),
+                "limit_mb": self._memory.max_bytes / (1024 * 1024),
+                "hits": self._memory.hits,
+                "misses": self._memory.misses,
+                "evictions": self._memory.evictions
+            }
         cache_size_mb = sum(
-            f.stat().st_size for f in self.cache_dir.glob("*.pkl")
+            f.stat().st_size for f in self.cache_dir.iterdir() if f.is_file()
         ) / (1024 * 1024)
 
         hit_rate = self.hits / (self.hits + self.misses) * 100 if (self.hits + self.misses) > 0 else 0
 
         return {
-            "total_entries": total_entries,
+            "total_entries": sum(per_model.values()),
             "cache_size_mb": cache_size_mb,
             "hits": self.hits,
             "misses": self.misses,
             "hit_rate": hit_rate,
-            "models": list(set(m["model"] for m in self.metadata["entries"].values()))
+            "models": list(per_model),
+            "entries_per_model": per_model,
+            "codec": self.codec,
+            "formats": formats,
+            "bytes_per_vector": disk_bytes / sum(per_model.values()) if per_model else 0,
+            "memoria": memory,
+            "disco": {
+                "entries": sum(per_model.values()),
+                "size_mb": disk_bytes / (1024 * 1024),
+                "limit_mb": self.disk_quota / (1024 * 1024),
+                "policy": self.eviction,
+                "hits": self.disk_hits,
+                "misses": self.disk_misses,
+                "evictions": self.disk_evictions
+            }
         }
 
+    def describe(self) -> List[dict]:
+        """
+        Estado de cada matriz de vetores (uma por dimensão e formato) para
+        diagnóstico de integridade.
+
+        Cada item traz dim, codec, rows (linhas completas no arquivo),
+        referenced (entradas do índice que apontam para a matriz), max_row
+        (maior linha referenciada), has_codebook (PQ treinado) e
+        bytes_per_vector (None em PQ sem codebook).
+        """
+        with self._shared():
+            groups = self._conn.execute(
+                "SELECT dimensao, codec, COUNT(*), MAX(linha) FROM entrada GROUP BY dimensao, codec"
+            ).fetchall()
+            matrices = []
+            for dim, codec, count, max_row in groups:
+                has_codebook = self._codebook(dim) is not None
+                readable = codec != 'pq' or has_codebook
+                matrices.append({
+                    "dim": dim,
+                    "codec": codec,
+                    "rows": self._row_count(dim, codec) if readable else 0,
+                    "referenced": count,
+                    "max_row": max_row,
+                    "has_codebook": has_codebook,
+                    "bytes_per_vector": self._row_bytes(dim, codec) if readable else None
+                })
+        return matrices
+
     def print_stats(self):
         """Imprime estatísticas do cache"""
         stats = self.get_stats()
@@ -211,15 +956,26 @@ class EmbeddingCache:
         print(f"Hits: {stats['hits']}")
         print(f"Misses: {stats['misses']}")
         print(f"Taxa de acerto: {stats['hit_rate']:.1f}%")
+        print(f"Formato: {stats['codec']} | {stats['bytes_per_vector']:.0f} bytes por vetor em disco")
+        for codec, entry in stats['formats'].items():
+            print(f"  - {codec}: {entry['entries']} vetores, {entry['bytes_per_vector']:.0f} bytes/vetor")
+        for name, tier in (("Memória", stats['memoria']), ("Disco", stats['disco'])):
+            limit = f"{tier['limit_mb']:.1f} MB" if tier['limit_mb'] > 0 else "sem limite"
+            print(f"{name}: {tier['entries']} entradas, {tier['size_mb']:.2f} MB (limite {limit}) | "
+                  f"hits {tier['hits']}, misses {tier['misses']}, removidas {tier['evictions']}")
         print(f"Modelos em cache: {len(stats['models'])}")
-        for model in stats['models']:
-            model_entries = sum(
-                1 for m in self.metadata["entries"].values()
-                if m["model"] == model
-            )
+        for model, model_entries in stats['entries_per_model'].items():
             print(f"  - {model}: {model_entries} embeddings")
         print(f"{'='*50}\n")
 
+    def close(self):
+        """Grava acessos pendentes e fecha índice e matrizes mapeadas."""
+        with self._lock:
+            self._flush_access()
+            self._matrices.clear()
+            self._memory.clear()
+            self._conn.close()
+
 
 # Função auxiliar para uso no benchmark
 def encode_with_cache(embedder, texts: List[str], cache: EmbeddingCache, batch_size: int = 32):
@@ -230,42 +986,33 @@ def encode_with_cache(embedder, texts: List[str], cache: EmbeddingCache, batch_s
     model_name = embedder._model_card_data.model_name if hasattr(embedder, '_model_card_data') else str(embedder)
 
     # Tenta recuperar do cache
-    cached_embeddings, missing_indices = cache.get_batch(texts, model_name)
+    cached, missing_indices = cache.get_many(texts, model_name)
 
     # Se todos estão em cache, retorna
     if not missing_indices:
         print(f"✓ Todos os {len(texts)} embeddings recuperados do cache")
-        return [emb.tolist() for emb in cached_embeddings]
+        return cached.tolist()
 
     print(f"Cache: {len(texts) - len(missing_indices)}/{len(texts)} encontrados")
 
     # Calcula apenas os faltantes
     missing_texts = [texts[i] for i in missing_indices]
-    new_embeddings = embedder.encode(missing_texts, batch_size=batch_size)
+    new_embeddings = np.asarray(embedder.encode(missing_texts, batch_size=batch_size), dtype=np.float32)
 
     # Atualiza cache com novos embeddings
     cache.set_batch(missing_texts, model_name, new_embeddings)
 
     # Mescla resultados
-    result = []
-    new_emb_idx = 0
-    for i, cached_emb in enumerate(cached_embeddings):
-        if cached_emb is None:
-            result.append(new_embeddings[new_emb_idx].tolist())
-            new_emb_idx += 1
-        else:
-            result.append(cached_emb.tolist())
-
-    return result
+    if cached is None:
+        return new_embeddings.tolist()
+    cached[missing_indices] = new_embeddings
+    return cached.tolist()
 
 
 if __name__ == "__main__":
     # Teste do cache
     cache = EmbeddingCache()
 
-    # Simula alguns embeddings
-    import numpy as np
-
     texts = ["café torrado", "soja em grãos", "telefone celular"]
     model = "test-model"
 
@@ -277,16 +1024,14 @@ if __name__ == "__main__":
         print(f"  {text}: {'HIT' if emb is not None else 'MISS'}")
 
     # Salva embeddings
-    for text in texts:
-        fake_emb = np.random.rand(384)
-        cache.set(text, model, fake_emb)
+    cache.put_many(texts, model, np.random.rand(len(texts), 384))
 
     print("\nApós salvar embeddings:")
 
-    # Segunda vez - deve dar hit
-    for text in texts:
-        emb = cache.get(text, model)
-        print(f"  {text}: {'HIT' if emb is not None else 'MISS'}")
+    # Segunda vez - deve dar hit (uma leitura vetorizada)
+    vectors, missing = cache.get_many(texts, model)
+    for i, text in enumerate(texts):
+        print(f"  {text}: {'MISS' if i in missing else 'HIT'}")
 
     # Estatísticas
     cache.print_stats()
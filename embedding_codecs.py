@@ -0,0 +1,118 @@
+# embedding_codecs.py
+# Formatos compactos de armazenamento de embeddings (float16, quantizacao por produto)
+
+import numpy as np
+
+from config import EMBEDDING_CACHE_PQ_SUBVECTORS
+
+# Formato -> sufixo do arquivo de matriz no cache
+CODECS = {
+    'float32': 'f32',
+    'float16': 'f16',
+    'pq': 'pq',
+}
+
+# Centroides por subespaco na quantizacao por produto (codigo de 1 byte)
+PQ_CENTROIDS = 256
+
+
+def pq_subvectors(dim, subvectors=None):
+    """
+    Quantidade de subvetores para a dimensao: maior divisor de dim que
+    nao passa de subvectors (EMBEDDING_CACHE_PQ_SUBVECTORS).
+    """
+    subvectors = min(subvectors or EMBEDDING_CACHE_PQ_SUBVECTORS, dim)
+    while dim % subvectors:
+        subvectors -= 1
+    return subvectors
+
+
+def train_pq(vectors, subvectors=None, iterations=20, seed=0):
+    """
+    Treina codebook de quantizacao por produto (k-means por subespaco).
+
+    Cada vetor e dividido em subvectors partes de dim/subvectors
+    dimensoes; em cada subespaco, k-means com PQ_CENTROIDS centroides.
+    Um vetor passa a ocupar subvectors bytes (indice do centroide mais
+    proximo em cada subespaco).
+
+    Retorna codebook float32 (subvectors x centroides x dim/subvectors).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    m = pq_subvectors(dim, subvectors)
+    dsub = dim // m
+    k = min(PQ_CENTROIDS, n)
+    rng = np.random.default_rng(seed)
+
+    codebook = np.zeros((m, PQ_CENTROIDS, dsub), dtype=np.float32)
+    for j in range(m):
+        x = vectors[:, j * dsub:(j + 1) * dsub]
+        centroids = x[rng.choice(n, k, replace=False)].copy()
+        for _ in range(iterations):
+            assign = _nearest(x, centroids)
+            counts = np.bincount(assign, minlength=k)
+            sums = np.stack([np.bincount(assign, weights=x[:, d], minlength=k) for d in range(dsub)], axis=1)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Centroide sem pontos recomeca em ponto aleatorio
+            if empty.any():
+                centroids[empty] = x[rng.choice(n, int(empty.sum()), replace=False)]
+        codebook[j, :k] = centroids
+        # Com menos de PQ_CENTROIDS vetores, sobras repetem o primeiro centroide
+        codebook[j, k:] = centroids[0]
+    return codebook
+
+
+def _nearest(x, centroids, chunk_size=16384):
+    """Indice do centroide mais proximo (distancia euclidiana) de cada linha."""
+    c_norms = np.einsum('ij,ij->i', centroids, centroids)
+    result = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        block = x[start:start + chunk_size]
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 (||x||^2 nao muda o argmin)
+        result[start:start + chunk_size] = np.argmin(c_norms - 2 * block @ centroids.T, axis=1)
+    return result
+
+
+def encode_vectors(vectors, codec, codebook=None):
+    """
+    Converte vetores float32 para o formato de armazenamento.
+
+    Retorna array float32 / float16 (n x dim) ou uint8 (n x subvetores) para 'pq'.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if codec == 'float32':
+        return vectors
+    if codec == 'float16':
+        return vectors.astype(np.float16)
+    if codec == 'pq':
+        m, _, dsub = codebook.shape
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = _nearest(vectors[:, j * dsub:(j + 1) * dsub], codebook[j])
+        return codes
+    raise ValueError(f"Formato de embedding invalido: {codec} (use {', '.join(CODECS)})")
+
+
+def decode_vectors(data, codec, codebook=None):
+    """Inverso de encode_vectors: retorna array float32 (n x dim)."""
+    if codec == 'pq':
+        m, _, dsub = codebook.shape
+        data = np.asarray(data)
+        # codebook[j, codes[:, j]] para cada subespaco, concatenado
+        return codebook[np.arange(m), data].reshape(len(data), m * dsub)
+    return np.asarray(data, dtype=np.float32)
+
+
+def row_format(dim, codec, codebook=None):
+    """(dtype, largura) de uma linha da matriz no formato."""
+    if codec == 'pq':
+        return np.uint8, codebook.shape[0]
+    return (np.float16 if codec == 'float16' else np.float32), dim
+
+
+def bytes_per_vector(dim, codec, codebook=None):
+    """Bytes ocupados por um vetor no formato."""
+    dtype, width = row_format(dim, codec, codebook)
+    return np.dtype(dtype).itemsize * width
@@ -0,0 +1,271 @@
+# embedding_pool.py
+# Pool de processos para vetorizacao do corpus em multiplos nucleos de CPU
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from config import (
+    EMBEDDING_WORKERS, EMBEDDING_THREADS_PER_WORKER, EMBEDDING_PIN_THREADS,
+    EMBEDDING_POOL_CHUNK, EMBEDDING_POOL_MIN_DOCS
+)
+
+
+def _available_cpus():
+    """Nucleos disponiveis para o processo (respeita afinidade/cgroups)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def resolve_workers(workers=None, threads_per_worker=None):
+    """
+    Resolve quantidade de processos e threads por processo.
+
+    workers=None usa EMBEDDING_WORKERS; threads_per_worker 0/None divide
+    os nucleos disponiveis igualmente entre os processos.
+
+    Retorna tupla (workers, threads_per_worker).
+    """
+    workers = EMBEDDING_WORKERS if workers is None else workers
+    threads_per_worker = threads_per_worker or EMBEDDING_THREADS_PER_WORKER
+    cpus = len(_available_cpus())
+
+    workers = max(1, min(workers, cpus))
+    if not threads_per_worker:
+        threads_per_worker = max(1, cpus // workers)
+    return workers, threads_per_worker
+
+
+def _init_worker(counter, threads, pin, cpus):
+    """
+    Inicializa processo do pool: limita threads do torch, fixa nucleos
+    (opcional) e carrega o modelo uma vez.
+
+    Cada processo recebe um indice unico via counter e, com pin=True,
+    fica restrito ao bloco de nucleos cpus[indice*threads:(indice+1)*threads].
+    """
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+
+    if pin and hasattr(os, 'sched_setaffinity'):
+        cores = cpus[index * threads:(index + 1) * threads]
+        if cores:
+            os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(threads)
+
+    from embeddings import get_embedder
+    get_embedder()
+
+
+def _ready():
+    """Tarefa vazia: confirma que o processo inicializou (modelo carregado)."""
+    return os.getpid()
+
+
+def _encode_chunk(texts):
+    """Vetoriza um bloco de textos no processo do pool."""
+    from embeddings import encode_array_local
+    return encode_array_local(texts, show_progress=False)
+
+
+class EncodingJob:
+    """
+    Vetorizacao de um lote em andamento no pool (ver EncodingPool.submit).
+
+    Guarda o resultado da consulta ao cache e os blocos enviados aos
+    processos; result() espera os blocos, grava os vetores novos no
+    cache e devolve o lote completo.
+    """
+
+    def __init__(self, pool, texts, vectors, missing, chunks, futures):
+        self.pool = pool
+        self.texts = texts
+        self.vectors = vectors
+        self.missing = missing
+        self.chunks = chunks
+        self.futures = futures
+
+    def result(self):
+        """Espera a vetorizacao. Retorna numpy array float32 (n_textos x dimensao)."""
+        from embeddings import cache_store
+
+        if not self.texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if not self.missing:
+            return self.vectors
+        blocks = self.pool._collect(self.chunks, self.futures)
+        return cache_store(self.texts, self.vectors, self.missing, np.vstack(blocks))
+
+
+class EncodingPool:
+    """
+    Pool de processos de vetorizacao, cada um com sua copia do modelo.
+
+    Cada lote e dividido em blocos de ate EMBEDDING_POOL_CHUNK textos,
+    reduzidos para que todos os processos recebam trabalho (ver
+    _chunk_size), e reunidos na ordem original. submit() nao espera o
+    resultado: o chamador pode enviar o proximo lote enquanto o atual e
+    vetorizado. Dentro de cada bloco, encode_array_local agrupa textos
+    por comprimento.
+
+    Processos usam start method 'spawn' (sem herdar estado do torch do
+    processo pai) e ficam vivos entre chamadas de encode; use close() ou
+    o pool como context manager ao terminar.
+
+    Falhas: start() espera cada processo carregar o modelo e levanta a
+    excecao se a inicializacao falhar. Processo encerrado durante o
+    trabalho (ex.: falta de memoria) torna o pool inutilizavel
+    (BrokenProcessPool); o pool e descartado e os blocos pendentes e
+    lotes seguintes sao vetorizados no processo atual.
+
+    Memoria: cada processo carrega o modelo completo (~1 GB para
+    multilingual-e5-base em FP32).
+    """
+
+    def __init__(self, workers=None, threads_per_worker=None, pin_threads=None,
+                 chunk_size=None):
+        self.workers, self.threads_per_worker = resolve_workers(workers, threads_per_worker)
+        self.pin_threads = EMBEDDING_PIN_THREADS if pin_threads is None else pin_threads
+        self.chunk_size = chunk_size or EMBEDDING_POOL_CHUNK
+        self._pool = None
+        self._failed = False
+
+    def start(self):
+        """
+        Inicia processos e espera cada um carregar o modelo. Levanta a
+        excecao da inicializacao (ex.: BrokenProcessPool) se algum falhar.
+        """
+        if self._pool is not None or self._failed:
+            return self
+
+        ctx = multiprocessing.get_context('spawn')
+        counter = ctx.Value('i', 0)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(counter, self.threads_per_worker, self.pin_threads, _available_cpus())
+        )
+        try:
+            for future in [self._pool.submit(_ready) for _ in range(self.workers)]:
+                future.result()
+        except BaseException:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            raise
+
+        pin = "com afinidade fixa" if self.pin_threads else "sem afinidade"
+        print(f"Pool de vetorizacao: {self.workers} processos x "
+              f"{self.threads_per_worker} threads ({pin})")
+        return self
+
+    def _chunk_size(self, total):
+        """Textos por bloco: ate chunk_size, dividindo o lote entre todos os processos."""
+        return max(1, min(self.chunk_size, math.ceil(total / self.workers)))
+
+    def _split(self, texts):
+        size = self._chunk_size(len(texts))
+        return [texts[i:i + size] for i in range(0, len(texts), size)]
+
+    def _submit_chunks(self, chunks):
+        """Envia blocos aos processos; None por bloco se o pool falhou."""
+        if self._pool is None:
+            return [None] * len(chunks)
+        return [self._pool.submit(_encode_chunk, chunk) for chunk in chunks]
+
+    def _collect(self, chunks, futures):
+        """
+        Resultados dos blocos na ordem original. Com o pool quebrado,
+        descarta-o e vetoriza no processo atual os blocos sem resultado.
+        """
+        from embeddings import encode_array_local
+
+        blocks = []
+        for chunk, future in zip(chunks, futures):
+            if future is not None:
+                try:
+                    blocks.append(future.result())
+                    continue
+                except BrokenProcessPool as e:
+                    self._discard(e)
+            blocks.append(encode_array_local(chunk, show_progress=False))
+        return blocks
+
+    def _discard(self, error):
+        """Descarta pool quebrado; vetorizacao segue no processo atual."""
+        if self._pool is None:
+            return
+        print(f"Erro no pool de vetorizacao, usando processo atual: {error}")
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self._failed = True
+
+    def submit(self, texts):
+        """
+        Envia lote para vetorizacao sem esperar, consultando antes o cache
+        de embeddings no processo principal (apenas textos ausentes vao
+        para o pool). Retorna EncodingJob; result() devolve o array.
+        """
+        from embeddings import cache_lookup
+
+        texts = list(texts)
+        if texts:
+            self.start()
+        vectors, missing = cache_lookup(texts)
+        chunks = self._split([texts[i] for i in missing]) if missing else []
+        return EncodingJob(self, texts, vectors, missing, chunks, self._submit_chunks(chunks))
+
+    def encode_array(self, texts):
+        """Vetoriza textos nos processos do pool (sem cache). Retorna numpy array float32."""
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        self.start()
+        chunks = self._split(texts)
+        return np.vstack(self._collect(chunks, self._submit_chunks(chunks)))
+
+    def encode_batch(self, texts, show_progress=False):
+        """
+        Mesmo contrato de embeddings.encode_batch: array float32 continuo,
+        consultando o cache de embeddings no processo principal (apenas
+        textos ausentes vao para o pool).
+
+        show_progress e aceito por compatibilidade e ignorado.
+        """
+        return self.submit(texts).result()
+
+    def close(self):
+        """Encerra processos do pool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def should_use_pool(total):
+    """
+    Indica se o corpus justifica o pool de processos.
+
+    Requer EMBEDDING_WORKERS > 1 (modo opcional) e total conhecido com
+    pelo menos EMBEDDING_POOL_MIN_DOCS documentos: abaixo disso o tempo
+    de iniciar processos e carregar copias do modelo nao compensa.
+    """
+    return EMBEDDING_WORKERS > 1 and total is not None and total >= EMBEDDING_POOL_MIN_DOCS
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# embedding_server.py
+# Servidor local de embeddings compartilhado entre CLI, menu, Gradio e diagnosticos
+
+"""
+SERVIDOR DE EMBEDDINGS
+
+Mantem um unico modelo carregado por maquina. Processos clientes
+(embeddings.encode_text / encode_batch) enviam textos por HTTP local e
+recebem vetores float32; se o servidor nao estiver rodando, cada
+processo carrega o proprio modelo como antes.
+
+Uso:
+    python embedding_server.py                  # porta de EMBEDDING_SERVER_URL
+    python embedding_server.py --port 8765
+
+Endpoints:
+    GET  /health   -> JSON com modelo, backend, dimensao e estatisticas
+    POST /encode   -> corpo JSON {"texts": [...]}; resposta com bytes float32
+                      (n x dimensao, ordem C) e cabecalho X-Embedding-Shape
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+
+from config import (
+    EMBEDDING_SERVER_URL, EMBEDDING_SERVER_TIMEOUT,
+    EMBEDDING_SERVER_MAX_BATCH, EMBEDDING_SERVER_BATCH_WAIT_MS
+)
+
+SHAPE_HEADER = 'X-Embedding-Shape'
+
+
+# === Cliente ===
+
+class EmbeddingServerClient:
+    """Cliente HTTP do servidor de embeddings."""
+
+    def __init__(self, url=None, timeout=None):
+        self.url = (url or EMBEDDING_SERVER_URL).rstrip('/')
+        self.timeout = timeout or EMBEDDING_SERVER_TIMEOUT
+
+    def health(self, timeout=None):
+        """Estado do servidor (JSON de /health)."""
+        with urllib.request.urlopen(f"{self.url}/health", timeout=timeout or self.timeout) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+
+    def encode(self, texts):
+        """Vetoriza textos no servidor. Retorna numpy array float32 (n x dimensao)."""
+        body = json.dumps({'texts': list(texts)}, ensure_ascii=False).encode('utf-8')
+        request = urllib.request.Request(
+            f"{self.url}/encode", data=body,
+            headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            rows, dim = (int(v) for v in resp.headers[SHAPE_HEADER].split(','))
+            return np.frombuffer(resp.read(), dtype=np.float32).reshape(rows, dim)
+
+
+_client = None
+_client_checked = False
+
+
+def get_server_client():
+    """
+    Cliente do servidor se disponivel e compativel, senao None.
+
+    Verificado uma vez por processo (health com timeout curto): o
+    servidor precisa usar o mesmo modelo/backend do cliente
+    (embedding_signature), senao os vetores nao seriam comparaveis com
+    o indice. Resultado negativo tambem fica em cache, evitando nova
+    tentativa de conexao a cada consulta.
+    """
+    global _client, _client_checked
+
+    if _client_checked:
+        return _client
+    _client_checked = True
+
+    if not EMBEDDING_SERVER_URL:
+        return None
+
+    from embedding_backends import embedding_signature
+
+    client = EmbeddingServerClient()
+    try:
+        info = client.health(timeout=0.5)
+    except (OSError, ValueError):
+        return None
+
+    if info.get('assinatura') != embedding_signature():
+        print(f"Servidor de embeddings usa outro modelo/backend ({info.get('assinatura')}), "
+              f"carregando modelo local")
+        return None
+
+    print(f"Usando servidor de embeddings em {client.url}")
+    _client = client
+    return _client
+
+
+def disable_server_client():
+    """Desativa cliente apos falha (proximas chamadas usam modelo local)."""
+    global _client, _client_checked
+    _client = None
+    _client_checked = True
+
+
+# === Servidor ===
+
+class _Pending:
+    """Requisicao aguardando vetorizacao no lote."""
+
+    __slots__ = ('texts', 'done', 'result', 'error')
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestBatcher(threading.Thread):
+    """
+    Agrupa requisicoes concorrentes em lotes de vetorizacao.
+
+    Cada thread HTTP chama submit e aguarda. A thread do batcher pega a
+    primeira requisicao da fila, espera ate EMBEDDING_SERVER_BATCH_WAIT_MS
+    por outras (ate EMBEDDING_SERVER_MAX_BATCH textos), vetoriza tudo em
+    uma unica chamada e devolve a fatia de cada requisicao. O modelo e
+    usado por uma thread so.
+    """
+
+    def __init__(self, encode, max_batch=None, wait_ms=None):
+        super().__init__(name="embedding-batcher", daemon=True)
+        self.encode = encode
+        self.max_batch = max_batch or EMBEDDING_SERVER_MAX_BATCH
+        self.wait_s = (EMBEDDING_SERVER_BATCH_WAIT_MS if wait_ms is None else wait_ms) / 1000
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+
+    def submit(self, texts):
+        """Vetoriza textos (bloqueia ate o lote que os contem terminar)."""
+        pending = _Pending(texts)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        """Primeira requisicao + as que chegarem dentro da janela de espera."""
+        batch = [self.queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.perf_counter() + self.wait_s
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += len(pending.texts)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            texts = [t for pending in batch for t in pending.texts]
+            try:
+                vectors = self.encode(texts)
+                start = 0
+                for pending in batch:
+                    end = start + len(pending.texts)
+                    pending.result = vectors[start:end]
+                    start = end
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+
+            self.requests += len(batch)
+            self.batches += 1
+            self.texts += len(texts)
+            for pending in batch:
+                pending.done.set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Rotas /health e /encode."""
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'erro': 'rota inexistente'})
+            return
+        server = self.server
+        self._send_json(200, {
+            'assinatura': server.signature,
+            'dimensao': server.dimension,
+            'iniciado_em': server.started_at,
+            'requisicoes': server.batcher.requests,
+            'lotes': server.batcher.batches,
+            'textos': server.batcher.texts
+        })
+
+    def do_POST(self):
+        if self.path != '/encode':
+            self._send_json(404, {'erro': 'rota inexistente'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            texts = json.loads(self.rfile.read(length).decode('utf-8'))['texts']
+            if not isinstance(texts, list):
+                raise ValueError("'texts' deve ser uma lista")
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {'erro': str(e)})
+            return
+
+        try:
+            vectors = self.server.batcher.submit([str(t) for t in texts]) if texts else \
+                np.empty((0, self.server.dimension), dtype=np.float32)
+        except Exception as e:
+            self._send_json(500, {'erro': str(e)})
+            return
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._send(200, vectors.tobytes(), 'application/octet-stream',
+                   {SHAPE_HEADER: f"{vectors.shape[0]},{vectors.shape[1]}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EmbeddingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer com fila de conexoes maior (clientes concorrentes)."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(host=None, port=None):
+    """Carrega modelo uma vez e atende requisicoes ate Ctrl-C."""
+    from embeddings import get_embedder, encode_array_local
+    from embedding_backends import embedding_signature
+
+    parsed = urlparse(EMBEDDING_SERVER_URL or 'http://127.0.0.1:8765')
+    host = host or parsed.hostname
+    port = port or parsed.port
+
+    embedder = get_embedder()
+    print(f"Modelo: {embedding_signature()}")
+
+    batcher = RequestBatcher(lambda texts: encode_array_local(texts, show_progress=False))
+    batcher.start()
+
+    server = EmbeddingHTTPServer((host, port), _Handler)
+    server.batcher = batcher
+    server.signature = embedding_signature()
+    server.dimension = embedder.get_sentence_embedding_dimension()
+    server.started_at = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    print(f"Servidor de embeddings em http://{host}:{port} (Ctrl-C para encerrar)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nEncerrando servidor...")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Servidor local de embeddings",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--host', type=str, default=None, help='Endereco (default: de EMBEDDING_SERVER_URL)')
+    parser.add_argument('--port', type=int, default=None, help='Porta (default: de EMBEDDING_SERVER_URL)')
+    args = parser.parse_args()
+
+    serve(args.host, args.port)
@@ -1,28 +1,129 @@
 # embeddings.py
 # Vetorizacao de texto usando sentence transformers
 
-from sentence_transformers import SentenceTransformer
-from config import EMBEDDING_MODEL
+import contextlib
+import time
+
+import numpy as np
+from embedding_backends import load_embedder, describe_source, embedding_signature
+from config import (
+    EMBEDDING_TOKEN_BUDGET, EMBEDDING_MAX_BATCH, USE_EMBEDDING_CACHE, DISABLE_NORMALIZATION
+)
 from tqdm import tqdm
 
 _embedder = None
+_cache = None
+# Blocos embedding_cache_disabled ativos (cache ignorado enquanto > 0)
+_cache_disabled = 0
 
 
 def get_embedder():
     """
     Retorna instancia singleton do modelo de embedding.
 
-    Carrega modelo especificado em EMBEDDING_MODEL apenas na primeira
+    Carrega modelo especificado em EMBEDDING_MODEL, com o backend de
+    EMBEDDING_BACKEND (ver embedding_backends), apenas na primeira
     chamada. Chamadas subsequentes retornam mesma instancia para
     economizar memoria e tempo de carregamento.
 
     Modelo carregado fica em memoria durante toda execucao do programa.
+    O tempo de carga e a origem (snapshot local ou Hub) sao exibidos.
     """
     global _embedder
     if _embedder is None:
-        _embedder = SentenceTransformer(EMBEDDING_MODEL)
+        t0 = time.perf_counter()
+        _embedder = load_embedder()
+        print(f"Modelo de embedding carregado em {time.perf_counter()-t0:.1f}s ({describe_source()})")
     return _embedder
 
+def get_embedding_cache():
+    """
+    Retorna instancia singleton do cache de embeddings, ou None se
+    USE_EMBEDDING_CACHE=False ou dentro de embedding_cache_disabled.
+    Aberto apenas no primeiro uso.
+    """
+    global _cache
+    if _cache_disabled:
+        return None
+    if _cache is None and USE_EMBEDDING_CACHE:
+        from embedding_cache import EmbeddingCache
+        _cache = EmbeddingCache()
+    return _cache
+
+
+@contextlib.contextmanager
+def embedding_cache_disabled():
+    """
+    Ignora o cache de embeddings neste processo dentro do bloco (ex.:
+    benchmarks que medem a vetorizacao real). O cache ja aberto nao e
+    fechado e volta a ser usado ao sair do bloco.
+    """
+    global _cache_disabled
+    _cache_disabled += 1
+    try:
+        yield
+    finally:
+        _cache_disabled -= 1
+
+
+def cache_namespace():
+    """
+    Parte da chave do cache alem do texto: modelo, backend e normalizacao.
+
+    Vetores de modelos/backends diferentes nunca se misturam, e trocar a
+    normalizacao de texto nao reaproveita vetores da configuracao anterior.
+    """
+    return f"{embedding_signature()}|normalizacao={not DISABLE_NORMALIZATION}"
+
+
+def cache_lookup(texts):
+    """
+    Consulta o cache de embeddings para os textos.
+
+    Retorna tupla (vetores, ausentes): array com os vetores encontrados
+    (linhas dos ausentes zeradas; None se nenhum encontrado ou cache
+    desativado) e lista de indices dos textos a vetorizar.
+    """
+    cache = get_embedding_cache()
+    if cache is None or not texts:
+        return None, list(range(len(texts)))
+    return cache.get_many(texts, cache_namespace())
+
+
+def cache_store(texts, vectors, missing, computed):
+    """
+    Grava no cache os vetores calculados dos textos ausentes (ver
+    cache_lookup) e os combina com os encontrados.
+
+    Retorna numpy array float32 continuo (n_textos x dimensao).
+    """
+    cache = get_embedding_cache()
+    if cache is not None and missing:
+        cache.put_many([texts[i] for i in missing], cache_namespace(), computed)
+
+    if vectors is None:
+        return computed
+    vectors[missing] = computed
+    return vectors
+
+
+def cached_encode(texts, encode):
+    """
+    Vetoriza textos consultando o cache: apenas os ausentes sao passados
+    para encode (funcao texts -> array float32) e gravados no cache.
+
+    Retorna numpy array float32 continuo (n_textos x dimensao).
+    """
+    texts = list(texts)
+    if not texts:
+        return encode(texts)
+
+    vectors, missing = cache_lookup(texts)
+    if not missing:
+        return vectors
+    return cache_store(texts, vectors, missing, encode([texts[i] for i in missing]))
+
+
 def encode_text(text):
     """
     Vetoriza texto unico em embedding.
@@ -30,36 +131,180 @@ def encode_text(text):
     Converte texto em vetor numerico de alta dimensionalidade (tipicamente
     768 dimensoes) que captura significado semantico do texto.
 
-    Retorna numpy array com embedding do texto.
+    Consulta o cache de embeddings (consultas repetidas ficam na camada
+    em memoria); se ausente, usa o servidor de embeddings compartilhado
+    se estiver rodando (ver embedding_server), senao o modelo local.
+
+    Retorna numpy array float32 com embedding do texto.
     """
+    return cached_encode([text], _encode_text_uncached)[0]
+
+
+def _encode_text_uncached(texts):
+    vectors = _encode_on_server(texts)
+    if vectors is not None:
+        return vectors
+
     embedder = get_embedder()
-    return embedder.encode(text)
+    return np.asarray(embedder.encode(texts[0]), dtype=np.float32)[None, :]
+
 
+def _encode_on_server(texts):
+    """
+    Vetoriza no servidor de embeddings; None se indisponivel.
 
-def encode_batch(texts, show_progress=True, batch_size=32):
+    Se o modelo ja foi carregado neste processo, usa-o diretamente.
+    Falha de comunicacao (apos uma nova tentativa) desativa o servidor
+    para o restante do processo.
     """
-    Vetoriza lista de textos em lote com barra de progresso.
+    if _embedder is not None:
+        return None
+
+    from embedding_server import get_server_client, disable_server_client
 
-    Para listas pequenas (<100 textos), processa sem mostrar progresso.
-    Para listas grandes, processa em batches mostrando barra de progresso.
+    client = get_server_client()
+    if client is None:
+        return None
+    try:
+        try:
+            return client.encode(texts)
+        except ConnectionError:
+            return client.encode(texts)
+    except (OSError, ValueError) as e:
+        print(f"Servidor de embeddings indisponivel ({e}), carregando modelo local")
+        disable_server_client()
+        return None
 
-    Processamento em batch e mais eficiente que processar textos
-    individualmente, especialmente com GPU.
 
-    Retorna lista de embeddings no formato float (compativel com ChromaDB).
+def token_lengths(texts):
+    """
+    Quantidade de tokens de cada texto, como o modelo os processa
+    (com tokens especiais e truncados em max_seq_length).
+
+    Retorna array int64 alinhado com texts.
     """
     embedder = get_embedder()
-    
-    if not show_progress or len(texts) < 100:
-        return embedder.encode(texts).astype(float).tolist()
-    
-    all_embeddings = []
-    
-    with tqdm(total=len(texts), desc="Embeddings", unit="doc") as pbar:
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i+batch_size]
-            embeddings = embedder.encode(batch)
-            all_embeddings.extend(embeddings)
-            pbar.update(len(batch))
-    
-    return [emb.astype(float).tolist() for emb in all_embeddings]
\ No newline at end of file
+    encoded = embedder.tokenizer(
+        list(texts),
+        add_special_tokens=True,
+        truncation=True,
+        max_length=embedder.max_seq_length
+    )
+    return np.fromiter((len(ids) for ids in encoded['input_ids']), dtype=np.int64, count=len(texts))
+
+
+def plan_batches(lengths, token_budget=None, max_batch_size=None):
+    """
+    Agrupa textos em lotes de comprimento semelhante.
+
+    Ordena indices por quantidade de tokens e fecha um lote quando
+    (tamanho do lote x maior comprimento do lote) excederia token_budget
+    ou quando atinge max_batch_size. Titulos curtos formam lotes grandes
+    e textos longos lotes pequenos, reduzindo o padding de cada lote ao
+    comprimento dos vizinhos em vez do texto mais longo da entrada.
+
+    Retorna lista de arrays de indices (posicoes em lengths).
+    """
+    token_budget = token_budget or EMBEDDING_TOKEN_BUDGET
+    max_batch_size = max_batch_size or EMBEDDING_MAX_BATCH
+
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order].tolist()
+
+    batches = []
+    start = 0
+    for pos, length in enumerate(sorted_lengths):
+        size = pos - start + 1
+        if size > 1 and (size > max_batch_size or size * length > token_budget):
+            batches.append(order[start:pos])
+            start = pos
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def padding_ratio(lengths, batches):
+    """
+    Razao entre tokens processados (com padding) e tokens reais.
+
+    1.0 significa nenhum padding; 2.0 significa metade do processamento
+    gasto em tokens de preenchimento.
+    """
+    lengths = np.asarray(lengths)
+    real = lengths.sum()
+    if real == 0:
+        return 1.0
+    padded = sum(len(idx) * lengths[idx].max() for idx in batches)
+    return padded / real
+
+
+def encode_array(texts, show_progress=True, batch_size=None, token_budget=None):
+    """
+    Vetoriza lista de textos: textos em cache (cached_encode) nao sao
+    recalculados; os demais vao ao servidor compartilhado, se disponivel,
+    ou ao modelo local (encode_array_local).
+
+    Retorna numpy array float32 continuo (n_textos x dimensao).
+    """
+    def encode(pending):
+        if pending:
+            vectors = _encode_on_server(pending)
+            if vectors is not None:
+                return vectors
+        return encode_array_local(pending, show_progress, batch_size, token_budget)
+
+    return cached_encode(texts, encode)
+
+
+def encode_array_local(texts, show_progress=True, batch_size=None, token_budget=None):
+    """
+    Vetoriza lista de textos com o modelo deste processo, em lotes
+    agrupados por comprimento.
+
+    Textos sao ordenados por quantidade de tokens e agrupados por
+    orcamento de tokens (plan_batches): cada lote tem no maximo
+    token_budget tokens com padding (EMBEDDING_TOKEN_BUDGET) e
+    batch_size textos (EMBEDDING_MAX_BATCH). Os vetores sao devolvidos
+    na ordem original dos textos.
+
+    Para listas pequenas (<100 textos) ou show_progress=False, nao
+    mostra barra de progresso.
+
+    Retorna numpy array float32 continuo (n_textos x dimensao).
+    """
+    embedder = get_embedder()
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    batches = plan_batches(token_lengths(texts), token_budget, batch_size)
+
+    vectors = None
+    disable = not show_progress or len(texts) < 100
+    with tqdm(total=len(texts), desc="Embeddings", unit="doc", disable=disable) as pbar:
+        for idx in batches:
+            embeddings = embedder.encode(
+                [texts[i] for i in idx],
+                batch_size=len(idx),
+                show_progress_bar=False,
+                convert_to_numpy=True
+            )
+            if vectors is None:
+                vectors = np.empty((len(texts), embeddings.shape[1]), dtype=np.float32)
+            vectors[idx] = embeddings
+            pbar.update(len(idx))
+
+    return vectors
+
+
+def encode_batch(texts, show_progress=True, batch_size=None, token_budget=None):
+    """
+    Vetoriza lista de textos em lotes agrupados por comprimento, com
+    cache de embeddings, no servidor compartilhado ou localmente (ver
+    encode_array).
+
+    Retorna numpy array float32 continuo (n_textos x dimensao); conversao
+    para o ChromaDB e feita apenas na gravacao (database.to_chroma_embeddings).
+    """
+    return encode_array(texts, show_progress, batch_size, token_budget)
@@ -1,11 +1,44 @@
 # indexer.py
 # Indexacao de documentos enriquecidos no banco vetorial
 
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import deque
+
 from embeddings import encode_batch
-from config import BATCH_SIZE
+from database import to_chroma_embeddings
+from embedding_backends import embedding_signature
+from config import BATCH_SIZE, DISABLE_NORMALIZATION, INDEX_PIPELINE_DEPTH, EMBEDDING_POOL_PREFETCH
 from tqdm import tqdm
 
 
+def document_hash(doc_text, metadata):
+    """
+    Hash do conteudo de um documento (texto + metadados + modelo).
+
+    Inclui modelo e backend (embedding_signature) para que troca de
+    modelo ou de backend invalide todos os vetores. Chave 'content_hash' dos metadados e ignorada.
+    """
+    meta = {k: v for k, v in metadata.items() if k != 'content_hash'}
+    digest = hashlib.sha1()
+    digest.update(embedding_signature().encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(doc_text.encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(json.dumps(meta, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _unique_id(base, seen):
+    """Retorna base, ou base_N se base ja foi usado (registra em seen)."""
+    n = seen.get(base, 0)
+    seen[base] = n + 1
+    return base if n == 0 else f"{base}_{n}"
+
+
 def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=False):
     """
     Prepara documentos NCM para indexacao no banco vetorial.
@@ -13,7 +46,8 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
     Processa DataFrame de NCMs e gera:
     - Textos enriquecidos para vetorizacao
     - Metadados estruturados para cada documento
-    - IDs unicos para cada documento
+    - IDs estaveis derivados do codigo NCM (ncm_{codigo}), iguais entre
+      versoes das fontes para permitir indexacao incremental
 
     Deteccao automatica de nomes de colunas para suportar diferentes encodings.
 
@@ -26,7 +60,7 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
 
     Retorna tupla: (documents, metadatas, ids)
     """
-    from data_loader import create_enriched_ncm_text, detect_ncm_level
+    from data_loader import create_enriched_ncm_text, detect_ncm_level, normalize_enriched_texts
 
     documents = []
     metadatas = []
@@ -62,8 +96,9 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
 
     skipped = 0
     skipped_structural = 0
+    seen_ids = {}
 
-    for idx, row in tqdm(ncm_data.iterrows(), total=len(ncm_data), desc="NCM"):
+    for _, row in tqdm(ncm_data.iterrows(), total=len(ncm_data), desc="NCM"):
         # Usar nomes detectados
         codigo = str(row.get(col_codigo, '')).strip() if col_codigo else ''
         descricao = str(row.get(col_desc, '')).strip() if col_desc else ''
@@ -81,7 +116,7 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
                 skipped_structural += 1
                 continue
 
-        doc_text = create_enriched_ncm_text(row, hierarchy, atributos_dict)
+        doc_text = create_enriched_ncm_text(row, hierarchy, atributos_dict, normalize=False)
 
         if doc_text is None or not doc_text.strip():
             skipped += 1
@@ -102,7 +137,11 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
         }
 
         metadatas.append(metadata)
-        ids.append(f"ncm_{idx}")
+        ids.append(_unique_id(f"ncm_{codigo}", seen_ids))
+
+    # Normaliza todas as linhas de uma vez (LRU absorve titulos repetidos)
+    if not DISABLE_NORMALIZATION:
+        documents = normalize_enriched_texts(documents)
 
     if skipped > 0:
         print(f"  Pulados {skipped} documentos vazios")
@@ -112,6 +151,43 @@ def prepare_ncm_documents(ncm_data, hierarchy, atributos_dict, index_only_items=
     return documents, metadatas, ids
 
 
+def iter_atributos_documents(ncm_items):
+    """
+    Gera documentos de atributos um a um a partir de itens de 'listaNcm'.
+
+    Versao em streaming de prepare_atributos_documents: consome um iteravel
+    de itens (ex.: iter_atributos_ncm) e produz tuplas (documento, metadata,
+    id) sem acumular listas, permitindo indexar o arquivo de atributos
+    inteiro com memoria constante via index_document_stream.
+
+    IDs sao estaveis entre versoes do arquivo de atributos, no formato
+    attr_{ncm}_{atributo}_{modalidade} (sufixo _N em caso de repeticao).
+    """
+    from data_loader import create_atributo_description, normalize_text_advanced
+
+    for ncm_item in ncm_items:
+        ncm_code = ncm_item['codigoNcm']
+        seen_ids = {}
+
+        for atributo in ncm_item['listaAtributos']:
+            doc_text = create_atributo_description(ncm_code, atributo)
+
+            metadata = {
+                "tipo": "atributo",
+                "ncm_codigo": ncm_code,
+                "atributo_codigo": atributo['codigo'],
+                "modalidade": atributo['modalidade'],
+                "obrigatorio": atributo['obrigatorio'],
+                "multivalorado": atributo['multivalorado'],
+                "data_inicio_vigencia": atributo['dataInicioVigencia']
+            }
+
+            modalidade = normalize_text_advanced(atributo['modalidade']).replace(' ', '_')
+            doc_id = _unique_id(f"attr_{ncm_code}_{atributo['codigo']}_{modalidade}", seen_ids)
+
+            yield doc_text, metadata, doc_id
+
+
 def prepare_atributos_documents(atributos_data):
     """
     Prepara documentos de atributos para indexacao.
@@ -122,12 +198,13 @@ def prepare_atributos_documents(atributos_data):
     Para cada atributo, cria:
     - Texto descritivo formatado
     - Metadata com codigo NCM, codigo atributo, modalidade, etc
-    - ID unico no formato attr_{ncm_idx}_{attr_idx}
+    - ID estavel no formato attr_{ncm}_{atributo}_{modalidade}
+
+    Materializa todos documentos em memoria; para arquivos grandes use
+    iter_atributos_documents com index_document_stream.
 
     Retorna tupla: (documents, metadatas, ids)
     """
-    from data_loader import create_atributo_description
-    
     documents = []
     metadatas = []
     ids = []
@@ -140,65 +217,375 @@ def prepare_atributos_documents(atributos_data):
     
     print("Preparando documentos de atributos...")
     with tqdm(total=total_atributos, desc="Atributos") as pbar:
-        for idx, ncm_item in enumerate(lista_ncm):
-            ncm_code = ncm_item['codigoNcm']
-            
-            for attr_idx, atributo in enumerate(ncm_item['listaAtributos']):
-                doc_text = create_atributo_description(ncm_code, atributo)
-                documents.append(doc_text)
-                
-                metadata = {
-                    "tipo": "atributo",
-                    "ncm_codigo": ncm_code,
-                    "atributo_codigo": atributo['codigo'],
-                    "modalidade": atributo['modalidade'],
-                    "obrigatorio": atributo['obrigatorio'],
-                    "multivalorado": atributo['multivalorado'],
-                    "data_inicio_vigencia": atributo['dataInicioVigencia']
-                }
-                
-                metadatas.append(metadata)
-                ids.append(f"attr_{idx}_{attr_idx}")
-                pbar.update(1)
+        for doc_text, metadata, doc_id in iter_atributos_documents(lista_ncm):
+            documents.append(doc_text)
+            metadatas.append(metadata)
+            ids.append(doc_id)
+            pbar.update(1)
     
     return documents, metadatas, ids
 
 
-def index_documents(collection, documents, metadatas, ids):
+class IndexDelta:
+    """
+    Estado de uma indexacao incremental.
+
+    Guarda o mapa id -> content_hash dos documentos ja presentes no banco
+    e, conforme os fluxos de documentos sao consumidos, separa:
+    - novos: id inexistente no banco
+    - alterados: id existente com hash diferente
+    - inalterados: mesmo id e mesmo hash (nao sao re-vetorizados)
+    Ao final, delete_stale remove ids do banco que nao apareceram em
+    nenhum fluxo (documentos excluidos das fontes).
+    """
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.seen = set()
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.embedded = 0
+        self.embed_time = 0.0
+
+    @classmethod
+    def from_collection(cls, collection, page_size=BATCH_SIZE):
+        """Le ids e content_hash de todos documentos da colecao (paginado)."""
+        existing = {}
+        offset = 0
+        while True:
+            page = collection.get(include=['metadatas'], limit=page_size, offset=offset)
+            ids = page['ids']
+            if not ids:
+                break
+            for doc_id, meta in zip(ids, page['metadatas']):
+                existing[doc_id] = (meta or {}).get('content_hash')
+            offset += len(ids)
+        return cls(existing)
+
+    def filter(self, docs, metas, ids):
+        """Retorna apenas documentos novos ou alterados do lote."""
+        keep_docs, keep_metas, keep_ids = [], [], []
+        for doc_text, metadata, doc_id in zip(docs, metas, ids):
+            self.seen.add(doc_id)
+            old_hash = self.existing.get(doc_id)
+            if old_hash == metadata['content_hash']:
+                self.unchanged += 1
+                continue
+            if doc_id in self.existing:
+                self.updated += 1
+            else:
+                self.added += 1
+            keep_docs.append(doc_text)
+            keep_metas.append(metadata)
+            keep_ids.append(doc_id)
+        return keep_docs, keep_metas, keep_ids
+
+    def delete_stale(self, collection):
+        """Remove do banco documentos ausentes das fontes atuais."""
+        stale = [doc_id for doc_id in self.existing if doc_id not in self.seen]
+        for start in range(0, len(stale), BATCH_SIZE):
+            collection.delete(ids=stale[start:start + BATCH_SIZE])
+        self.removed = len(stale)
+        return self.removed
+
+    def seconds_per_document(self, fallback=None):
+        """Tempo medio de vetorizacao por documento nesta execucao."""
+        if self.embedded:
+            return self.embed_time / self.embedded
+        return fallback
+
+    def report(self, seconds_per_doc=None):
+        """Exibe tamanho do delta e tempo economizado estimado."""
+        total = self.added + self.updated + self.unchanged
+        changed = self.added + self.updated
+        print("\nDelta da indexacao incremental:")
+        print(f"  Novos: {self.added}")
+        print(f"  Alterados: {self.updated}")
+        print(f"  Removidos: {self.removed}")
+        print(f"  Inalterados: {self.unchanged} de {total}")
+        if total:
+            print(f"  Re-vetorizados: {changed} ({100*changed/total:.1f}% do corpus)")
+
+        seconds_per_doc = self.seconds_per_document(seconds_per_doc)
+        if seconds_per_doc:
+            saved = self.unchanged * seconds_per_doc
+            print(f"  Tempo economizado (estimado): {saved:.1f}s "
+                  f"({seconds_per_doc*1000:.2f} ms/doc)")
+        else:
+            print("  Tempo economizado: sem medida de tempo por documento")
+
+
+class IndexWriter(threading.Thread):
+    """
+    Thread escritora do pipeline de indexacao.
+
+    Recebe lotes ja vetorizados por uma fila limitada (queue.Queue com
+    maxsize=depth) e grava cada um no ChromaDB enquanto a thread
+    principal vetoriza o lote seguinte. Quando a fila enche, submit
+    bloqueia o produtor (backpressure), limitando a memoria a depth
+    lotes em espera + 1 em gravacao + 1 em vetorizacao.
+
+    Excecoes na gravacao sao guardadas e relancadas na thread principal
+    no proximo submit ou em close; lotes restantes sao descartados.
+
+    on_commit (opcional, por lote) e chamado na thread escritora apos a
+    gravacao, na ordem de envio (usado pelo diario de build).
+    """
+
+    def __init__(self, write, depth=INDEX_PIPELINE_DEPTH):
+        super().__init__(name="indexer-writer", daemon=True)
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.write = write
+        self.error = None
+        self.written = 0
+        self.write_time = 0.0
+        self.idle_time = 0.0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def run(self):
+        while True:
+            t0 = time.perf_counter()
+            item = self.queue.get()
+            self.idle_time += time.perf_counter() - t0
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            batch, on_commit = item
+            try:
+                if batch['ids']:
+                    t0 = time.perf_counter()
+                    self.write(**batch)
+                    self.write_time += time.perf_counter() - t0
+                    self.written += len(batch['ids'])
+                if on_commit is not None:
+                    on_commit()
+            except Exception as e:
+                self.error = e
+
+    def submit(self, on_commit=None, **batch):
+        """Enfileira lote para gravacao; bloqueia se a fila estiver cheia."""
+        if self.error is not None:
+            raise self.error
+        item = (batch, on_commit)
+        if self.queue.full():
+            self.stalls += 1
+            t0 = time.perf_counter()
+            self.queue.put(item)
+            self.stall_time += time.perf_counter() - t0
+        else:
+            self.queue.put(item)
+
+    def close(self):
+        """Aguarda gravacao dos lotes pendentes e relanca erro do escritor."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _print_pipeline_stats(desc, docs, encode_time, writer, elapsed):
+    """Exibe throughput por estagio e esperas de backpressure do pipeline."""
+    def rate(seconds):
+        return f"{docs/seconds:,.0f} doc/s" if seconds > 0 else "-"
+
+    print(f"  Pipeline [{desc}]: {docs} documentos em {elapsed:.1f}s")
+    print(f"    Vetorizacao: {encode_time:.1f}s ({rate(encode_time)})")
+    print(f"    Escrita:     {writer.write_time:.1f}s ({rate(writer.write_time)})")
+    print(f"    Backpressure: {writer.stalls} esperas do produtor ({writer.stall_time:.1f}s), "
+          f"escritor ocioso {writer.idle_time:.1f}s")
+
+
+def _start_encoding_pool(total):
+    """Inicia pool de processos para corpus grande, ou None (ver should_use_pool)."""
+    from embedding_pool import EncodingPool, should_use_pool
+
+    if not should_use_pool(total):
+        return None
+    try:
+        return EncodingPool().start()
+    except Exception as e:
+        print(f"Erro ao iniciar pool de vetorizacao, usando processo atual: {e}")
+        return None
+
+
+def index_document_stream(collection, doc_stream, total=None, desc="Indexacao", delta=None,
+                          journal=None):
+    """
+    Indexa fluxo de documentos no banco vetorial em lotes de BATCH_SIZE.
+
+    Consome iteravel de tuplas (documento, metadata, id) e, a cada lote
+    completo, gera embeddings apenas desse lote. A gravacao no ChromaDB
+    e feita por uma thread escritora (IndexWriter) ligada por fila
+    limitada, de modo que vetorizacao (CPU) e escrita em disco se
+    sobrepoem. Nenhuma lista com o corpus inteiro (textos ou vetores) e
+    mantida: o pico de memoria fica limitado a INDEX_PIPELINE_DEPTH + 2
+    lotes (mais EMBEDDING_POOL_PREFETCH com o pool de processos)
+    independentemente do tamanho da fonte.
+
+    Cada metadata recebe 'content_hash' (ver document_hash). Se delta
+    (IndexDelta) for informado, o modo e incremental: documentos com hash
+    igual ao do banco sao pulados e os demais gravados via upsert.
+
+    Se journal (database.BuildJournal) for informado, cada lote gravado e
+    registrado no diario sob o nome desc, e os lotes ja registrados por
+    uma execucao interrompida sao pulados sem vetorizacao (retomada). Os
+    documentos sao gravados via upsert, entao um lote gravado mas nao
+    registrado antes da interrupcao pode ser regravado com seguranca.
+
+    Com EMBEDDING_WORKERS > 1 e total >= EMBEDDING_POOL_MIN_DOCS, a
+    vetorizacao usa o pool de processos (embedding_pool.EncodingPool):
+    ate EMBEDDING_POOL_PREFETCH lotes seguintes sao enviados ao pool
+    enquanto o atual e coletado, e os lotes chegam ao escritor na ordem
+    de leitura.
+
+    total e opcional e serve para a barra de progresso e para decidir
+    o uso do pool.
+
+    Ao final exibe throughput de cada estagio e esperas de backpressure.
+
+    Retorna quantidade de documentos gravados.
+    """
+    indexed = 0
+    resumed = 0
+    batch_no = 0
+    encode_time = 0.0
+    committed = journal.committed(desc) if journal is not None else 0
+    batch_docs, batch_metas, batch_ids = [], [], []
+    store = collection.add if delta is None and journal is None else collection.upsert
+
+    def write(ids, documents, embeddings, metadatas):
+        # Vetores chegam como array float32; conversao so na fronteira com o banco
+        store(ids=ids, documents=documents,
+              embeddings=to_chroma_embeddings(embeddings), metadatas=metadatas)
+
+    writer = IndexWriter(write)
+    pool = _start_encoding_pool(total)
+    # Lotes em vetorizacao no pool, coletados e enviados ao escritor em ordem
+    pending = deque()
+    window = EMBEDDING_POOL_PREFETCH if pool is not None else 0
+    writer.start()
+    start = time.perf_counter()
+
+    def collect():
+        nonlocal encode_time
+        job, on_commit, docs, metas, ids = pending.popleft()
+        if job is None:
+            writer.submit(on_commit=on_commit, ids=[])
+            return
+        t0 = time.perf_counter()
+        vectors = job.result() if pool is not None else job
+        elapsed = time.perf_counter() - t0
+        encode_time += elapsed
+        if delta is not None:
+            delta.embed_time += elapsed
+        writer.submit(
+            on_commit=on_commit,
+            ids=ids,
+            documents=docs,
+            embeddings=vectors,
+            metadatas=metas,
+        )
+
+    def flush():
+        nonlocal encode_time, batch_no, resumed
+        docs, metas, ids = batch_docs, batch_metas, batch_ids
+        number = batch_no
+        batch_no += 1
+
+        if number < committed:
+            # Lote ja gravado por execucao interrompida
+            resumed += len(ids)
+            if delta is not None:
+                delta.seen.update(ids)
+            return 0
+
+        on_commit = None
+        if journal is not None:
+            on_commit = lambda: journal.record(desc, number, len(ids))
+
+        job = None
+        if delta is not None:
+            docs, metas, ids = delta.filter(docs, metas, ids)
+        if docs:
+            t0 = time.perf_counter()
+            # Com pool: EncodingJob (coletado em collect); sem pool: vetores prontos
+            job = pool.submit(docs) if pool is not None else encode_batch(docs, show_progress=False)
+            elapsed = time.perf_counter() - t0
+            encode_time += elapsed
+            if delta is not None:
+                delta.embed_time += elapsed
+                delta.embedded += len(docs)
+        pending.append((job, on_commit, docs, metas, ids))
+        while len(pending) > window:
+            collect()
+        return len(docs)
+
+    try:
+        with tqdm(total=total, desc=desc, unit="doc") as pbar:
+            for doc_text, metadata, doc_id in doc_stream:
+                metadata['content_hash'] = document_hash(doc_text, metadata)
+                batch_docs.append(doc_text)
+                batch_metas.append(metadata)
+                batch_ids.append(doc_id)
+
+                if len(batch_docs) >= BATCH_SIZE:
+                    indexed += flush()
+                    pbar.update(len(batch_docs))
+                    batch_docs, batch_metas, batch_ids = [], [], []
+
+            if batch_docs:
+                indexed += flush()
+                pbar.update(len(batch_docs))
+            while pending:
+                collect()
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.close()
+
+    if resumed:
+        print(f"  Retomada [{desc}]: {committed} lotes ({resumed} documentos) ja gravados, pulados")
+    if indexed:
+        _print_pipeline_stats(desc, indexed, encode_time, writer, time.perf_counter() - start)
+
+    return indexed
+
+
+def index_documents(collection, documents, metadatas, ids, delta=None, journal=None):
     """
     Indexa documentos no banco vetorial ChromaDB em lotes.
 
     Processo de indexacao:
-    1. Gera embeddings de todos documentos usando encode_batch
-    2. Divide documentos em lotes de tamanho BATCH_SIZE
-    3. Adiciona cada lote ao ChromaDB com ids, documentos, embeddings e metadatas
+    1. Divide documentos em lotes de tamanho BATCH_SIZE
+    2. Gera embeddings de cada lote usando encode_batch
+    3. Thread escritora adiciona cada lote ao ChromaDB enquanto o lote
+       seguinte e vetorizado (ver index_document_stream)
 
     Processamento em lotes e necessario pois ChromaDB tem limite de
     ~5461 documentos por operacao de adicao.
 
+    Com delta (IndexDelta), apenas documentos novos ou alterados sao
+    vetorizados e gravados (upsert); remocao de documentos excluidos fica
+    a cargo de delta.delete_stale apos todos os fluxos. journal habilita
+    retomada por lotes (ver index_document_stream).
+
     Mostra barra de progresso durante indexacao.
     """
     if not documents:
         print("Nenhum documento para indexar")
         return
-    
+
     total = len(documents)
-    vectors = encode_batch(documents)
-    
-    print(f"\nIndexando {total} documentos em lotes de {BATCH_SIZE}...")
-    
-    num_batches = (total + BATCH_SIZE - 1) // BATCH_SIZE
-    with tqdm(total=num_batches, desc="Indexacao") as pbar:
-        for start in range(0, total, BATCH_SIZE):
-            end = min(start + BATCH_SIZE, total)
-            
-            collection.add(
-                ids=ids[start:end],
-                documents=documents[start:end],
-                embeddings=vectors[start:end],
-                metadatas=metadatas[start:end],
-            )
-            
-            pbar.update(1)
-    
-    print(f"Indexacao concluida: {total} documentos")
\ No newline at end of file
+    mode = "incremental, " if delta is not None else ""
+    print(f"\nIndexando {total} documentos ({mode}lotes de {BATCH_SIZE})...")
+
+    written = index_document_stream(
+        collection, zip(documents, metadatas, ids), total=total, desc="NCM",
+        delta=delta, journal=journal
+    )
+
+    print(f"Indexacao concluida: {written} documentos gravados")
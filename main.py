@@ -2,10 +2,11 @@
 # Sistema RAG NCM com modo interativo de consulta
 
 import argparse
-from setup import setup_database
-from visualization import show_sample_data, show_random_data, show_statistics
-from diagnostico.diagnostics import comprehensive_diagnostic
-from config import DEFAULT_MODEL
+from config import DEFAULT_MODEL, BACKGROUND_WARM_UP
+
+# Modulos pesados (chromadb, torch/sentence-transformers, pandas) sao
+# importados dentro das funcoes: --help e modos que nao consultam o banco
+# nao pagam esse custo (ver benchmarks.py --importacao)
 
 
 def interactive_mode(collection, prompt_file="system_prompt.txt"):
@@ -38,6 +39,8 @@ def interactive_mode(collection, prompt_file="system_prompt.txt"):
         find_ncm_by_description, find_atributos_by_ncm,
         find_ncm_hierarchical, find_ncm_hierarchical_with_context
     )
+    from visualization import show_sample_data, show_random_data, show_statistics
+    from diagnostico.diagnostics import comprehensive_diagnostic
 
     print(f"\nCarregando prompt: {prompt_file}")
     load_system_prompt(prompt_file)
@@ -193,10 +196,14 @@ def main():
     - --menu: usa menu principal completo (default)
 
     Fluxo de execucao:
-    1. Configura e indexa banco vetorial (ou reutiliza existente)
-    2. Se --setup-only nao especificado, entra em modo de interface
-    3. Modo padrao e o menu principal com todas funcionalidades
-    4. Modo CLI mantem compatibilidade com versao anterior
+    1. --setup-only / --cli: configura e indexa banco vetorial (ou reutiliza
+       existente, retomando indexacao interrompida); so prossegue com
+       indice completo
+    2. Menu (default): exibido imediatamente; colecao e modulos pesados
+       sao carregados em segundo plano (BACKGROUND_WARM_UP) ou no primeiro
+       uso (LazyCollection). Se o banco precisar de indexacao, ela roda em
+       primeiro plano na primeira opcao que consultar o banco
+    3. Modo CLI mantem compatibilidade com versao anterior
     """
     parser = argparse.ArgumentParser(description='Sistema RAG NCM Aprimorado')
     parser.add_argument('--prompt', type=str, default='system_prompt.txt')
@@ -209,17 +216,30 @@ def main():
 
     args = parser.parse_args()
 
-    collection = setup_database()
+    if args.setup_only or args.cli:
+        from setup import setup_database
+        from database import is_index_complete
+
+        collection = setup_database()
+
+        # Nao atende consultas com indice parcial (indexacao interrompida ou
+        # em andamento em outro processo)
+        if not is_index_complete():
+            print("Indice incompleto: execute novamente para retomar a indexacao")
+            return collection
 
-    if not args.setup_only:
-        # Se --cli especificado, usa modo antigo
         if args.cli:
             interactive_mode(collection, prompt_file=args.prompt)
-        # Caso contrario, usa menu principal (default)
-        else:
-            from menu import main_menu
-            main_menu(collection)
+        return collection
+
+    from database import LazyCollection
+    from setup import open_collection, preload_collection
+    from menu import main_menu
 
+    collection = LazyCollection(open_collection, preload=preload_collection)
+    if BACKGROUND_WARM_UP:
+        collection.warm_up()
+    main_menu(collection)
     return collection
 
 
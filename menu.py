@@ -146,24 +146,50 @@ def option_12(c):
 
 def option_13(c):
     from config import EMBEDDING_MODEL, DEFAULT_MODEL, NCM_FILE, ATRIBUTOS_FILE
+    from embedding_backends import backend_id, describe_source
     print("\n" + "="*70)
     print("INFORMAÇÕES DO SISTEMA")
     print("="*70)
     print(f"\n[CONFIG]")
-    print(f"  Embedding: {EMBEDDING_MODEL}")
+    print(f"  Embedding: {EMBEDDING_MODEL} ({backend_id()})")
+    print(f"  Origem do modelo: {describe_source()}")
     print(f"  LLM: {DEFAULT_MODEL}")
     print(f"  NCM: {NCM_FILE}")
     print(f"  Atributos: {ATRIBUTOS_FILE}")
     print(f"\n[BANCO]")
+    from database import load_index_state, is_index_complete
+    state = load_index_state()
+    status = 'completo' if is_index_complete(state) else 'INCOMPLETO (retomar com setup)'
+    print(f"  Indice: {status} (atualizado em {state.get('atualizado_em', 'n/d')})")
+    print(f"  Backend do indice: {state.get('fingerprint', {}).get('backend', 'n/d')}")
     print(f"  Total: {c.count()} docs")
+    from config import SEARCH_ENGINE
+    from vector_index import vector_index_info, vector_index_up_to_date
+    info = vector_index_info()
+    if SEARCH_ENGINE == 'numpy' and info:
+        fresh = 'atualizado' if vector_index_up_to_date(state) else 'DESATUALIZADO (usa ChromaDB)'
+        print(f"  Busca: numpy exata ({info.get('quantidade', 0)} vetores, {fresh})")
+    else:
+        print("  Busca: ChromaDB (HNSW)")
     try:
         print(f"  NCMs: {len(c.get(where={'tipo': 'ncm'}, limit=20000)['ids'])}")
     except:
         pass
     try:
-        print(f"  Atributos: {len(c.get(where={'tipo': 'atributo'}, limit=100000)['ids'])}")
+        from atributos_table import count_atributos
+        attr_count, origem = count_atributos(c)
+        print(f"  Atributos ({origem}): {attr_count}")
     except:
         pass
+    from config import ATRIBUTOS_RESIDENT_INDEX
+    if ATRIBUTOS_RESIDENT_INDEX:
+        from atributos_index import get_atributos_index
+        index = get_atributos_index()
+        if index is not None:
+            stats = index.stats()
+            print(f"\n[MEMÓRIA]")
+            print(f"  Índice de atributos: {stats['ncms']} NCMs, {stats['atributos']} atributos, "
+                  f"{stats['memoria_mb']:.1f} MB ({stats['origem']}, carga {stats['carga_s']:.2f}s)")
     pause()
 
 
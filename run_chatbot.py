@@ -1,7 +1,8 @@
 # run_chatbot.py
 # Interface Gradio para chatbot RAG
 
-from main import setup_database
+from setup import setup_database
+from database import is_index_complete
 import gradio as gr
 from llm_client import chat, get_models
 from search import find_similars, find_ncm_hierarchical_with_context, find_ncm_hierarchical
@@ -83,6 +84,12 @@ def launch_ui(collection, share=False):
 if __name__ == "__main__":
     print("Configurando sistema RAG")
     collection = setup_database()
-    
+
+    # Nao atende consultas com indice parcial (indexacao interrompida ou
+    # em andamento em outro processo)
+    if not is_index_complete():
+        print("Indice incompleto: execute novamente para retomar a indexacao")
+        raise SystemExit(1)
+
     print("Iniciando interface Gradio")
     launch_ui(collection, share=False)
\ No newline at end of file
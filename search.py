@@ -1,7 +1,51 @@
 # search.py
 # Busca vetorial no banco ChromaDB com filtros e ranking
 
-from embeddings import encode_text
+from embeddings import encode_text, encode_batch
+from database import to_chroma_embeddings
+from config import NORMALIZE_QUERIES, ATRIBUTOS_STORAGE, SEARCH_ENGINE, ATRIBUTOS_RESIDENT_INDEX
+
+
+def prepare_query(query_text):
+    """
+    Prepara texto da consulta antes da vetorizacao.
+
+    Se NORMALIZE_QUERIES=True, aplica a mesma normalizacao usada nos
+    documentos indexados (TextNormalizer compartilhado, com LRU).
+    Caso contrario retorna a consulta sem alteracao.
+    """
+    if not NORMALIZE_QUERIES:
+        return query_text
+
+    from data_loader import get_text_normalizer
+    return get_text_normalizer().normalize(query_text) or query_text
+
+
+def _query_vectors(collection, emb, k, filters):
+    """
+    Consulta top-k no motor configurado (SEARCH_ENGINE).
+
+    emb pode ser um vetor ou matriz de consultas (n x dimensao): varias
+    consultas sao respondidas em uma unica chamada. Com 'numpy', usa o
+    indice exato em memoria (vector_index) se estiver exportado e o
+    filtro for suportado; senao, ChromaDB. Resultado no formato de
+    collection.query (uma lista por consulta).
+    """
+    if SEARCH_ENGINE == 'numpy':
+        from vector_index import get_vector_index
+
+        index = get_vector_index()
+        if index is not None:
+            try:
+                return index.query(emb, k=k, filters=filters)
+            except NotImplementedError:
+                pass
+
+    return collection.query(
+        query_embeddings=to_chroma_embeddings(emb),
+        n_results=k,
+        where=filters
+    )
 
 
 def find_similars(collection, query_text, k=15, filters=None, min_score=None):
@@ -9,8 +53,10 @@ def find_similars(collection, query_text, k=15, filters=None, min_score=None):
     Busca documentos similares no banco vetorial.
 
     Processo:
-    1. Vetoriza query_text usando modelo de embedding
-    2. Busca k documentos mais similares no ChromaDB
+    1. Vetoriza query_text usando modelo de embedding (normalizado se
+       NORMALIZE_QUERIES=True, ver prepare_query)
+    2. Busca k documentos mais similares (ChromaDB ou indice exato em
+       memoria, ver SEARCH_ENGINE)
     3. Aplica filtros de metadata se especificados
     4. Filtra por score minimo (distancia maxima) se especificado
 
@@ -20,22 +66,43 @@ def find_similars(collection, query_text, k=15, filters=None, min_score=None):
     Retorna lista de dicionarios com documento, metadata e metricas
     de similaridade (distance e score).
     """
-    emb = encode_text(query_text).astype(float).tolist()
-    
-    res = collection.query(
-        query_embeddings=[emb],
-        n_results=k,
-        where=filters
-    )
-    
-    if not res or not res.get("documents") or not res["documents"][0]:
+    emb = encode_text(prepare_query(query_text))
+    res = _query_vectors(collection, emb, k, filters)
+    return _result_hits(res, 0, min_score)
+
+
+def find_similars_batch(collection, query_texts, k=15, filters=None, min_score=None):
+    """
+    Versao em lote de find_similars: vetoriza todas as consultas em uma
+    chamada do modelo (encode_batch, com cache) e busca todas em uma
+    unica consulta multi-vetor.
+
+    Retorna lista de listas de hits, uma por consulta na ordem de
+    query_texts, no mesmo formato de find_similars. Os resultados
+    coincidem com os de find_similars apenas dentro da tolerancia de
+    ponto flutuante: vetores calculados em lote diferem nos ultimos bits
+    (float32), o que altera levemente as distancias e pode inverter a
+    ordem de documentos empatados.
+    """
+    query_texts = list(query_texts)
+    if not query_texts:
+        return []
+
+    embs = encode_batch([prepare_query(q) for q in query_texts], show_progress=False)
+    res = _query_vectors(collection, embs, k, filters)
+    return [_result_hits(res, i, min_score) for i in range(len(query_texts))]
+
+
+def _result_hits(res, i, min_score=None):
+    """Hits da i-esima consulta de um resultado no formato de collection.query."""
+    if not res or not res.get("documents") or len(res["documents"]) <= i or not res["documents"][i]:
         return []
     
-    distances = (res.get("distances") or [[]])[0]
-    ids = (res.get("ids") or [[]])[0]
+    distances = res["distances"][i] if res.get("distances") else []
+    ids = res["ids"][i] if res.get("ids") else []
     
     hits = []
-    for doc, meta, _id, dist in zip(res["documents"][0], res["metadatas"][0], ids, distances):
+    for doc, meta, _id, dist in zip(res["documents"][i], res["metadatas"][i], ids, distances):
         if min_score is not None and dist > min_score:
             continue
         
@@ -83,7 +150,10 @@ def find_atributos_by_ncm(collection, ncm_code, k=20):
     Busca atributos associados a um codigo NCM especifico.
 
     Normaliza codigo NCM para formato padrao antes da busca.
-    Usa busca exata por metadata (nao vetorial) filtrando por
+    Com ATRIBUTOS_RESIDENT_INDEX=True, responde pelo indice residente em
+    memoria (atributos_index). Com ATRIBUTOS_STORAGE='sqlite', consulta a tabela local indexada por
+    codigo NCM (atributos_table). Sem tabela, ou no modo 'vector', usa
+    busca exata por metadata (nao vetorial) filtrando por
     tipo='atributo' AND ncm_codigo=codigo_normalizado.
 
     Retorna lista de atributos com informacoes de modalidade
@@ -95,6 +165,23 @@ def find_atributos_by_ncm(collection, ncm_code, k=20):
         return []
     
     ncm_normalized = normalize_ncm_code(ncm_code)
+
+    if ATRIBUTOS_RESIDENT_INDEX:
+        from atributos_index import get_atributos_index
+
+        index = get_atributos_index()
+        if index is not None:
+            return index.find(ncm_normalized, limit=k)
+
+    if ATRIBUTOS_STORAGE == 'sqlite':
+        from atributos_table import atributos_table_exists, find_atributos
+
+        if atributos_table_exists():
+            try:
+                return find_atributos(ncm_normalized, limit=k)
+            except Exception as e:
+                print(f"Erro ao buscar atributos na tabela: {e}")
+                return []
     
     try:
         results = collection.get(
@@ -110,25 +197,110 @@ def find_atributos_by_ncm(collection, ncm_code, k=20):
         if not results or not results.get('ids'):
             return []
         
-        hits = []
-        for meta in results['metadatas']:
-            hits.append({
-                "tipo": "atributo",
-                "ncm_codigo": meta.get("ncm_codigo"),
-                "atributo_codigo": meta.get("atributo_codigo"),
-                "modalidade": meta.get("modalidade"),
-                "obrigatorio": meta.get("obrigatorio"),
-                "multivalorado": meta.get("multivalorado"),
-                "data_inicio_vigencia": meta.get("data_inicio_vigencia")
-            })
-        
-        return hits
+        return [_atributo_hit(meta) for meta in results['metadatas']]
         
     except Exception as e:
         print(f"Erro ao buscar atributos: {e}")
         return []
 
 
+def _atributo_hit(meta):
+    """Metadata de documento de atributo no formato de find_atributos_by_ncm."""
+    return {
+        "tipo": "atributo",
+        "ncm_codigo": meta.get("ncm_codigo"),
+        "atributo_codigo": meta.get("atributo_codigo"),
+        "modalidade": meta.get("modalidade"),
+        "obrigatorio": meta.get("obrigatorio"),
+        "multivalorado": meta.get("multivalorado"),
+        "data_inicio_vigencia": meta.get("data_inicio_vigencia")
+    }
+
+
+def find_atributos_by_ncm_many(collection, ncm_codes, k=20):
+    """
+    Versao em lote de find_atributos_by_ncm: atributos de varios NCMs
+    em uma unica consulta.
+
+    Com ATRIBUTOS_RESIDENT_INDEX=True, usa o indice residente em memoria.
+    Senao, com ATRIBUTOS_STORAGE='sqlite', uma consulta IN na tabela local
+    (atributos_table.find_atributos_many); sem tabela, ou no modo
+    'vector', um unico collection.get com filtro $in sobre os codigos.
+
+    Retorna dict codigo (como informado) -> lista de atributos, com no
+    maximo k por NCM; codigos vazios ou sem atributos mapeiam para [].
+    """
+    from data_loader import normalize_ncm_code
+
+    result = {code: [] for code in ncm_codes}
+    normalized = {
+        code: normalize_ncm_code(code) for code in result
+        if code and str(code).strip() != ''
+    }
+    if not normalized:
+        return result
+    codes = list(dict.fromkeys(normalized.values()))
+
+    grouped = None
+    if ATRIBUTOS_RESIDENT_INDEX:
+        from atributos_index import get_atributos_index
+
+        index = get_atributos_index()
+        if index is not None:
+            grouped = index.find_many(codes, limit=k)
+
+    if grouped is None and ATRIBUTOS_STORAGE == 'sqlite':
+        from atributos_table import atributos_table_exists, find_atributos_many
+
+        if atributos_table_exists():
+            try:
+                grouped = find_atributos_many(codes, limit=k)
+            except Exception as e:
+                print(f"Erro ao buscar atributos na tabela: {e}")
+                return result
+
+    if grouped is None:
+        try:
+            results = collection.get(
+                where={
+                    "$and": [
+                        {"tipo": "atributo"},
+                        {"ncm_codigo": {"$in": codes}}
+                    ]
+                }
+            )
+        except Exception as e:
+            print(f"Erro ao buscar atributos: {e}")
+            return result
+
+        grouped = {code: [] for code in codes}
+        for meta in results.get('metadatas') or []:
+            hits = grouped.get(meta.get("ncm_codigo"))
+            if hits is not None and len(hits) < k:
+                hits.append(_atributo_hit(meta))
+
+    for code, ncm_normalized in normalized.items():
+        result[code] = grouped.get(ncm_normalized, [])
+    return result
+
+
+def _with_atributos(collection, ncm_results, k=10):
+    """
+    Acrescenta atributos (e contagem) a cada NCM, buscados em uma unica
+    consulta para todos os resultados (find_atributos_by_ncm_many).
+    """
+    codes = [ncm.get('codigo_normalizado') or ncm.get('codigo') for ncm in ncm_results]
+    atributos = find_atributos_by_ncm_many(collection, codes, k=k)
+    return [
+        {
+            **ncm,
+            "atributos": atributos[code],
+            "num_atributos": len(atributos[code])
+        }
+        for ncm, code in zip(ncm_results, codes)
+    ]
+
+
 def find_ncm_and_atributos(collection, description_text):
     """
     Busca NCM por descricao e retorna NCM com seus atributos.
@@ -155,25 +327,14 @@ def search_with_context(collection, query, k=8):
     """
     Busca contextualizada retornando NCMs com atributos enriquecidos.
 
-    Para cada NCM encontrado, busca seus atributos e inclui no resultado.
-    Cada resultado contem NCM completo mais lista de atributos e contagem.
+    Atributos de todos os NCMs encontrados sao buscados em uma unica
+    consulta e incluidos no resultado. Cada resultado contem NCM completo
+    mais lista de atributos e contagem.
 
     Usado para fornecer contexto completo ao LLM no sistema RAG.
     """
     ncm_results = find_ncm_by_description(collection, query, k=k)
-
-    enriched_results = []
-    for ncm in ncm_results:
-        ncm_code = ncm.get('codigo_normalizado') or ncm.get('codigo')
-        atributos = find_atributos_by_ncm(collection, ncm_code, k=10)
-
-        enriched_results.append({
-            **ncm,
-            "atributos": atributos,
-            "num_atributos": len(atributos)
-        })
-
-    return enriched_results
+    return _with_atributos(collection, ncm_results, k=10)
 
 
 def find_ncm_hierarchical(collection, query_text, k=10, prefer_items=True, min_distance=None):
@@ -200,7 +361,23 @@ def find_ncm_hierarchical(collection, query_text, k=10, prefer_items=True, min_d
         k=k*3,  # Busca 3x mais para poder filtrar e priorizar
         filters={"tipo": "ncm"}
     )
+    return _prioritize_hierarchy(results, k, prefer_items, min_distance)
 
+
+def find_ncm_hierarchical_batch(collection, query_texts, k=10, prefer_items=True, min_distance=None):
+    """
+    Versao em lote de find_ncm_hierarchical: uma vetorizacao e uma
+    consulta para todas as descricoes (find_similars_batch), mesma
+    filtragem e priorizacao por nivel em cada lista.
+
+    Retorna lista de listas de resultados, uma por consulta.
+    """
+    batch = find_similars_batch(collection, query_texts, k=k*3, filters={"tipo": "ncm"})
+    return [_prioritize_hierarchy(results, k, prefer_items, min_distance) for results in batch]
+
+
+def _prioritize_hierarchy(results, k, prefer_items=True, min_distance=None):
+    """Filtra por distancia e ordena por nivel (items primeiro), retornando top k."""
     if not results:
         return []
 
@@ -230,22 +407,11 @@ def find_ncm_hierarchical_with_context(collection, query_text, k=8):
     Combina find_ncm_hierarchical (priorizacao de items especificos)
     com enriquecimento de atributos (search_with_context).
 
-    Para cada NCM encontrado hierarquicamente, adiciona seus atributos.
+    Para cada NCM encontrado hierarquicamente, adiciona seus atributos
+    (uma unica consulta para todos os NCMs, ver _with_atributos).
 
     Funcao principal usada no modo interativo para alimentar LLM com
     contexto completo e preciso.
     """
     ncm_results = find_ncm_hierarchical(collection, query_text, k=k, prefer_items=True)
-
-    enriched_results = []
-    for ncm in ncm_results:
-        ncm_code = ncm.get('codigo_normalizado') or ncm.get('codigo')
-        atributos = find_atributos_by_ncm(collection, ncm_code, k=10)
-
-        enriched_results.append({
-            **ncm,
-            "atributos": atributos,
-            "num_atributos": len(atributos)
-        })
-
-    return enriched_results
\ No newline at end of file
+    return _with_atributos(collection, ncm_results, k=10)
\ No newline at end of file
@@ -8,22 +8,174 @@ os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 
 import time
 from datetime import datetime
-from database import get_client, get_or_create_collection
-from config import CLEAR_DB, INDEX_ONLY_ITEMS
+from database import (
+    get_client, get_or_create_collection, load_index_state, save_index_state,
+    is_index_complete, BuildJournal, STATUS_IN_PROGRESS, STATUS_COMPLETE
+)
+from config import (
+    BATCH_SIZE,
+    CLEAR_DB, INDEX_ONLY_ITEMS, INCREMENTAL_INDEX, EMBEDDING_MODEL, DISABLE_NORMALIZATION,
+    ATRIBUTOS_STORAGE, ATRIBUTOS_DB_FILE, SEARCH_ENGINE, VECTOR_INDEX_DIR,
+    ATRIBUTOS_RESIDENT_INDEX
+)
 # from diagnostico.diagnostics import check_prepared_documents  # Removido - função não essencial
 
 
+def source_fingerprint(cached=False):
+    """
+    Impressao digital das fontes e parametros que definem o conteudo do indice.
+
+    Combina hash dos arquivos fonte (data_snapshot.snapshot_key), versao
+    declarada no arquivo de atributos, modelo e backend de embedding e
+    opcoes de indexacao. Qualquer diferenca em relacao ao estado gravado dispara
+    indexacao incremental.
+
+    cached=True reutiliza o hash registrado de cada arquivo enquanto
+    tamanho e mtime nao mudarem (verificacao rapida na inicializacao);
+    indexacao grava a impressao com hash completo.
+    """
+    from data_snapshot import snapshot_key
+    from data_loader import read_atributos_header
+    from embedding_backends import backend_id
+
+    fingerprint = {
+        'fontes': snapshot_key(cached=cached),
+        'versao_atributos': read_atributos_header().get('versao', ''),
+        'modelo': EMBEDDING_MODEL,
+        'backend': backend_id(),
+        'index_only_items': INDEX_ONLY_ITEMS,
+        'normalizacao': not DISABLE_NORMALIZATION
+    }
+    # Modo original ('vector') fica de fora: bancos indexados antes da
+    # opcao nao sao reindexados so por ela
+    if ATRIBUTOS_STORAGE != 'vector':
+        fingerprint['atributos_storage'] = ATRIBUTOS_STORAGE
+    return fingerprint
+
+
+def build_atributos_side_table(ncm_items=None):
+    """
+    Grava atributos na tabela local SQLite (ATRIBUTOS_STORAGE='sqlite').
+
+    Substitui a indexacao vetorial de um documento por atributo: a busca
+    de atributos e sempre exata por codigo NCM (ver atributos_table).
+    ncm_items padrao: JSON de atributos em streaming (iter_atributos_ncm).
+    """
+    from atributos_table import build_atributos_table
+    from data_loader import read_atributos_header, iter_atributos_ncm
+
+    t0 = time.time()
+    count = build_atributos_table(
+        iter_atributos_ncm() if ncm_items is None else ncm_items,
+        info={'versao': read_atributos_header().get('versao', '')}
+    )
+    print(f"  Atributos: {count} linhas em {ATRIBUTOS_DB_FILE} ({time.time()-t0:.1f}s)")
+    return count
+
+
+def export_vector_index(collection):
+    """
+    Exporta vetores NCM da colecao para busca exata em memoria
+    (SEARCH_ENGINE='numpy', ver vector_index), marcada com a data do
+    estado do indice para detectar exportacao desatualizada.
+    """
+    from vector_index import build_vector_index
+
+    t0 = time.time()
+    count = build_vector_index(
+        collection,
+        info={'indice_atualizado_em': load_index_state().get('atualizado_em')}
+    )
+    print(f"  Vetores NCM: {count} em {VECTOR_INDEX_DIR} ({time.time()-t0:.1f}s)")
+    return count
+
+
+def index_sources(collection, delta=None, journal=None):
+    """
+    Carrega fontes e indexa documentos NCM e de atributos na colecao.
+
+    Com delta (IndexDelta), executa em modo incremental: apenas documentos
+    novos/alterados sao vetorizados e, ao final, documentos removidos das
+    fontes sao excluidos do banco.
+
+    Com journal (BuildJournal), lotes gravados sao registrados e lotes ja
+    registrados por execucao interrompida sao pulados (retomada).
+
+    Com ATRIBUTOS_STORAGE='sqlite', atributos vao para a tabela local e o
+    banco vetorial recebe apenas documentos NCM (documentos de atributo
+    de indexacoes anteriores sao removidos no modo incremental).
+    """
+    from data_snapshot import load_parsed_data
+    from data_loader import iter_atributos_ncm, count_atributos_by_ncm
+    from indexer import (
+        prepare_ncm_documents, iter_atributos_documents,
+        index_documents, index_document_stream
+    )
+
+    # Atributos nunca sao carregados inteiros: uma passada em streaming
+    # conta atributos por NCM (texto dos documentos NCM) e outra grava a
+    # tabela ou indexa os documentos de atributo
+    print("\n[1/4] Carregando NCMs, hierarquia e contagem de atributos...")
+    t0 = time.time()
+    ncm_data, hierarchy, _ = load_parsed_data(atributos=False)
+    atributos_count = count_atributos_by_ncm(iter_atributos_ncm())
+    print(f"  NCM: {len(ncm_data)} registros")
+    print(f"  Hierarquia: {len(hierarchy)} niveis")
+    print(f"  Atributos: {len(atributos_count)} NCMs mapeados ({time.time()-t0:.1f}s)")
+
+    print("\n[2/4] Preparando documentos NCM enriquecidos...")
+    t0 = time.time()
+    ncm_docs, ncm_metas, ncm_ids = prepare_ncm_documents(
+        ncm_data, hierarchy, atributos_count, index_only_items=INDEX_ONLY_ITEMS
+    )
+    print(f"  NCMs: {len(ncm_docs)} documentos ({time.time()-t0:.1f}s)")
+
+    # check_prepared_documents(all_docs, all_metas, n=3)  # Removido - função não essencial
+
+    print("\n[3/4] Indexando NCMs no banco vetorial...")
+    t0 = time.time()
+    index_documents(collection, ncm_docs, ncm_metas, ncm_ids, delta=delta, journal=journal)
+    print(f"  Indexacao concluida ({time.time()-t0:.1f}s)")
+
+    del ncm_docs, ncm_metas, ncm_ids
+
+    if ATRIBUTOS_STORAGE == 'sqlite':
+        print("\n[4/4] Gravando atributos na tabela local (SQLite)...")
+        build_atributos_side_table(iter_atributos_ncm())
+    else:
+        # Documentos de atributos sao gerados sob demanda e indexados
+        # lote a lote, sem materializar textos ou vetores do corpus inteiro
+        print("\n[4/4] Indexando atributos em streaming...")
+        t0 = time.time()
+        attr_count = index_document_stream(
+            collection,
+            iter_atributos_documents(iter_atributos_ncm()),
+            total=sum(atributos_count.values()),
+            desc="Atributos",
+            delta=delta,
+            journal=journal
+        )
+        print(f"  Atributos: {attr_count} documentos gravados ({time.time()-t0:.1f}s)")
+
+    if delta is not None:
+        removed = delta.delete_stale(collection)
+        print(f"  Removidos: {removed} documentos ausentes das fontes")
+
+
 def setup_database():
     """
     Configura o banco vetorial ChromaDB com dados enriquecidos de NCM e atributos.
 
-    Realiza as seguintes operacoes em sequencia:
-    1. Carrega dados NCM do arquivo CSV configurado
-    2. Carrega atributos do arquivo JSON configurado
-    3. Constroi hierarquia NCM (capitulos, posicoes, subitens, items)
-    4. Cria indice de atributos por codigo NCM
-    5. Prepara documentos enriquecidos com contexto hierarquico
-    6. Indexa documentos no banco vetorial usando embeddings
+    Realiza as seguintes operacoes em sequencia (ver index_sources):
+    1. Carrega dados NCM e hierarquia (snapshot binario quando fontes nao
+       mudaram, ver data_snapshot) e conta atributos por codigo NCM em
+       streaming (o JSON de atributos nunca e carregado inteiro)
+    2. Prepara documentos NCM enriquecidos com contexto hierarquico
+    3. Indexa documentos NCM no banco vetorial usando embeddings
+    4. Grava atributos na tabela local SQLite (ATRIBUTOS_STORAGE='sqlite')
+       ou indexa documentos de atributo em streaming (modo 'vector')
+    5. Exporta vetores NCM para busca exata em memoria (SEARCH_ENGINE='numpy')
+    6. Carrega indice residente de atributos (ATRIBUTOS_RESIDENT_INDEX)
 
     O processo cria embeddings vetoriais para cada documento usando o modelo
     configurado em EMBEDDING_MODEL. Os documentos sao enriquecidos com:
@@ -32,82 +184,204 @@ def setup_database():
     - Indicacao de atributos cadastrados
     - Nivel hierarquico (capitulo/posicao/subposicao/item)
 
+    Toda indexacao registra lotes gravados em um diario (BuildJournal) e
+    marca o estado do indice como 'em_andamento' ate terminar, quando
+    passa a 'completo'. Se a execucao anterior foi interrompida (queda,
+    falta de memoria, Ctrl-C), a indexacao e retomada do ultimo lote
+    gravado, sem re-vetorizar o que ja foi concluido (tem prioridade
+    sobre CLEAR_DB).
+
     Se CLEAR_DB=True ou banco vazio, executa indexacao completa.
-    Se banco ja existe, reutiliza dados existentes.
+    Se banco ja existe e as fontes mudaram desde a ultima indexacao
+    (ex.: nova versao do arquivo de atributos) com INCREMENTAL_INDEX=True,
+    re-vetoriza apenas documentos novos/alterados e remove os excluidos.
+    Caso contrario, reutiliza dados existentes.
 
     Ao final, exibe diagnostico basico do banco indexado.
     """
-    from data_loader import (
-        load_ncm_data, load_atributos_data,
-        build_ncm_hierarchy, create_atributos_dict
-    )
-    from indexer import (
-        prepare_ncm_documents, prepare_atributos_documents,
-        index_documents
-    )
+    from indexer import IndexDelta
+    from atributos_table import atributos_table_exists
+    from vector_index import vector_index_up_to_date
 
-    start_total = time.time()
     print("="*60)
     print("CONFIGURANDO BANCO VETORIAL ENRIQUECIDO COM HIERARQUIA")
     print(f"Inicio: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*60)
 
     client = get_client()
-    collection = get_or_create_collection(client, clear=CLEAR_DB)
+    state = load_index_state()
+    interrupted = state.get('status') == STATUS_IN_PROGRESS
+    collection = get_or_create_collection(client, clear=CLEAR_DB and not interrupted)
 
-    if CLEAR_DB or collection.count() == 0:
-        print("\n[1/6] Carregando dados NCM...")
-        t0 = time.time()
-        ncm_data = load_ncm_data()
-        print(f"  Total: {len(ncm_data)} registros ({time.time()-t0:.1f}s)")
+    if interrupted:
+        print(f"\nIndexacao anterior interrompida ({state.get('atualizado_em', '?')}): retomando")
+        if CLEAR_DB:
+            print("  CLEAR_DB ignorado para nao descartar lotes ja gravados")
+        _run_build(collection, state, resume=True)
 
-        print("\n[2/6] Carregando atributos...")
-        t0 = time.time()
-        atributos_data = load_atributos_data()
-        total_ncm_attr = len(atributos_data.get('listaNcm', []))
-        print(f"  Total: {total_ncm_attr} NCMs com atributos ({time.time()-t0:.1f}s)")
+    elif CLEAR_DB or collection.count() == 0:
+        _run_build(collection, state, fingerprint=source_fingerprint(), delta=IndexDelta({}))
 
-        print("\n[3/6] Construindo hierarquia NCM...")
-        t0 = time.time()
-        hierarchy = build_ncm_hierarchy(ncm_data)
-        print(f"  Hierarquia: {len(hierarchy)} niveis ({time.time()-t0:.1f}s)")
+    elif not state:
+        # Banco criado antes do estado de indice (ids posicionais): uma
+        # atualizacao incremental equivaleria a reindexar tudo
+        print(f"\nBanco existente: {collection.count()} documentos (sem estado de indice)")
+        print("  Considerado completo; use CLEAR_DB=True em config.py para recriar")
+        print("  com ids estaveis e habilitar indexacao incremental/retomada")
 
-        print("\n[4/6] Criando indice de atributos...")
-        t0 = time.time()
-        atributos_dict = create_atributos_dict(atributos_data)
-        print(f"  Atributos: {len(atributos_dict)} NCMs mapeados ({time.time()-t0:.1f}s)")
+    # Hash completo so quando o rapido (tamanho/mtime) indica mudanca
+    elif (INCREMENTAL_INDEX and state.get('fingerprint') != source_fingerprint(cached=True)
+          and state.get('fingerprint') != (fingerprint := source_fingerprint())):
+        old_version = state.get('fingerprint', {}).get('versao_atributos', '?')
+        print(f"\nFontes alteradas (atributos versao {old_version} -> "
+              f"{fingerprint['versao_atributos']}): indexacao incremental")
+        _run_build(collection, state, fingerprint=fingerprint,
+                   delta=IndexDelta.from_collection(collection))
 
-        print("\n[5/6] Preparando documentos enriquecidos...")
-        t0 = time.time()
-        ncm_docs, ncm_metas, ncm_ids = prepare_ncm_documents(
-            ncm_data, hierarchy, atributos_dict, index_only_items=INDEX_ONLY_ITEMS
-        )
-        attr_docs, attr_metas, attr_ids = prepare_atributos_documents(
-            atributos_data
-        )
+    else:
+        print(f"\nBanco existente: {collection.count()} documentos")
+        print("Use CLEAR_DB=True em config.py para recriar")
 
-        all_docs = ncm_docs + attr_docs
-        all_metas = ncm_metas + attr_metas
-        all_ids = ncm_ids + attr_ids
+    if ATRIBUTOS_STORAGE == 'sqlite' and not atributos_table_exists():
+        # Banco legado (atributos vetorizados) ou tabela apagada
+        print("\nTabela de atributos ausente, gerando a partir das fontes...")
+        build_atributos_side_table()
 
-        print(f"\n  Total preparado: {len(all_docs)} documentos ({time.time()-t0:.1f}s)")
-        print(f"    NCMs: {len(ncm_docs)}")
-        print(f"    Atributos: {len(attr_docs)}")
+    if SEARCH_ENGINE == 'numpy' and is_index_complete() and not vector_index_up_to_date(load_index_state()):
+        print("\nExportando vetores NCM para busca em memoria...")
+        export_vector_index(collection)
 
-        # check_prepared_documents(all_docs, all_metas, n=3)  # Removido - função não essencial
+    if ATRIBUTOS_RESIDENT_INDEX and is_index_complete():
+        from atributos_index import preload_atributos_index
+        preload_atributos_index()
 
-        print("\n[6/6] Indexando no banco vetorial...")
-        t0 = time.time()
-        index_documents(collection, all_docs, all_metas, all_ids)
-        print(f"  Indexacao concluida ({time.time()-t0:.1f}s)")
+    print("="*60)
 
-        elapsed = time.time() - start_total
-        print(f"\nTempo total: {elapsed:.1f}s")
-        print(f"Total no banco: {collection.count()} documentos")
-    else:
-        print(f"\nBanco existente: {collection.count()} documentos")
-        print("Use CLEAR_DB=True em config.py para recriar")
+    return collection
 
-    print("="*60)
 
+def index_up_to_date(state=None):
+    """
+    Indica se setup_database apenas reutilizaria o banco existente.
+
+    Verdadeiro quando nao ha CLEAR_DB, a ultima indexacao terminou, as
+    fontes nao mudaram (com INCREMENTAL_INDEX; por tamanho/mtime, sem
+    reler os arquivos), a tabela de atributos existe
+    (ATRIBUTOS_STORAGE='sqlite') e os vetores NCM exportados
+    correspondem ao indice (SEARCH_ENGINE='numpy'). Nao abre o ChromaDB.
+    """
+    from atributos_table import atributos_table_exists
+    from vector_index import vector_index_up_to_date
+
+    state = load_index_state() if state is None else state
+    if CLEAR_DB or not state or not is_index_complete(state):
+        return False
+    if INCREMENTAL_INDEX and state.get('fingerprint') != source_fingerprint(cached=True):
+        return False
+    if SEARCH_ENGINE == 'numpy' and not vector_index_up_to_date(state):
+        return False
+    return ATRIBUTOS_STORAGE != 'sqlite' or atributos_table_exists()
+
+
+def open_collection(run_setup=True):
+    """
+    Colecao pronta para consulta, configurando o banco so se necessario.
+
+    Indice atualizado (index_up_to_date): abre a colecao diretamente, sem
+    log de configuracao. Caso contrario executa setup_database (ou
+    retorna None com run_setup=False, usado no warm-up em segundo plano).
+
+    Levanta RuntimeError se o indice continuar incompleto.
+    """
+    if index_up_to_date():
+        collection = get_or_create_collection(get_client())
+        if collection.count() > 0:
+            return collection
+    if not run_setup:
+        return None
+
+    collection = setup_database()
+    if not is_index_complete():
+        raise RuntimeError("Indice incompleto: execute novamente para retomar a indexacao")
+    return collection
+
+
+def preload_collection():
+    """
+    Warm-up em segundo plano: importa modulos pesados de consulta
+    (ChromaDB, busca, sentence-transformers) e abre a colecao se o
+    indice estiver atualizado, carregando tambem o indice residente de
+    atributos (ATRIBUTOS_RESIDENT_INDEX). Sem saida no terminal.
+    """
+    import importlib
+
+    for module in ('chromadb', 'search', 'sentence_transformers'):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    collection = open_collection(run_setup=False)
+    if collection is not None and ATRIBUTOS_RESIDENT_INDEX:
+        from atributos_index import preload_atributos_index
+        preload_atributos_index(verbose=False)
     return collection
+
+
+def _run_build(collection, state, fingerprint=None, delta=None, resume=False):
+    """
+    Executa indexacao (completa, incremental ou retomada) com diario.
+
+    Na retomada, reutiliza o diario se as fontes e BATCH_SIZE nao mudaram
+    (lotes registrados sao pulados); caso contrario descarta o diario e
+    segue em modo incremental pelo hash de conteudo, que tambem evita
+    re-vetorizar documentos ja gravados.
+    """
+    from indexer import IndexDelta
+
+    start_total = time.time()
+    journal = BuildJournal()
+
+    if resume:
+        fingerprint = source_fingerprint()
+        header = {'fingerprint': fingerprint, 'batch_size': BATCH_SIZE}
+        if journal.load() and journal.header == header:
+            done = sum(journal.batches.values())
+            print(f"  Diario: {done} lotes ja gravados")
+        else:
+            print("  Fontes ou tamanho de lote mudaram desde a interrupcao: "
+                  "retomando por hash de conteudo")
+            journal.start(header)
+        delta = IndexDelta.from_collection(collection)
+        print(f"  Documentos no banco: {len(delta.existing)}")
+    else:
+        journal.start({'fingerprint': fingerprint, 'batch_size': BATCH_SIZE})
+
+    _save_state(fingerprint, delta, state, STATUS_IN_PROGRESS)
+    index_sources(collection, delta, journal)
+    if delta.existing:
+        delta.report(state.get('segundos_por_documento'))
+
+    elapsed = time.time() - start_total
+    print(f"\nTempo total: {elapsed:.1f}s")
+    print(f"Total no banco: {collection.count()} documentos")
+
+    _save_state(fingerprint, delta, state, STATUS_COMPLETE)
+    journal.finish()
+
+
+def _save_state(fingerprint, delta, previous, status):
+    """Grava estado do indice (em andamento ou completo)."""
+    save_index_state({
+        'status': status,
+        'fingerprint': fingerprint,
+        'atualizado_em': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'segundos_por_documento': delta.seconds_per_document(
+            previous.get('segundos_por_documento')
+        ),
+        'ultimo_delta': {
+            'novos': delta.added,
+            'alterados': delta.updated,
+            'removidos': delta.removed,
+            'inalterados': delta.unchanged
+        }
+    })
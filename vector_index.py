@@ -0,0 +1,301 @@
+# vector_index.py
+# Busca exata em memoria (NumPy) sobre matriz mapeada dos vetores NCM
+
+import json
+import os
+
+import numpy as np
+
+from config import VECTOR_INDEX_DIR, BATCH_SIZE, INDEX_STATE_FILE
+from database import load_index_state
+
+VECTORS_FILE = 'vetores.npy'
+METADATA_FILE = 'metadados.json'
+# Gravado por ultimo: presenca indica exportacao completa
+INFO_FILE = 'info.json'
+
+# Consultas por produto de matrizes em query (limita memoria dos scores)
+_QUERY_CHUNK = 256
+
+_index = None
+_index_path = None
+# mtime do estado do indice e da exportacao quando _index foi avaliado
+_index_version = None
+
+
+def vector_index_exists(path=None):
+    """Verifica se a matriz de vetores NCM ja foi exportada."""
+    path = path or VECTOR_INDEX_DIR
+    return os.path.exists(os.path.join(path, INFO_FILE))
+
+
+def vector_index_info(path=None):
+    """Informacoes da exportacao (quantidade, dimensao, versao do indice); {} se ausente."""
+    path = path or VECTOR_INDEX_DIR
+    try:
+        with open(os.path.join(path, INFO_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def vector_index_up_to_date(state, path=None):
+    """
+    Indica se a exportacao corresponde ao estado atual do indice
+    (database.load_index_state): mesma data de atualizacao.
+    """
+    info = vector_index_info(path)
+    return bool(info) and info.get('indice_atualizado_em') == state.get('atualizado_em')
+
+
+def _normalize_rows(vectors):
+    """Normaliza linhas para norma L2 unitaria (in-place; linhas nulas ficam nulas)."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+class VectorIndex:
+    """
+    Matriz float32 (n x dimensao) de vetores NCM normalizados com ids,
+    documentos e metadados alinhados por linha.
+
+    A matriz e mapeada em memoria (np.load com mmap_mode='r'): processos
+    que abrem o mesmo indice compartilham as paginas do arquivo. Top-k e
+    um produto matriz-vetor (BLAS) seguido de argpartition, resultado
+    exato (sem aproximacao do HNSW); varias consultas viram um unico
+    produto de matrizes.
+
+    Distancia devolvida segue a do ChromaDB (L2 ao quadrado): com vetores
+    unitarios, ||q - d||^2 = 2 - 2 cos(q, d).
+    """
+
+    def __init__(self, vectors, ids, documents, metadatas, info=None):
+        self.vectors = vectors
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.info = info or {}
+        self._columns = {}
+
+    @classmethod
+    def load(cls, path=None):
+        """Abre indice exportado por build_vector_index (None se ausente ou inconsistente)."""
+        path = path or VECTOR_INDEX_DIR
+        if not vector_index_exists(path):
+            return None
+        info = vector_index_info(path)
+        with open(os.path.join(path, METADATA_FILE), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r')
+        if vectors.shape[0] != len(data['ids']) or len(data['ids']) != info.get('quantidade'):
+            print(f"Indice vetorial inconsistente em {path}: "
+                  f"{vectors.shape[0]} vetores, {len(data['ids'])} ids")
+            return None
+        return cls(vectors, data['ids'], data['documents'], data['metadatas'], info)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimension(self):
+        return self.vectors.shape[1]
+
+    def _column(self, field):
+        """Valores de um campo de metadata alinhados com as linhas (object array)."""
+        if field not in self._columns:
+            self._columns[field] = np.array([(m or {}).get(field) for m in self.metadatas], dtype=object)
+        return self._columns[field]
+
+    def filter_mask(self, filters):
+        """
+        Converte filtro where do ChromaDB em mascara booleana por linha.
+
+        Suporta igualdade ({"campo": valor} ou {"campo": {"$eq": valor}})
+        combinada com "$and". Retorna None (todas as linhas), a mascara,
+        ou levanta NotImplementedError para filtros que o indice nao
+        responde (o chamador usa o ChromaDB).
+        """
+        if not filters:
+            if not self.info.get('somente_ncm', False):
+                # Colecao tem outros tipos de documento alem dos exportados
+                raise NotImplementedError("busca sem filtro em colecao com atributos")
+            return None
+
+        conditions = []
+        pending = [filters]
+        while pending:
+            clause = pending.pop()
+            for key, value in clause.items():
+                if key == '$and':
+                    pending.extend(value)
+                elif key.startswith('$'):
+                    raise NotImplementedError(f"operador {key}")
+                elif isinstance(value, dict):
+                    if set(value) != {'$eq'}:
+                        raise NotImplementedError(f"operador em {key}: {list(value)}")
+                    conditions.append((key, value['$eq']))
+                else:
+                    conditions.append((key, value))
+
+        mask = None
+        for field, value in conditions:
+            if field == 'tipo':
+                # Apenas documentos NCM sao exportados
+                if value != 'ncm':
+                    raise NotImplementedError(f"tipo={value}")
+                continue
+            match = self._column(field) == value
+            mask = match if mask is None else mask & match
+        return mask
+
+    def search(self, query_embeddings, k, mask=None):
+        """
+        Top-k exato por cosseno de uma ou varias consultas (n x dimensao).
+
+        Retorna (linhas, distancias), arrays n x k ordenados do mais
+        similar para o menos similar em cada consulta.
+        """
+        queries = _normalize_rows(np.array(np.atleast_2d(query_embeddings), dtype=np.float32))
+        scores = queries @ self.vectors.T
+        available = len(self) if mask is None else int(np.count_nonzero(mask))
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+
+        k = min(k, available)
+        if k <= 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        if k < len(self):
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(self)), (len(queries), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        return top, 2.0 - 2.0 * np.take_along_axis(top_scores, order, axis=1)
+
+    def query(self, query_embeddings, k=10, filters=None):
+        """
+        Consulta no formato de collection.query do ChromaDB: dict com
+        listas ids/documents/metadatas/distances, uma por consulta.
+
+        Aceita um vetor ou matriz de consultas; processadas em blocos de
+        _QUERY_CHUNK (matriz de scores limitada a _QUERY_CHUNK x n).
+        Levanta NotImplementedError se o filtro nao for suportado.
+        """
+        mask = self.filter_mask(filters)
+        queries = np.atleast_2d(query_embeddings)
+        result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        for start in range(0, len(queries), _QUERY_CHUNK):
+            rows, distances = self.search(queries[start:start + _QUERY_CHUNK], k, mask)
+            for row_ids, row_distances in zip(rows.tolist(), distances.tolist()):
+                result['ids'].append([self.ids[i] for i in row_ids])
+                result['documents'].append([self.documents[i] for i in row_ids])
+                result['metadatas'].append([self.metadatas[i] for i in row_ids])
+                result['distances'].append(row_distances)
+        return result
+
+
+def build_vector_index(collection, path=None, info=None, page_size=BATCH_SIZE):
+    """
+    Exporta vetores NCM da colecao para a matriz mapeada em memoria.
+
+    Le documentos tipo 'ncm' paginados (ids, documentos, metadados e
+    embeddings), normaliza os vetores e grava vetores.npy, metadados.json
+    e info.json. Arquivos temporarios sao substituidos ao final
+    (os.replace), com info.json removido antes e gravado por ultimo:
+    exportacao interrompida fica ausente, nunca parcial. info (dict) e
+    gravado junto (ex.: indice_atualizado_em do estado do indice).
+
+    Retorna quantidade de vetores exportados.
+    """
+    global _index, _index_path, _index_version
+
+    path = path or VECTOR_INDEX_DIR
+    os.makedirs(path, exist_ok=True)
+
+    ids, documents, metadatas, blocks = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(
+            where={'tipo': 'ncm'},
+            include=['embeddings', 'documents', 'metadatas'],
+            limit=page_size,
+            offset=offset
+        )
+        if not page['ids']:
+            break
+        ids.extend(page['ids'])
+        documents.extend(page['documents'])
+        metadatas.extend(page['metadatas'])
+        blocks.append(np.asarray(page['embeddings'], dtype=np.float32))
+        offset += len(page['ids'])
+
+    vectors = _normalize_rows(np.vstack(blocks)) if blocks else np.empty((0, 0), dtype=np.float32)
+
+    info = dict(info or {})
+    info.update({
+        'quantidade': len(ids),
+        'dimensao': int(vectors.shape[1]),
+        'somente_ncm': collection.count() == len(ids)
+    })
+
+    vectors_path = os.path.join(path, VECTORS_FILE)
+    metadata_path = os.path.join(path, METADATA_FILE)
+    info_path = os.path.join(path, INFO_FILE)
+    # np.save acrescenta .npy a nomes sem essa extensao
+    np.save(vectors_path + '.tmp.npy', vectors)
+    with open(metadata_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'ids': ids, 'documents': documents, 'metadatas': metadatas}, f, ensure_ascii=False)
+    with open(info_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+
+    if _index_path == path:
+        _index, _index_path, _index_version = None, None, None
+    if os.path.exists(info_path):
+        os.remove(info_path)
+    os.replace(vectors_path + '.tmp.npy', vectors_path)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    os.replace(info_path + '.tmp', info_path)
+    return len(ids)
+
+
+def _index_version_key(path):
+    """mtime do estado do indice e do info.json da exportacao (None se ausente)."""
+    version = []
+    for file in (INDEX_STATE_FILE, os.path.join(path, INFO_FILE)):
+        try:
+            version.append(os.stat(file).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def get_vector_index(path=None):
+    """
+    Retorna indice vetorial em memoria (singleton por caminho), ou None
+    se ainda nao exportado ou desatualizado em relacao ao estado do
+    indice (vector_index_up_to_date: indexacao posterior a exportacao,
+    inclusive em andamento). None faz a busca usar o ChromaDB.
+
+    Estado do indice e exportacao sao verificados por mtime a cada
+    chamada; quando mudam, o indice e reavaliado e recarregado.
+    """
+    global _index, _index_path, _index_version
+
+    path = path or VECTOR_INDEX_DIR
+    version = _index_version_key(path)
+    if _index_path != path or _index_version != version:
+        fresh = vector_index_up_to_date(load_index_state(), path)
+        _index = VectorIndex.load(path) if fresh else None
+        _index_path, _index_version = path, version
+    return _index
+
+
+def close_vector_index():
+    """Descarta indice carregado (proxima consulta reabre os arquivos)."""
+    global _index, _index_path, _index_version
+    _index = None
+    _index_path = None
+    _index_version = None
@@ -3,6 +3,8 @@
 
 import random
 from search import find_atributos_by_ncm, find_ncm_by_description
+from atributos_table import count_atributos
+from config import ATRIBUTOS_RESIDENT_INDEX
 
 
 def show_sample_data(collection, n=5):
@@ -195,7 +197,8 @@ def show_statistics(collection):
     Conta e exibe:
     - Total de documentos indexados no banco
     - Quantidade de documentos do tipo NCM
-    - Quantidade de documentos do tipo atributo
+    - Quantidade de atributos (tabela local ou documentos do banco)
+    - Indice residente de atributos: NCMs, atributos e memoria ocupada
 
     Util para verificacao rapida do estado do banco apos indexacao.
     """
@@ -210,9 +213,17 @@ def show_statistics(collection):
         ncm_count = len(collection.get(where={"tipo": "ncm"}, limit=20000)['ids'])
         print(f"Documentos NCM: {ncm_count}")
 
-        attr_count = len(collection.get(where={"tipo": "atributo"}, limit=60000)['ids'])
-        print(f"Documentos Atributo: {attr_count}")
+        attr_count, origem = count_atributos(collection, limit=60000)
+        print(f"Atributos ({origem}): {attr_count}")
     except Exception as e:
         print(f"Erro ao contar: {e}")
 
+    if ATRIBUTOS_RESIDENT_INDEX:
+        from atributos_index import get_atributos_index
+        index = get_atributos_index()
+        if index is not None:
+            stats = index.stats()
+            print(f"Indice de atributos em memoria: {stats['ncms']} NCMs, {stats['atributos']} atributos, "
+                  f"{stats['memoria_mb']:.1f} MB ({stats['origem']})")
+
     print("="*60)